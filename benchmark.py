@@ -0,0 +1,473 @@
+"""
+Benchmark Harness for Hello Zombie Main Server
+Runs main_server:app against an in-process fake Ollama and drives it with
+concurrent async clients; results can be saved as a baseline and compared
+"""
+
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import httpx
+import uvicorn
+import yaml
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+REPO_DIR = Path(__file__).resolve().parent
+FAKE_MODELS = ["gemma:2b", "deepseek-coder:6.7b"]
+SCENARIOS = ["chat", "cached", "stream", "openai"]
+# Compared against a baseline; "higher" metrics regress when they drop
+REGRESSION_METRICS = {
+    "throughput_rps": "higher",
+    "p50_ms": "lower",
+    "p95_ms": "lower",
+    "p99_ms": "lower",
+    "error_rate": "lower"
+}
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def start_server(app, port: int) -> uvicorn.Server:
+    """Run an ASGI app with uvicorn on a daemon thread and wait until it listens"""
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    deadline = time.time() + 30
+    while not server.started:
+        if not thread.is_alive() or time.time() > deadline:
+            raise RuntimeError(f"Server on port {port} failed to start")
+        time.sleep(0.05)
+    return server
+
+def stop_server(server: uvicorn.Server):
+    server.should_exit = True
+    deadline = time.time() + 10
+    while server.started and time.time() < deadline:
+        time.sleep(0.05)
+
+# ============================================================================
+# Fake Ollama
+# ============================================================================
+
+def create_fake_ollama(token_rate: float, first_token_ms: float, tokens: int, failure_rate: float) -> FastAPI:
+    """Ollama look-alike: /api/tags, /api/ps, /api/generate, /api/chat, /api/embeddings
+
+    Generations take first_token_ms, then emit `tokens` tokens at `token_rate`
+    tokens/second, streamed as NDJSON unless "stream" is false. A
+    `failure_rate` fraction of generations fail with a 500.
+    """
+    fake = FastAPI()
+    fake.state.stats = {"generations": 0, "failures": 0, "embeddings": 0}
+    token_delay = 1.0 / token_rate if token_rate > 0 else 0.0
+
+    def final_chunk(model: str, prompt_chars: int, elapsed: float) -> Dict[str, Any]:
+        prompt_tokens = max(1, prompt_chars // 4)
+        eval_seconds = tokens * token_delay
+        return {
+            "model": model,
+            "done": True,
+            "prompt_eval_count": prompt_tokens,
+            "eval_count": tokens,
+            "prompt_eval_duration": int(first_token_ms * 1e6),
+            "eval_duration": int(eval_seconds * 1e9),
+            "total_duration": int(elapsed * 1e9),
+            "context": [1, 2, 3]
+        }
+
+    def fragment(kind: str, text: str) -> Dict[str, Any]:
+        if kind == "chat":
+            return {"message": {"role": "assistant", "content": text}}
+        return {"response": text}
+
+    async def generate(kind: str, request: Request):
+        body = await request.json()
+        fake.state.stats["generations"] += 1
+        if failure_rate and random.random() < failure_rate:
+            fake.state.stats["failures"] += 1
+            return JSONResponse({"error": "injected failure"}, status_code=500)
+        model = body.get("model", FAKE_MODELS[0])
+        if kind == "chat":
+            prompt_chars = sum(len(m.get("content", "")) for m in body.get("messages", []))
+        else:
+            prompt_chars = len(body.get("prompt", ""))
+        words = [f" token{i}" for i in range(tokens)]
+        start = time.perf_counter()
+
+        if not body.get("stream", True):
+            await asyncio.sleep(first_token_ms / 1000 + tokens * token_delay)
+            result = final_chunk(model, prompt_chars, time.perf_counter() - start)
+            result.update(fragment(kind, "".join(words)))
+            return JSONResponse(result)
+
+        async def ndjson():
+            await asyncio.sleep(first_token_ms / 1000)
+            for word in words:
+                chunk = {"model": model, "done": False}
+                chunk.update(fragment(kind, word))
+                yield json.dumps(chunk) + "\n"
+                await asyncio.sleep(token_delay)
+            chunk = final_chunk(model, prompt_chars, time.perf_counter() - start)
+            chunk.update(fragment(kind, ""))
+            yield json.dumps(chunk) + "\n"
+
+        return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+    @fake.get("/api/tags")
+    async def tags():
+        return {"models": [{"name": name, "size": 1, "modified_at": "2024-01-01T00:00:00Z"} for name in FAKE_MODELS]}
+
+    @fake.get("/api/ps")
+    async def ps():
+        return {"models": [{"name": FAKE_MODELS[0]}]}
+
+    @fake.post("/api/generate")
+    async def api_generate(request: Request):
+        return await generate("generate", request)
+
+    @fake.post("/api/chat")
+    async def api_chat(request: Request):
+        return await generate("chat", request)
+
+    @fake.post("/api/embeddings")
+    async def api_embeddings(request: Request):
+        body = await request.json()
+        fake.state.stats["embeddings"] += 1
+        vector = [0.0] * 32
+        for ch in body.get("prompt", "").lower():
+            vector[ord(ch) % 32] += 1.0
+        return {"embedding": vector}
+
+    return fake
+
+# ============================================================================
+# Main server under test
+# ============================================================================
+
+def write_bench_config(workdir: Path, ollama_url: str, args) -> None:
+    """Point a throwaway copy of the server config at the fake Ollama"""
+    config_path = workdir / "Extension" / "agent_config" / "hello_zombie.yaml"
+    config_path.parent.mkdir(parents=True, exist_ok=True)
+    (workdir / "data" / "memory").mkdir(parents=True, exist_ok=True)
+    bench_config = {
+        "agent": {"name": "Hello Zombie", "model": FAKE_MODELS[0]},
+        "infrastructure": {
+            "ollama": {
+                "host": ollama_url,
+                "model_name": FAKE_MODELS[0],
+                "scheduler": {
+                    "max_concurrency": args.max_concurrency,
+                    "max_queue": max(32, args.concurrency * 2)
+                }
+            },
+            "cache": {
+                "semantic": {"enabled": args.semantic},
+                "persistent": {"enabled": True, "location": "data/memory/bench_cache.sqlite"}
+            },
+            "hot_reload": {"enabled": False},
+            # Per-request INFO lines would drown the report; main_server.log in workdir keeps them
+            "logging": {"console_level": "INFO" if args.verbose else "WARNING"},
+            "memory": {"location": "data/memory/bench_memory.sqlite"}
+        }
+    }
+    with open(config_path, "w", encoding="utf-8") as f:
+        yaml.safe_dump(bench_config, f)
+
+def load_main_server(workdir: Path):
+    """Import main_server with workdir as the current directory
+
+    The server resolves its config, database and log paths relative to the
+    working directory, so the benchmark never touches the real data/.
+    """
+    os.chdir(workdir)
+    spec = importlib.util.spec_from_file_location("main_server", REPO_DIR / "main_server.py")
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["main_server"] = module
+    spec.loader.exec_module(module)
+    return module
+
+# ============================================================================
+# Load generation
+# ============================================================================
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(pct / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+class ScenarioRun:
+    """One scenario: `requests` requests from `concurrency` clients"""
+
+    def __init__(self, name: str, base_url: str, requests: int, concurrency: int, distinct: int):
+        self.name = name
+        self.base_url = base_url
+        self.requests = requests
+        self.concurrency = concurrency
+        self.distinct = distinct
+        self.run_id = uuid.uuid4().hex[:8]
+        self.latencies: List[float] = []
+        self.first_token: List[float] = []
+        self.statuses: Dict[str, int] = {}
+        self.errors = 0
+
+    def prompt(self, index: int) -> str:
+        if self.name == "cached":
+            return f"Benchmark question {index % self.distinct}: what is {index % self.distinct} + 2?"
+        return f"Benchmark {self.run_id} question {index}: explain item {index} briefly."
+
+    async def one(self, client: httpx.AsyncClient, index: int):
+        text = self.prompt(index)
+        start = time.perf_counter()
+        status = "error"
+        try:
+            if self.name == "stream":
+                async with client.stream("POST", "/chat/stream", json={"agent": "bench", "input": text}) as response:
+                    status = str(response.status_code)
+                    first = True
+                    async for line in response.aiter_lines():
+                        if not line.startswith("data: "):
+                            continue
+                        if first:
+                            self.first_token.append(time.perf_counter() - start)
+                            first = False
+                        if '"error"' in line:
+                            status = "stream_error"
+            elif self.name == "openai":
+                response = await client.post("/v1/chat/completions", json={
+                    "model": FAKE_MODELS[0],
+                    "messages": [{"role": "user", "content": text}]
+                })
+                status = str(response.status_code)
+            else:
+                response = await client.post("/chat", json={"agent": "bench", "input": text})
+                status = str(response.status_code)
+                if response.status_code == 200 and not response.json().get("success", False):
+                    status = "unsuccessful"
+        except httpx.HTTPError as e:
+            status = type(e).__name__
+        self.latencies.append(time.perf_counter() - start)
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        if status != "200":
+            self.errors += 1
+
+    async def run(self) -> float:
+        counter = iter(range(self.requests))
+        limits = httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency)
+        async with httpx.AsyncClient(base_url=self.base_url, limits=limits, timeout=120) as client:
+            async def worker():
+                for index in counter:
+                    await self.one(client, index)
+            start = time.perf_counter()
+            await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+            return time.perf_counter() - start
+
+    def summary(self, elapsed: float) -> Dict[str, Any]:
+        ordered = sorted(self.latencies)
+        result = {
+            "requests": len(ordered),
+            "concurrency": self.concurrency,
+            "elapsed_seconds": round(elapsed, 3),
+            "throughput_rps": round(len(ordered) / elapsed, 2) if elapsed else 0.0,
+            "p50_ms": round(percentile(ordered, 50) * 1000, 2),
+            "p95_ms": round(percentile(ordered, 95) * 1000, 2),
+            "p99_ms": round(percentile(ordered, 99) * 1000, 2),
+            "max_ms": round(ordered[-1] * 1000, 2) if ordered else 0.0,
+            "error_rate": round(self.errors / len(ordered), 4) if ordered else 0.0,
+            "statuses": self.statuses
+        }
+        if self.first_token:
+            first = sorted(self.first_token)
+            result["ttft_p50_ms"] = round(percentile(first, 50) * 1000, 2)
+            result["ttft_p95_ms"] = round(percentile(first, 95) * 1000, 2)
+        return result
+
+async def server_counters(client: httpx.AsyncClient) -> Dict[str, Any]:
+    """Cache, coalescing and writer counters from /performance"""
+    perf = (await client.get("/performance")).json()
+    cache = perf["cache"]
+    persistent = cache.get("persistent", {})
+    semantic = cache.get("semantic", {})
+    return {
+        "memory_hits": cache.get("hits", 0),
+        "misses": cache.get("misses", 0),
+        "persistent_hits": persistent.get("hits", 0),
+        "semantic_hits": semantic.get("hits", 0),
+        "coalesced": perf["coalescing"].get("followers", 0),
+        "written": perf["database"]["writer"]["written"],
+        "queued": perf["database"]["writer"]["queued"],
+        "write_batches": perf["database"]["writer"]["batches"]
+    }
+
+async def drain_writer(client: httpx.AsyncClient, timeout: float = 10.0) -> Dict[str, Any]:
+    """Wait for the write-behind queue to empty so DB rates count every row
+
+    An empty queue is not enough: the writer may still hold a batch it is
+    gathering, so also wait until the written count stops moving.
+    """
+    deadline = time.time() + timeout
+    counters = await server_counters(client)
+    while time.time() < deadline:
+        await asyncio.sleep(0.6)  # longer than the writer's 0.5s gather window
+        latest = await server_counters(client)
+        if not latest["queued"] and latest["written"] == counters["written"]:
+            return latest
+        counters = latest
+    return counters
+
+async def run_benchmark(base_url: str, fake: FastAPI, args) -> Dict[str, Any]:
+    results: Dict[str, Any] = {}
+    async with httpx.AsyncClient(base_url=base_url, timeout=30) as client:
+        for name in args.scenarios:
+            before = await drain_writer(client)
+            generations_before = fake.state.stats["generations"]
+            write_start = time.perf_counter()
+            run = ScenarioRun(name, base_url, args.requests, args.concurrency, args.distinct)
+            elapsed = await run.run()
+            after = await drain_writer(client)
+            write_elapsed = time.perf_counter() - write_start
+
+            summary = run.summary(elapsed)
+            hits = sum(after[k] - before[k] for k in ("memory_hits", "persistent_hits", "semantic_hits"))
+            lookups = hits + (after["misses"] - before["misses"])
+            summary["cache_hits"] = hits
+            summary["cache_hit_ratio"] = round(hits / lookups, 4) if lookups else 0.0
+            summary["coalesced"] = after["coalesced"] - before["coalesced"]
+            summary["ollama_generations"] = fake.state.stats["generations"] - generations_before
+            summary["db_rows_written"] = after["written"] - before["written"]
+            summary["db_write_batches"] = after["write_batches"] - before["write_batches"]
+            summary["db_writes_per_second"] = round(summary["db_rows_written"] / write_elapsed, 2) if write_elapsed else 0.0
+            results[name] = summary
+            print_scenario(name, summary)
+    return results
+
+# ============================================================================
+# Reporting and baselines
+# ============================================================================
+
+def print_scenario(name: str, summary: Dict[str, Any]):
+    line = (f"  {name:<8} {summary['throughput_rps']:>8.2f} req/s  "
+            f"p50 {summary['p50_ms']:>8.2f}  p95 {summary['p95_ms']:>8.2f}  p99 {summary['p99_ms']:>8.2f} ms  "
+            f"errors {summary['error_rate']:.2%}  hit ratio {summary['cache_hit_ratio']:.2%}  "
+            f"db {summary['db_writes_per_second']:.1f} rows/s")
+    if "ttft_p50_ms" in summary:
+        line += f"  ttft p50 {summary['ttft_p50_ms']:.2f} ms"
+    print(line)
+
+def compare_to_baseline(results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """List every metric that moved the wrong way by more than `tolerance`"""
+    regressions = []
+    for name, summary in results.items():
+        previous = baseline.get("scenarios", {}).get(name)
+        if not previous:
+            continue
+        for metric, better in REGRESSION_METRICS.items():
+            old, new = previous.get(metric), summary.get(metric)
+            if old is None or new is None:
+                continue
+            if metric == "error_rate":
+                # Absolute: a 0% baseline would otherwise flag any single error
+                regressed = new - old > tolerance / 10
+            elif better == "higher":
+                regressed = old > 0 and new < old * (1 - tolerance)
+            else:
+                regressed = old > 0 and new > old * (1 + tolerance)
+            if regressed:
+                regressions.append(f"{name}.{metric}: {old} -> {new}")
+    return regressions
+
+def parse_args(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Benchmark main_server against a fake Ollama")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help=f"comma-separated subset of {','.join(SCENARIOS)}")
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=16, help="concurrent clients")
+    parser.add_argument("--distinct", type=int, default=10, help="distinct prompts in the cached scenario")
+    parser.add_argument("--token-rate", type=float, default=500.0, help="fake Ollama tokens per second")
+    parser.add_argument("--tokens", type=int, default=32, help="tokens per fake response")
+    parser.add_argument("--first-token-ms", type=float, default=20.0, help="fake Ollama latency before the first token")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="fraction of fake generations that fail")
+    parser.add_argument("--max-concurrency", type=int, default=4, help="server scheduler slots per model")
+    parser.add_argument("--semantic", action="store_true", help="enable the semantic cache tier")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--verbose", action="store_true", help="show the server's INFO logs")
+    parser.add_argument("--save-baseline", metavar="PATH", help="write results as a baseline JSON file")
+    parser.add_argument("--compare", metavar="PATH", help="fail when results regress against this baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression (0.2 = 20%%)")
+    args = parser.parse_args(argv)
+    args.scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = [s for s in args.scenarios if s not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+    for attr in ("save_baseline", "compare"):
+        if getattr(args, attr):
+            setattr(args, attr, str(Path(getattr(args, attr)).resolve()))
+    return args
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    random.seed(args.seed)
+    print("🚀 Starting Hello Zombie Benchmark...")
+    print("=" * 50)
+
+    fake = create_fake_ollama(args.token_rate, args.first_token_ms, args.tokens, args.failure_rate)
+    fake_port = free_port()
+    fake_server = start_server(fake, fake_port)
+
+    original_cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="hz-bench-") as workdir:
+        write_bench_config(Path(workdir), f"http://127.0.0.1:{fake_port}", args)
+        main_server = load_main_server(Path(workdir))
+        server_port = free_port()
+        server = start_server(main_server.app, server_port)
+        try:
+            results = asyncio.run(run_benchmark(f"http://127.0.0.1:{server_port}", fake, args))
+        finally:
+            stop_server(server)
+            stop_server(fake_server)
+            os.chdir(original_cwd)
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "settings": {k: v for k, v in vars(args).items() if k not in ("save_baseline", "compare", "verbose")},
+        "scenarios": results
+    }
+    print("=" * 50)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"💾 Baseline saved to {args.save_baseline}")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("settings") != report["settings"]:
+            print("⚠️  Settings differ from the baseline; comparison may not be meaningful")
+        regressions = compare_to_baseline(results, baseline, args.tolerance)
+        if regressions:
+            print(f"❌ PERFORMANCE REGRESSION (tolerance {args.tolerance:.0%}):")
+            for regression in regressions:
+                print(f"   {regression}")
+            return 1
+        print(f"✅ No regressions against {args.compare}")
+
+    print("🎉 BENCHMARK COMPLETE")
+    return 0
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,305 @@
+"""
+Concurrency Test for Hello Zombie Main Server
+Checks single-flight generation, the per-model admission scheduler and
+multi-worker coordination (leases, shared slots, shared generation waits
+and batch claims). Ollama generations are replaced by a counting stand-in
+and every coordination file lives in a temporary directory.
+"""
+
+import asyncio
+import sqlite3
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from migration_test import load_server
+
+@contextmanager
+def patched(module, **values):
+    """Temporarily replace module globals"""
+    saved = {name: getattr(module, name) for name in values}
+    for name, value in values.items():
+        setattr(module, name, value)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(module, name, value)
+
+@contextmanager
+def coordinators(count: int = 2):
+    """Open `count` workers sharing one fresh coordination file"""
+    server = load_server()
+    path = Path(tempfile.mkdtemp(prefix="hello_zombie_coordination_")) / "coordination.sqlite"
+    workers = [server.WorkerCoordinator(str(path), f"worker-{index}") for index in range(count)]
+    for worker in workers:
+        worker.open()
+    try:
+        yield workers
+    finally:
+        for worker in workers:
+            worker.close()
+
+def crash(worker):
+    """Make a worker look like it stopped heartbeating long ago"""
+    conn = sqlite3.connect(worker.path)
+    conn.execute("UPDATE workers SET updated_at = 0 WHERE worker_id = ?", (worker.worker_id,))
+    conn.commit()
+    conn.close()
+
+def test_generate_coalesced():
+    """Identical concurrent generations reach Ollama once; a cancelled caller does not abort the others"""
+    print("🔍 Testing Single-Flight Generation...")
+    server = load_server()
+    calls = []
+
+    async def fake_generate(path, payload, priority=server.PRIORITY_INTERACTIVE):
+        calls.append(payload["prompt"])
+        await asyncio.sleep(0.1)
+        return {"response": f"answer to {payload['prompt']}", "model": payload["model"], "done": True}
+
+    async def scenario():
+        payload = {"model": "m", "prompt": "coalesce me"}
+        callers = [asyncio.create_task(server.generate_coalesced("coalesce-key", "/api/generate", payload))
+                   for _ in range(5)]
+        await asyncio.sleep(0.02)
+        callers[0].cancel()
+        results = await asyncio.gather(*callers[1:])
+        return results, callers[0].cancelled()
+
+    leaders = server.coalescing_stats["leaders"]
+    followers = server.coalescing_stats["followers"]
+    with patched(server, ollama_generate=fake_generate):
+        results, cancelled = asyncio.run(scenario())
+    assert calls == ["coalesce me"]
+    assert cancelled
+    assert all(result["response"] == "answer to coalesce me" for result in results)
+    assert server.coalescing_stats["leaders"] - leaders == 1
+    assert server.coalescing_stats["followers"] - followers == 4
+    assert "coalesce-key" not in server.inflight_generations
+    assert server.response_cache.get("coalesce-key")["response"] == "answer to coalesce me"
+    print("✅ Single-flight generation: PASS")
+
+def test_scheduler_priority():
+    """A freed slot goes to the highest-priority waiter, not the first to arrive"""
+    print("🔍 Testing Scheduler Priority...")
+    server = load_server()
+    scheduler = server.OllamaScheduler(1, {}, 4, {0: 5.0, 1: 5.0, 2: 5.0})
+    order = []
+
+    async def job(name: str, priority: int, hold: asyncio.Event = None):
+        async with scheduler.slot("m", priority):
+            order.append(name)
+            if hold is not None:
+                await hold.wait()
+
+    async def scenario():
+        hold = asyncio.Event()
+        holder = asyncio.create_task(job("holder", server.PRIORITY_INTERACTIVE, hold))
+        await asyncio.sleep(0)
+        waiters = [asyncio.create_task(job("batch", server.PRIORITY_BATCH)),
+                   asyncio.create_task(job("background", server.PRIORITY_BACKGROUND)),
+                   asyncio.create_task(job("interactive", server.PRIORITY_INTERACTIVE))]
+        await asyncio.sleep(0.01)
+        assert scheduler.stats()["models"]["m"]["queued"] == 3
+        hold.set()
+        await asyncio.gather(holder, *waiters)
+
+    asyncio.run(scenario())
+    assert order == ["holder", "interactive", "background", "batch"], order
+    stats = scheduler.stats()["models"]["m"]
+    assert stats["running"] == 0 and stats["queued"] == 0 and stats["admitted"] == 4
+    print("✅ Scheduler priority: PASS")
+
+def test_scheduler_rejections():
+    """A full queue is refused with 429 and a waiter past its deadline with 503"""
+    print("🔍 Testing Scheduler Rejections...")
+    server = load_server()
+    scheduler = server.OllamaScheduler(1, {}, 1, {0: 0.2, 1: 0.2, 2: 0.2})
+
+    async def scenario():
+        hold = asyncio.Event()
+
+        async def holder():
+            async with scheduler.slot("m"):
+                await hold.wait()
+
+        async def waiter():
+            async with scheduler.slot("m"):
+                pass
+
+        running = asyncio.create_task(holder())
+        await asyncio.sleep(0)
+        queued = asyncio.create_task(waiter())
+        await asyncio.sleep(0.01)
+        statuses = []
+        try:
+            scheduler.check_admission("m")
+        except server.SchedulerRejected as e:
+            statuses.append(e.status_code)
+        try:
+            async with scheduler.slot("m"):
+                pass
+        except server.SchedulerRejected as e:
+            statuses.append(e.status_code)
+        try:
+            await queued
+        except server.SchedulerRejected as e:
+            statuses.append(e.status_code)
+        hold.set()
+        await running
+        return statuses
+
+    assert asyncio.run(scenario()) == [429, 429, 503]
+    stats = scheduler.stats()["models"]["m"]
+    assert stats["rejected_queue_full"] == 2 and stats["rejected_deadline"] == 1
+    assert stats["running"] == 0 and stats["queued"] == 0
+    print("✅ Scheduler rejections: PASS")
+
+def test_leases_and_leadership():
+    """A lease has one owner at a time and passes on when released or when its owner stops heartbeating"""
+    print("🔍 Testing Leases...")
+    with coordinators() as (a, b):
+        assert a.try_acquire("gen:x", 30)
+        assert not b.try_acquire("gen:x", 30)
+        assert a.try_acquire("gen:x", 30)  # renewal
+        a.release("gen:x")
+        assert b.try_acquire("gen:x", 30)
+
+        assert a.try_acquire("gen:short", 0.05)
+        time.sleep(0.1)
+        assert b.try_acquire("gen:short", 30)
+
+        assert a.elect() and not b.elect()
+        assert a.is_leader and not b.is_leader
+        crash(a)
+        assert b.elect() and b.elections_won == 1
+        assert a.counter("cache_epoch") == 0
+        assert a.bump("cache_epoch") == 1 and b.bump("cache_epoch") == 2
+        assert [worker["worker_id"] for worker in b.workers()] == ["worker-1"]
+    print("✅ Leases: PASS")
+
+def test_shared_slots():
+    """Generation slots are shared across workers, and a crashed worker's slots are freed"""
+    print("🔍 Testing Shared Slots...")
+    with coordinators() as (a, b):
+        assert a.acquire_slot("m", 2) == 0
+        assert b.acquire_slot("m", 2) == 1
+        assert a.acquire_slot("m", 2) is None
+        assert a.acquire_slot("other", 2) == 0
+        b.release_slot("m", 1)
+        assert a.acquire_slot("m", 2) == 1
+        a.release_slot("m", 1)
+        assert b.acquire_slot("m", 2) == 1
+        crash(b)
+        assert a.acquire_slot("m", 2) == 1
+
+    server = load_server()
+    scheduler = server.OllamaScheduler(1, {}, 4, {0: 0.3, 1: 0.3, 2: 0.3})
+
+    async def scenario():
+        async with scheduler.slot("m"):
+            pass
+
+    with coordinators() as (a, b), patched(server, worker_coordinator=b):
+        assert a.acquire_slot("m", 1) == 0
+        try:
+            asyncio.run(scenario())
+            raise AssertionError("slot held by another worker was admitted")
+        except server.SchedulerRejected as e:
+            assert e.status_code == 503
+        a.release_slot("m", 0)
+        asyncio.run(scenario())
+        assert b.acquire_slot("m", 1) == 0  # released on exit
+    stats = scheduler.stats()["models"]["m"]
+    assert stats["running"] == 0 and stats["rejected_deadline"] == 1 and stats["admitted"] == 1
+    print("✅ Shared slots: PASS")
+
+def test_shared_generation_wait():
+    """A worker waits for another's identical generation and reads it from the shared tier, or gives up"""
+    print("🔍 Testing Shared Generation Wait...")
+    server = load_server()
+    directory = Path(tempfile.mkdtemp(prefix="hello_zombie_shared_cache_"))
+    owner_cache = server.PersistentResponseCache(str(directory / "cache.sqlite"), 60, 100)
+    waiter_cache = server.PersistentResponseCache(str(directory / "cache.sqlite"), 60, 100)
+    assert owner_cache.open() and waiter_cache.open()
+    stats = server.coordination_stats
+
+    async def finish_later(owner, key: str):
+        await asyncio.sleep(0.3)
+        owner_cache.set(key, {"response": "shared answer", "model": "m"})
+        owner_cache.flush()
+        owner.release(f"gen:{key}")
+
+    async def scenario(owner, key: str):
+        finisher = asyncio.create_task(finish_later(owner, key))
+        result = await server.wait_for_shared_generation(key)
+        await finisher
+        return result
+
+    try:
+        with coordinators() as (a, b), patched(server, worker_coordinator=b, persistent_cache=waiter_cache):
+            hits, waits = stats["shared_generation_hits"], stats["shared_generation_waits"]
+            assert a.try_acquire("gen:shared-key", 60)
+            assert asyncio.run(scenario(a, "shared-key")) == {"response": "shared answer", "model": "m"}
+            assert stats["shared_generation_hits"] - hits == 1
+            assert stats["shared_generation_waits"] - waits == 1
+
+            # Nobody holds the lease: generate right away
+            assert asyncio.run(server.wait_for_shared_generation("free-key")) is None
+
+            # The owner never finishes: give up at the deadline
+            timeouts = stats["shared_generation_timeouts"]
+            assert a.try_acquire("gen:stuck-key", 60)
+            with patched(server, SHARED_WAIT_SECONDS=0.3):
+                start = time.monotonic()
+                assert asyncio.run(server.wait_for_shared_generation("stuck-key")) is None
+                assert time.monotonic() - start < 2
+            assert stats["shared_generation_timeouts"] - timeouts == 1
+    finally:
+        owner_cache.close()
+        waiter_cache.close()
+    print("✅ Shared generation wait: PASS")
+
+def test_batch_claims():
+    """One worker runs a batch; another takes it over only after the first stops heartbeating"""
+    print("🔍 Testing Batch Claims...")
+    server = load_server()
+    with coordinators() as (a, b):
+        with patched(server, worker_coordinator=a):
+            assert asyncio.run(server.claim_batch("batch_claim"))
+        with patched(server, worker_coordinator=b):
+            assert not asyncio.run(server.claim_batch("batch_claim"))
+            crash(a)
+            assert asyncio.run(server.claim_batch("batch_claim"))
+    with patched(server, worker_coordinator=None):
+        assert asyncio.run(server.claim_batch("batch_claim"))
+    print("✅ Batch claims: PASS")
+
+def run_concurrency_tests():
+    """Run all concurrency tests"""
+    print("🚀 Starting Hello Zombie Concurrency Tests...")
+    print("=" * 50)
+
+    try:
+        test_generate_coalesced()
+        test_scheduler_priority()
+        test_scheduler_rejections()
+        test_leases_and_leadership()
+        test_shared_slots()
+        test_shared_generation_wait()
+        test_batch_claims()
+
+        print("=" * 50)
+        print("🎉 ALL CONCURRENCY TESTS PASSED!")
+        return True
+
+    except Exception as e:
+        print("=" * 50)
+        print(f"❌ CONCURRENCY TEST FAILED: {e!r}")
+        return False
+
+if __name__ == "__main__":
+    success = run_concurrency_tests()
+    exit(0 if success else 1)
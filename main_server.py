@@ -4,41 +4,223 @@ Connects Extension to Ollama LLM with proper validation and security
 """
 
 import os
+import re
 import json
+import gzip
+import shutil
 import logging
+import logging.handlers
+import contextvars
 import sqlite3
 import yaml
 import hashlib
+import base64
 import time
-from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Any
+import atexit
+import asyncio
+import importlib.util
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Any, AsyncIterator
 from pathlib import Path
-from functools import lru_cache
+from contextlib import contextmanager, asynccontextmanager
 import threading
+import queue
+from collections import OrderedDict, deque
+import uuid
+import heapq
+from email.utils import formatdate, parsedate_to_datetime
 
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel, Field
 import httpx
 import uvicorn
 
+try:
+    import numpy as np
+except ImportError:  # Optional: the semantic cache falls back to pure Python
+    np = None
+
 # Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('main_server.log'),
-        logging.StreamHandler()
-    ]
-)
+# Records are queued immediately; configure_logging() starts the QueueListener that
+# writes them (file and console) on its own thread once the agent config is read.
+LOG_TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s'
+LOG_QUEUE_SIZE = 10000
+request_id_var: contextvars.ContextVar = contextvars.ContextVar("request_id", default=None)
+log_queue: queue.Queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+log_listener: Optional[logging.handlers.QueueListener] = None
+
+class RequestContextFilter(logging.Filter):
+    """Stamp records with the current request ID while still on the logging thread"""
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id_var.get() or "-"
+        return True
+
+class LogSampler(logging.Filter):
+    """Per-category sampling and rate limits for high-frequency INFO/DEBUG records
+
+    The category is the last part of the logger name (main_server.cache ->
+    "cache"). `sample_rate` keeps that fraction of records, evenly spaced;
+    `max_per_second` caps the rest with a token bucket. Warnings and errors
+    always pass. The next record let through carries how many were dropped.
+    """
+    
+    def __init__(self, rules: Dict[str, Dict[str, Any]]):
+        super().__init__()
+        self.rules = rules
+        self.state: Dict[str, Dict[str, float]] = {}
+        self.lock = threading.Lock()
+        self.suppressed_total = 0
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        category = record.name.rsplit(".", 1)[-1]
+        rule = self.rules.get(category)
+        if not rule:
+            return True
+        with self.lock:
+            state = self.state.setdefault(category, {"credit": 1.0, "tokens": 0.0, "refilled": 0.0, "suppressed": 0})
+            keep = True
+            rate = rule.get('sample_rate')
+            if rate is not None:
+                state["credit"] += rate
+                keep = state["credit"] >= 1.0
+                if keep:
+                    state["credit"] -= 1.0
+            limit = rule.get('max_per_second')
+            if keep and limit:
+                now = time.monotonic()
+                state["tokens"] = min(float(limit), state["tokens"] + (now - state["refilled"]) * limit)
+                state["refilled"] = now
+                keep = state["tokens"] >= 1.0
+                if keep:
+                    state["tokens"] -= 1.0
+            if not keep:
+                state["suppressed"] += 1
+                self.suppressed_total += 1
+                return False
+            record.suppressed = state["suppressed"]
+            state["suppressed"] = 0
+            return True
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per line: ts, level, logger, request_id, message"""
+    
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "request_id": getattr(record, "request_id", "-"),
+            "message": record.getMessage()
+        }
+        if getattr(record, "suppressed", 0):
+            entry["suppressed"] = record.suppressed
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records instead of blocking when the writer falls behind
+
+    Installed once on the root logger, it also carries the pipeline's
+    sampler, so every import of this module reports the same counters.
+    """
+    
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self.sampler: Optional[LogSampler] = None
+    
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def _gzip_rotator(source: str, dest: str):
+    with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+def create_log_file_handler(settings: Dict[str, Any], shared: bool = False) -> logging.Handler:
+    """Size- or time-rotated log file, gzip-compressed on rotation by default
+
+    A `shared` file is appended to by several worker processes. Rotating it
+    in-process would have them rename and truncate it under each other, so
+    rotation is left to an external tool (logrotate) and the file is
+    reopened when it is moved away.
+    """
+    path = settings.get('file', 'main_server.log')
+    rotate = 'external' if shared else settings.get('rotate', 'size')
+    backup_count = settings.get('backup_count', 7)
+    if rotate == 'external':
+        handler = logging.handlers.WatchedFileHandler(path, encoding='utf-8')
+    elif rotate == 'time':
+        handler = logging.handlers.TimedRotatingFileHandler(
+            path, when=settings.get('when', 'midnight'), backupCount=backup_count, encoding='utf-8')
+    elif rotate == 'size':
+        handler = logging.handlers.RotatingFileHandler(
+            path, maxBytes=settings.get('max_bytes', 10 * 1024 * 1024), backupCount=backup_count, encoding='utf-8')
+    else:
+        handler = logging.FileHandler(path, encoding='utf-8')
+    if rotate in ('size', 'time') and settings.get('compress', True):
+        handler.namer = lambda name: name + ".gz"
+        handler.rotator = _gzip_rotator
+    if settings.get('file_format', 'json') == 'json':
+        handler.setFormatter(JsonLogFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(LOG_TEXT_FORMAT))
+    return handler
+
+def configure_logging(settings: Dict[str, Any], shared: bool = False):
+    """Start the listener thread that drains log_queue into the file and console"""
+    global log_listener
+    file_handler = create_log_file_handler(settings, shared)
+    file_handler.setLevel(settings.get('level', 'INFO'))
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter(LOG_TEXT_FORMAT))
+    console_handler.setLevel(settings.get('console_level', settings.get('level', 'INFO')))
+    log_listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler,
+                                                  respect_handler_level=True)
+    log_listener.start()
+    # At exit rather than app shutdown, so the final shutdown lines are written too
+    atexit.register(stop_logging)
+
+def stop_logging():
+    """Flush queued records and stop the listener thread"""
+    global log_listener
+    if log_listener is not None:
+        log_listener.stop()
+        log_listener = None
+
+# main_server is imported a second time when run as a script; the first import owns the
+# pipeline and later imports share its handler, queue and sampler
+log_queue_handler = next((handler for handler in logging.getLogger().handlers
+                          if isinstance(handler, logging.handlers.QueueHandler) and hasattr(handler, "sampler")), None)
+if log_queue_handler is None:
+    log_queue_handler = DroppingQueueHandler(log_queue)
+    log_queue_handler.addFilter(RequestContextFilter())
+    logging.getLogger().addHandler(log_queue_handler)
+    logging.getLogger().setLevel(logging.INFO)
+log_queue = log_queue_handler.queue
 logger = logging.getLogger(__name__)
+# High-frequency per-request lines, sampled by category (see LogSampler)
+cache_logger = logging.getLogger(f"{__name__}.cache")
+request_logger = logging.getLogger(f"{__name__}.requests")
 
 # Load agent configuration
 CONFIG_PATH = Path("Extension/agent_config/hello_zombie.yaml")
-try:
+
+def read_agent_config() -> Dict[str, Any]:
     with open(CONFIG_PATH, 'r', encoding='utf-8') as f:
-        config = yaml.safe_load(f)
+        return yaml.safe_load(f) or {}
+
+try:
+    config = read_agent_config()
     logger.info(f"Loaded agent config: {config['agent']['name']}")
 except Exception as e:
     logger.error(f"Failed to load config: {e}")
@@ -46,19 +228,43 @@ except Exception as e:
 
 # Load ZombieCoder meta memory
 META_MEMORY_PATH = Path("config/agents/zombiecoder_meta.json")
-try:
+
+def read_meta_memory() -> Dict[str, Any]:
     with open(META_MEMORY_PATH, 'r', encoding='utf-8') as f:
-        zombiecoder_meta = json.load(f)
+        return json.load(f)
+
+try:
+    zombiecoder_meta = read_meta_memory()
     logger.info(f"Loaded ZombieCoder meta memory: {zombiecoder_meta['agent_name']}")
 except Exception as e:
     logger.error(f"Failed to load meta memory: {e}")
     zombiecoder_meta = {}
 
+LOGGING_CONFIG = config.get('infrastructure', {}).get('logging', {})
+LOG_SAMPLING_RULES = LOGGING_CONFIG.get('sampling', {
+    "cache": {"sample_rate": 0.01, "max_per_second": 5},
+    "requests": {"max_per_second": 50},
+    "httpx": {"sample_rate": 0.01, "max_per_second": 5}  # one "HTTP Request" line per Ollama call
+})
+if log_queue_handler.sampler is None:
+    log_queue_handler.sampler = LogSampler(LOG_SAMPLING_RULES)
+    log_queue_handler.addFilter(log_queue_handler.sampler)
+    try:
+        # With several uvicorn workers every process appends to the same file
+        configure_logging(LOGGING_CONFIG, shared=int(config.get('infrastructure', {}).get('workers', {}).get('count', 1)) > 1)
+    except Exception as e:
+        # Never lose logs because of a bad logging section: fall back to the console alone
+        configure_logging({"rotate": "none", "file": os.devnull})
+        logger.error(f"Failed to configure logging: {e}")
+log_sampler = log_queue_handler.sampler
+
 # Pydantic models for request/response validation
 class ChatRequest(BaseModel):
     agent: str = Field(..., description="Agent identifier")
     input: str = Field(..., min_length=1, max_length=10000, description="User input")
     context: Optional[Dict[str, Any]] = Field(default=None, description="Additional context")
+    session_id: Optional[str] = Field(default=None, max_length=200, description="Session for multi-turn context reuse")
+    model: Optional[str] = Field(default=None, description="Model name or alias; routed automatically when omitted")
 
 class ChatResponse(BaseModel):
     id: str
@@ -130,19 +336,850 @@ OLLAMA_HOST = config.get('infrastructure', {}).get('ollama', {}).get('host', 'ht
 OLLAMA_MODEL = config.get('infrastructure', {}).get('ollama', {}).get('model_name', 'gemma:2b')
 MEMORY_PATH = config.get('infrastructure', {}).get('memory', {}).get('location', 'data/memory/hello_zombie_memory.sqlite')
 
+# Multi-worker mode: several uvicorn processes coordinating through a shared SQLite file
+WORKERS_CONFIG = config.get('infrastructure', {}).get('workers', {})
+WORKER_COUNT = max(1, int(WORKERS_CONFIG.get('count', 1)))
+MULTI_WORKER = WORKER_COUNT > 1
+COORDINATION_PATH = WORKERS_CONFIG.get(
+    'coordination_location', os.path.join(os.path.dirname(MEMORY_PATH), 'hello_zombie_coordination.sqlite'))
+LEADER_LEASE_SECONDS = WORKERS_CONFIG.get('leader_lease_seconds', 15)
+WORKER_HEARTBEAT_SECONDS = WORKERS_CONFIG.get('heartbeat_seconds', 2)
+SHARED_WAIT_SECONDS = WORKERS_CONFIG.get('shared_wait_seconds', 60)  # then generate locally
+SHARED_POLL_MAX_SECONDS = WORKERS_CONFIG.get('poll_max_seconds', 1.0)  # backoff cap for shared waits
+WORKER_ID = f"{os.getpid()}-{uuid.uuid4().hex[:6]}"
+
+# Shared Ollama HTTP client settings
+OLLAMA_HTTP_CONFIG = config.get('infrastructure', {}).get('ollama', {}).get('http', {})
+OLLAMA_HTTP2 = bool(OLLAMA_HTTP_CONFIG.get('http2', True))
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None  # h2 comes with httpx[http2]
+OLLAMA_TIMEOUTS = {
+    "connect": 5.0,
+    "read": 30.0,    # per read, so streamed generations only fail when Ollama stalls
+    "write": 10.0,
+    "pool": 5.0,
+    "health": 5.0,   # total for the /api/tags health probe
+    "models": 10.0,  # total for model listing
+    "embed": 10.0,   # total for a single embedding
+    "generate": 300.0  # total wall clock for a non-streaming generation
+}
+OLLAMA_TIMEOUTS.update(OLLAMA_HTTP_CONFIG.get('timeouts', {}) or {})
+ollama_client: Optional[httpx.AsyncClient] = None
+
+ollama_client_stats = {
+    "requests": 0,
+    "responses": 0,
+    "http2_responses": 0,
+    "errors": 0,
+    "clients_created": 0
+}
+
+# Ollama backends: every instance we may route generations to
+BACKENDS_CONFIG = config.get('infrastructure', {}).get('ollama', {}).get('backends', {})
+OLLAMA_BACKEND_URLS = [str(url).rstrip('/') for url in BACKENDS_CONFIG.get('urls', [])] or [OLLAMA_HOST.rstrip('/')]
+BACKEND_FAILURE_THRESHOLD = BACKENDS_CONFIG.get('failure_threshold', 3)  # consecutive failures to open the circuit
+BACKEND_OPEN_SECONDS = BACKENDS_CONFIG.get('open_seconds', 30.0)  # how long an open circuit rejects traffic
+BACKEND_RETRY_ATTEMPTS = BACKENDS_CONFIG.get('retry_attempts', 2)  # extra backends tried on connection failure
+BACKEND_REFRESH_INTERVAL = BACKENDS_CONFIG.get('model_refresh_interval_seconds', 10.0)  # also the health probe interval
+MODEL_CATALOG_TTL = config.get('infrastructure', {}).get('ollama', {}).get('model_catalog_ttl_seconds', 30.0)
+
+# Admission control in front of Ollama
+SCHEDULER_CONFIG = config.get('infrastructure', {}).get('ollama', {}).get('scheduler', {})
+PRIORITY_INTERACTIVE = 0  # /chat and /chat/stream
+PRIORITY_BACKGROUND = 1   # OpenAI-compatible traffic
+PRIORITY_BATCH = 2        # /v1/batch items yield to everything else
+# Limits are server-wide; with several workers the slots are shared through the coordination file
+MAX_CONCURRENCY_PER_MODEL = SCHEDULER_CONFIG.get('max_concurrency', 2)
+MODEL_CONCURRENCY = SCHEDULER_CONFIG.get('model_concurrency', {})  # per-model overrides
+MAX_QUEUE_PER_MODEL = SCHEDULER_CONFIG.get('max_queue', 32)
+QUEUE_TIMEOUTS = {
+    PRIORITY_INTERACTIVE: SCHEDULER_CONFIG.get('interactive_queue_timeout_seconds', 15.0),
+    PRIORITY_BACKGROUND: SCHEDULER_CONFIG.get('background_queue_timeout_seconds', 30.0),
+    PRIORITY_BATCH: SCHEDULER_CONFIG.get('batch_queue_timeout_seconds', 600.0)
+}
+
+# Bulk /v1/batch processing
+BATCH_CONFIG = config.get('infrastructure', {}).get('batch', {})
+BATCH_PARALLELISM = BATCH_CONFIG.get('parallelism', 4)  # items in flight per batch by default
+BATCH_MAX_PARALLELISM = BATCH_CONFIG.get('max_parallelism', 16)
+BATCH_MAX_ITEMS = BATCH_CONFIG.get('max_items', 50000)
+BATCH_MAX_ATTEMPTS = BATCH_CONFIG.get('max_attempts', 5)  # per item, when Ollama sheds load
+
+# Model routing: requested names/aliases -> installed Ollama models
+ROUTING_CONFIG = config.get('infrastructure', {}).get('ollama', {}).get('routing', {})
+MODEL_ALIASES = ROUTING_CONFIG.get('aliases', {})  # e.g. {"gpt-4": "deepseek-coder:6.7b"}
+SIZE_ROUTING_CONFIG = ROUTING_CONFIG.get('size_routing', {})
+SIZE_ROUTING_ENABLED = SIZE_ROUTING_CONFIG.get('enabled', False)
+SIZE_ROUTING_SMALL_MODEL = SIZE_ROUTING_CONFIG.get('small_model', OLLAMA_MODEL)
+SIZE_ROUTING_LARGE_MODEL = SIZE_ROUTING_CONFIG.get('large_model', OLLAMA_MODEL)
+SIZE_ROUTING_THRESHOLD_CHARS = SIZE_ROUTING_CONFIG.get('threshold_chars', 2000)
+OLLAMA_KEEP_ALIVE = ROUTING_CONFIG.get('keep_alive', '30m')  # keep models resident between requests
+MODEL_KEEP_ALIVE = ROUTING_CONFIG.get('model_keep_alive', {})  # per-model overrides
+MODEL_LATENCY_WINDOW = 500  # recent generations kept per model for percentiles
+model_stats: Dict[str, Dict[str, Any]] = {}
+
 # Performance optimization variables
-response_cache = {}
-cache_lock = threading.Lock()
-CACHE_TTL = 3600  # 1 hour cache TTL
-MAX_CACHE_SIZE = 1000  # Maximum cached responses
+CACHE_CONFIG = config.get('infrastructure', {}).get('cache', {})
+CACHE_TTL = CACHE_CONFIG.get('ttl_seconds', 3600)  # 1 hour cache TTL
+MAX_CACHE_BYTES = CACHE_CONFIG.get('max_bytes', 64 * 1024 * 1024)  # Memory budget for cached responses
+MAX_CACHE_ENTRY_BYTES = CACHE_CONFIG.get('max_entry_bytes', 1024 * 1024)
+# Only what the endpoints actually serve, plus token counts for usage reporting
+CACHED_RESPONSE_FIELDS = ("response", "model", "prompt_eval_count", "eval_count")
+CACHE_CASEFOLD = CACHE_CONFIG.get('casefold', False)  # Also ignore casing when matching prompts
+SEMANTIC_CACHE_CONFIG = CACHE_CONFIG.get('semantic', {})
+SEMANTIC_CACHE_ENABLED = SEMANTIC_CACHE_CONFIG.get('enabled', False)
+SEMANTIC_EMBEDDING_MODEL = SEMANTIC_CACHE_CONFIG.get('embedding_model', 'nomic-embed-text')
+SEMANTIC_SIMILARITY_THRESHOLD = SEMANTIC_CACHE_CONFIG.get('similarity_threshold', 0.95)
+SEMANTIC_CACHE_MAX_ENTRIES = SEMANTIC_CACHE_CONFIG.get('max_entries', 5000)
+PERSISTENT_CACHE_CONFIG = CACHE_CONFIG.get('persistent', {})
+PERSISTENT_CACHE_ENABLED = PERSISTENT_CACHE_CONFIG.get('enabled', True)
+PERSISTENT_CACHE_PATH = PERSISTENT_CACHE_CONFIG.get(
+    'location', os.path.join(os.path.dirname(MEMORY_PATH), 'hello_zombie_cache.sqlite'))
+PERSISTENT_CACHE_TTL = PERSISTENT_CACHE_CONFIG.get('ttl_seconds', 7 * 24 * 3600)
+PERSISTENT_CACHE_MAX_ENTRIES = PERSISTENT_CACHE_CONFIG.get('max_entries', 50000)
+PERSISTENT_CACHE_WARM_ENTRIES = PERSISTENT_CACHE_CONFIG.get('warm_entries', 500)
+PERSISTENT_CACHE_COMPACT_INTERVAL = PERSISTENT_CACHE_CONFIG.get('compact_interval_seconds', 600)
+
+# Request coalescing (single-flight) for identical in-flight prompts
+inflight_generations: Dict[str, asyncio.Task] = {}
+inflight_streams: Dict[str, "InflightStream"] = {}
+coalescing_stats = {
+    "leaders": 0,    # requests that started an Ollama generation
+    "followers": 0   # requests that joined one already in flight
+}
+
+# Write-behind conversation persistence
+MEMORY_CONFIG = config.get('infrastructure', {}).get('memory', {})
+WRITE_BATCH_SIZE = MEMORY_CONFIG.get('write_batch_size', 100)
+WRITE_FLUSH_INTERVAL = MEMORY_CONFIG.get('write_flush_interval_seconds', 0.5)
+WRITE_QUEUE_SIZE = MEMORY_CONFIG.get('write_queue_size', 10000)
+
+# Retention: expired conversations are deleted (and optionally archived) in small batches
+RETENTION_CONFIG = MEMORY_CONFIG.get('retention', {})
+RETENTION_ENABLED = RETENTION_CONFIG.get('enabled', True)
+RETENTION_DAYS = RETENTION_CONFIG.get('days', 30)
+RETENTION_INTERVAL = RETENTION_CONFIG.get('interval_seconds', 3600)
+RETENTION_BATCH_SIZE = RETENTION_CONFIG.get('batch_size', 500)  # rows per delete transaction
+RETENTION_PAUSE = RETENTION_CONFIG.get('pause_seconds', 0.05)  # yield to the writer between batches
+RETENTION_VACUUM_PAGES = RETENTION_CONFIG.get('vacuum_pages', 1000)  # pages freed per incremental_vacuum step
+RETENTION_ARCHIVE_CONFIG = RETENTION_CONFIG.get('archive', {})
+RETENTION_ARCHIVE_ENABLED = RETENTION_ARCHIVE_CONFIG.get('enabled', False)
+RETENTION_ARCHIVE_PATH = RETENTION_ARCHIVE_CONFIG.get(
+    'location', os.path.join(os.path.dirname(MEMORY_PATH), 'archive'))
+
+# Retrieval of relevant past exchanges into new prompts (needs NumPy)
+MEMORY_RETRIEVAL_CONFIG = MEMORY_CONFIG.get('retrieval', {})
+MEMORY_RETRIEVAL_ENABLED = MEMORY_RETRIEVAL_CONFIG.get('enabled', False)
+MEMORY_EMBEDDING_MODEL = MEMORY_RETRIEVAL_CONFIG.get('embedding_model', SEMANTIC_EMBEDDING_MODEL)
+MEMORY_TOP_K = MEMORY_RETRIEVAL_CONFIG.get('top_k', 3)
+MEMORY_MIN_SIMILARITY = MEMORY_RETRIEVAL_CONFIG.get('min_similarity', 0.75)
+MEMORY_TOKEN_BUDGET = MEMORY_RETRIEVAL_CONFIG.get('token_budget', 512)  # prompt tokens spent on memories
+MEMORY_INDEX_PATH = MEMORY_RETRIEVAL_CONFIG.get('index_location', os.path.splitext(MEMORY_PATH)[0] + '_vectors')
+MEMORY_BACKFILL_LIMIT = MEMORY_RETRIEVAL_CONFIG.get('backfill_limit', 10000)  # newest unindexed rows embedded at startup
+MEMORY_INDEX_QUEUE_SIZE = MEMORY_RETRIEVAL_CONFIG.get('queue_size', 10000)
+MEMORY_INDEX_MAX_ATTEMPTS = MEMORY_RETRIEVAL_CONFIG.get('index_max_attempts', 3)  # embedding tries per conversation
+
+# Token usage accounting
+USAGE_CONFIG = config.get('infrastructure', {}).get('usage', {})
+TOKENIZER_CACHE_SIZE = USAGE_CONFIG.get('tokenizer_cache_size', 4096)
+
+# Multi-turn sessions: Ollama's evaluated context array from each session's last turn
+SESSION_CONFIG = config.get('infrastructure', {}).get('sessions', {})
+SESSION_TTL = SESSION_CONFIG.get('ttl_seconds', 1800)
+MAX_SESSIONS = SESSION_CONFIG.get('max_sessions', 500)
+session_contexts: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+session_lock = threading.Lock()
+
+# Hot reload of the agent: the `agent` section of hello_zombie.yaml and zombiecoder_meta.json
+# (the system prompt). Everything under `infrastructure` is read once and needs a restart.
+HOT_RELOAD_CONFIG = config.get('infrastructure', {}).get('hot_reload', {})
+HOT_RELOAD_ENABLED = HOT_RELOAD_CONFIG.get('enabled', True)
+HOT_RELOAD_INTERVAL = HOT_RELOAD_CONFIG.get('interval_seconds', 2.0)
+agent_version = 0
+agent_reload_lock = threading.Lock()
+restart_required = False  # the infrastructure section on disk differs from the one in use
+
+# Long-running tasks started at startup and cancelled at shutdown
+background_tasks: List[asyncio.Task] = []
 
 # Connection pooling
-db_connections = {}
-db_lock = threading.Lock()
-MAX_DB_CONNECTIONS = 10
+MAX_DB_CONNECTIONS = MEMORY_CONFIG.get('max_read_connections', 10)
+DB_POOL_TIMEOUT = MEMORY_CONFIG.get('pool_timeout_seconds', 5.0)
+DB_PRAGMAS = {
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,
+    "temp_store": "MEMORY",
+    "mmap_size": MEMORY_CONFIG.get('mmap_size', 256 * 1024 * 1024),
+    "cache_size": -MEMORY_CONFIG.get('cache_size_kb', 16 * 1024)  # negative = KiB
+}
+
+# Metrics in Prometheus text exposition format
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+TOKEN_RATE_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 250, 500)
+
+def _escape_label(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(names: tuple, values: tuple, extra: Optional[tuple] = None) -> str:
+    pairs = [(name, value) for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape_label(value)}"' for name, value in pairs) + "}"
+
+class Counter:
+    """Monotonic counter keyed by label values"""
+    
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values: Dict[tuple, float] = {}
+        self.lock = threading.Lock()
+    
+    def inc(self, amount: float = 1.0, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+    
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labels, key)} {value}")
+        return lines
+
+class Histogram:
+    """Cumulative-bucket histogram keyed by label values; safe to observe from any thread"""
+    
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        self.series: Dict[tuple, list] = {}  # label values -> [bucket counts, sum, count]
+        self.lock = threading.Lock()
+    
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+    
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, (counts, total, count) in sorted(self.series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, ('le', bound))} {cumulative}")
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, ('le', '+Inf'))} {count}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {total}")
+                lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {count}")
+        return lines
+
+class MetricsRegistry:
+    """Owns the metrics and renders them, plus gauges sampled at scrape time"""
+    
+    def __init__(self):
+        self.metrics: List[Any] = []
+        self.sampled: List[tuple] = []  # (name, documentation, labels, callback returning {label tuple: value}, type)
+    
+    def counter(self, name: str, documentation: str, labels: tuple = ()) -> Counter:
+        metric = Counter(name, documentation, labels)
+        self.metrics.append(metric)
+        return metric
+    
+    def histogram(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        metric = Histogram(name, documentation, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+    
+    def sample(self, name: str, documentation: str, labels: tuple, callback, kind: str = "gauge"):
+        """Register values read from existing stats at scrape time"""
+        self.sampled.append((name, documentation, labels, callback, kind))
+    
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        for name, documentation, labels, callback, kind in self.sampled:
+            lines.extend([f"# HELP {name} {documentation}", f"# TYPE {name} {kind}"])
+            try:
+                for key, value in sorted(callback().items()):
+                    lines.append(f"{name}{_format_labels(labels, key)} {value}")
+            except Exception as e:
+                logger.warning(f"Metric {name} unavailable: {e}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+http_request_seconds = metrics.histogram(
+    "hello_zombie_http_request_duration_seconds", "End-to-end request latency, including streamed bodies",
+    ("method", "route", "status"))
+queue_wait_seconds = metrics.histogram(
+    "hello_zombie_scheduler_queue_wait_seconds", "Time spent waiting for an Ollama slot", ("model", "priority"))
+ollama_generation_seconds = metrics.histogram(
+    "hello_zombie_ollama_generation_seconds", "Ollama generation wall time after admission", ("model",))
+ollama_first_token_seconds = metrics.histogram(
+    "hello_zombie_ollama_time_to_first_token_seconds", "Time from request to the first streamed token", ("model",))
+ollama_prompt_eval_seconds = metrics.histogram(
+    "hello_zombie_ollama_prompt_eval_seconds", "Ollama prompt_eval_duration", ("model",))
+ollama_eval_seconds = metrics.histogram(
+    "hello_zombie_ollama_eval_seconds", "Ollama eval_duration", ("model",))
+ollama_tokens_per_second = metrics.histogram(
+    "hello_zombie_ollama_tokens_per_second", "Generated tokens per second (eval_count / eval_duration)",
+    ("model",), TOKEN_RATE_BUCKETS)
+ollama_tokens_total = metrics.counter(
+    "hello_zombie_ollama_tokens_total", "Tokens processed by Ollama", ("model", "kind"))
+ollama_errors_total = metrics.counter(
+    "hello_zombie_ollama_errors_total", "Failed Ollama generations", ("model",))
+db_write_seconds = metrics.histogram(
+    "hello_zombie_db_write_seconds", "SQLite write transaction latency", ("table",), DB_BUCKETS)
+
+PRIORITY_NAMES = {0: "interactive", 1: "background", 2: "batch"}
+
+def observe_ollama_timings(model: str, chunk: Dict[str, Any]):
+    """Record the timing fields Ollama reports on a finished generation (durations are in ns)"""
+    prompt_eval_ns = chunk.get("prompt_eval_duration")
+    eval_ns = chunk.get("eval_duration")
+    eval_count = chunk.get("eval_count")
+    if prompt_eval_ns:
+        ollama_prompt_eval_seconds.observe(prompt_eval_ns / 1e9, model=model)
+    if eval_ns:
+        ollama_eval_seconds.observe(eval_ns / 1e9, model=model)
+        if eval_count:
+            ollama_tokens_per_second.observe(eval_count / (eval_ns / 1e9), model=model)
+    if chunk.get("prompt_eval_count"):
+        ollama_tokens_total.inc(chunk["prompt_eval_count"], model=model, kind="prompt")
+    if eval_count:
+        ollama_tokens_total.inc(eval_count, model=model, kind="completion")
+
+class MetricsMiddleware:
+    """ASGI middleware timing each request until its last body chunk is sent"""
+    
+    def __init__(self, app):
+        self.app = app
+        self.route_paths: Dict[Any, str] = {}
+    
+    def _route(self, scope) -> str:
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "unmatched"
+        if not self.route_paths:
+            self.route_paths = {getattr(route, "endpoint", None): route.path for route in app.routes}
+        return self.route_paths.get(endpoint, scope.get("path", ""))
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        start = time.perf_counter()
+        status = {"code": 500}
+        
+        async def timed_send(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                http_request_seconds.observe(time.perf_counter() - start, method=scope["method"],
+                                             route=self._route(scope), status=status["code"])
+        
+        await self.app(scope, receive, timed_send)
+
+app.add_middleware(MetricsMiddleware)
+
+REQUEST_ID_PATTERN = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+
+class RequestIdMiddleware:
+    """ASGI middleware giving every request an ID for its log records
+
+    A well-formed incoming X-Request-ID is kept so IDs can span services;
+    otherwise one is generated. It is echoed in the X-Request-ID response
+    header, and tasks spawned by the request (batch jobs) inherit it.
+    """
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        incoming = dict(scope.get("headers", [])).get(b"x-request-id", b"").decode("latin-1")
+        request_id = incoming if REQUEST_ID_PATTERN.match(incoming) else uuid.uuid4().hex[:16]
+        token = request_id_var.set(request_id)
+        
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [(b"x-request-id", request_id.encode())]
+            await send(message)
+        
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            request_id_var.reset(token)
+
+# Added last so it is outermost: every log line of the request carries the ID
+app.add_middleware(RequestIdMiddleware)
+
+# Shared Ollama HTTP client
+def ollama_timeout(operation: str) -> httpx.Timeout:
+    """Build the httpx timeout for an Ollama operation"""
+    if operation in ("health", "models", "embed"):
+        return httpx.Timeout(OLLAMA_TIMEOUTS[operation], connect=OLLAMA_TIMEOUTS["connect"])
+    return httpx.Timeout(
+        connect=OLLAMA_TIMEOUTS["connect"],
+        read=OLLAMA_TIMEOUTS["read"],
+        write=OLLAMA_TIMEOUTS["write"],
+        pool=OLLAMA_TIMEOUTS["pool"]
+    )
+
+async def _count_ollama_request(request: httpx.Request):
+    ollama_client_stats["requests"] += 1
+
+async def _count_ollama_response(response: httpx.Response):
+    ollama_client_stats["responses"] += 1
+    if response.http_version == "HTTP/2":
+        ollama_client_stats["http2_responses"] += 1
+    if response.status_code >= 400:
+        ollama_client_stats["errors"] += 1
+
+def create_ollama_client() -> httpx.AsyncClient:
+    """Create the pooled keep-alive client used for all Ollama traffic"""
+    limits = httpx.Limits(
+        max_connections=OLLAMA_HTTP_CONFIG.get('max_connections', 20),
+        max_keepalive_connections=OLLAMA_HTTP_CONFIG.get('max_keepalive_connections', 10),
+        keepalive_expiry=OLLAMA_HTTP_CONFIG.get('keepalive_expiry', 30.0)
+    )
+    # HTTP/2 needs the optional h2 package; fall back to HTTP/1.1 keep-alive without it
+    http2 = OLLAMA_HTTP2 and HTTP2_AVAILABLE
+    ollama_client_stats["clients_created"] += 1
+    # No base_url: requests carry the absolute URL of the backend chosen for them
+    return httpx.AsyncClient(
+        limits=limits,
+        timeout=ollama_timeout("generate"),
+        http2=http2,
+        headers={"Content-Type": "application/json"},
+        event_hooks={"request": [_count_ollama_request], "response": [_count_ollama_response]}
+    )
+
+def get_ollama_client() -> httpx.AsyncClient:
+    """Return the application-lifetime Ollama client, creating it on first use"""
+    global ollama_client
+    if ollama_client is None or ollama_client.is_closed:
+        ollama_client = create_ollama_client()
+    return ollama_client
+
+async def close_ollama_client():
+    """Close the shared Ollama client and release pooled connections"""
+    global ollama_client
+    if ollama_client is not None:
+        await ollama_client.aclose()
+        ollama_client = None
+
+def get_ollama_pool_stats() -> Dict[str, Any]:
+    """Summarize the shared client: its configured limits and our own request counters
+
+    Only public httpx API is used; the connection pool's internals change
+    between httpcore releases, so open connections are not reported.
+    """
+    stats = dict(ollama_client_stats)
+    stats["http2"] = OLLAMA_HTTP2 and HTTP2_AVAILABLE
+    stats["open"] = ollama_client is not None and not ollama_client.is_closed
+    stats["in_flight"] = sum(backend.outstanding for backend in ollama_backends.backends)
+    stats["limits"] = {
+        "max_connections": OLLAMA_HTTP_CONFIG.get('max_connections', 20),
+        "max_keepalive_connections": OLLAMA_HTTP_CONFIG.get('max_keepalive_connections', 10),
+        "keepalive_expiry": OLLAMA_HTTP_CONFIG.get('keepalive_expiry', 30.0)
+    }
+    stats["timeouts"] = dict(OLLAMA_TIMEOUTS)
+    return stats
+
+# Ollama backend pool
+CONNECT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout, httpx.RemoteProtocolError)
+
+class OllamaBackend:
+    """One Ollama instance with its load, circuit state and known models"""
+    
+    def __init__(self, url: str):
+        self.url = url
+        self.outstanding = 0
+        self.consecutive_failures = 0
+        self.opened_at: Optional[float] = None
+        self.half_open_trial = False
+        self.installed_models: set = set()
+        self.loaded_models: set = set()
+        self.model_details: List[Dict[str, Any]] = []  # last /api/tags listing
+        self.requests = 0
+        self.failures = 0
+        self.last_refresh: Optional[float] = None
+    
+    def available(self, now: float) -> bool:
+        """Closed circuit, or open long enough to let a single trial request through"""
+        if self.opened_at is None:
+            return True
+        return now - self.opened_at >= BACKEND_OPEN_SECONDS and not self.half_open_trial
+    
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if time.time() - self.opened_at >= BACKEND_OPEN_SECONDS else "open"
+
+class OllamaBackendPool:
+    """Routes Ollama requests across backends
+
+    Picks the backend with the fewest outstanding requests, preferring ones
+    that already have the model loaded (/api/ps), then ones that have it
+    installed (/api/tags). Connection failures count against a backend and
+    are retried on another one; after repeated failures its circuit opens
+    and it only gets a single trial request once the cool-down has passed.
+    """
+    
+    def __init__(self, urls: List[str]):
+        self.backends = [OllamaBackend(url) for url in urls]
+        self.retries = 0
+        self.rotation = 0
+    
+    def choose(self, model: Optional[str] = None, exclude: Optional[set] = None) -> OllamaBackend:
+        now = time.time()
+        candidates = [backend for backend in self.backends
+                      if backend.available(now) and backend not in (exclude or set())]
+        if not candidates:
+            raise httpx.ConnectError("No healthy Ollama backend available")
+        
+        if model:
+            for affinity in ("loaded_models", "installed_models"):
+                preferred = [backend for backend in candidates if model in getattr(backend, affinity)]
+                if preferred:
+                    candidates = preferred
+                    break
+        
+        # Least outstanding requests; rotate the starting point so ties spread out
+        self.rotation += 1
+        offset = self.rotation % len(candidates)
+        rotated = candidates[offset:] + candidates[:offset]
+        return min(rotated, key=lambda backend: backend.outstanding)
+    
+    def can_retry(self, tried: set) -> bool:
+        """Another untried, available backend exists and the retry budget allows it"""
+        if len(tried) > BACKEND_RETRY_ATTEMPTS:
+            return False
+        now = time.time()
+        return any(backend.available(now) for backend in self.backends if backend not in tried)
+    
+    def _acquire(self, backend: OllamaBackend):
+        backend.outstanding += 1
+        backend.requests += 1
+        if backend.opened_at is not None:
+            backend.half_open_trial = True
+    
+    def _release(self, backend: OllamaBackend):
+        backend.outstanding -= 1
+    
+    def record_success(self, backend: OllamaBackend, model: Optional[str] = None):
+        if backend.opened_at is not None:
+            logger.info(f"Ollama backend {backend.url} recovered, closing circuit")
+        backend.consecutive_failures = 0
+        backend.opened_at = None
+        backend.half_open_trial = False
+        if model:
+            # Ollama keeps a model resident after serving it
+            backend.installed_models.add(model)
+            backend.loaded_models.add(model)
+    
+    def record_failure(self, backend: OllamaBackend):
+        backend.failures += 1
+        backend.consecutive_failures += 1
+        backend.half_open_trial = False
+        if backend.opened_at is not None or backend.consecutive_failures >= BACKEND_FAILURE_THRESHOLD:
+            if backend.opened_at is None:
+                logger.warning(f"Ollama backend {backend.url} failing, opening circuit for {BACKEND_OPEN_SECONDS}s")
+            backend.opened_at = time.time()
+    
+    async def request(self, method: str, path: str, model: Optional[str] = None, **kwargs) -> httpx.Response:
+        """Send a request to the best backend, retrying elsewhere if it cannot be reached"""
+        tried = set()
+        while True:
+            backend = self.choose(model, tried)
+            tried.add(backend)
+            self._acquire(backend)
+            try:
+                response = await get_ollama_client().request(method, backend.url + path, **kwargs)
+            except CONNECT_ERRORS as e:
+                self.record_failure(backend)
+                if not self.can_retry(tried):
+                    raise
+                self.retries += 1
+                logger.warning(f"Ollama backend {backend.url} unreachable ({e!r}), retrying on another backend")
+                continue
+            finally:
+                self._release(backend)
+            
+            if response.status_code >= 500:
+                self.record_failure(backend)
+            else:
+                self.record_success(backend, model if response.status_code == 200 else None)
+            return response
+    
+    @asynccontextmanager
+    async def stream(self, method: str, path: str, model: Optional[str] = None, **kwargs):
+        """Open a streamed response on the best backend
+
+        Retries only happen while connecting; once the response has started,
+        the backend is held until the caller leaves the block.
+        """
+        tried = set()
+        while True:
+            backend = self.choose(model, tried)
+            tried.add(backend)
+            self._acquire(backend)
+            started = False
+            try:
+                async with get_ollama_client().stream(method, backend.url + path, **kwargs) as response:
+                    if response.status_code >= 500:
+                        self.record_failure(backend)
+                    else:
+                        self.record_success(backend, model if response.status_code == 200 else None)
+                    started = True
+                    yield response
+                return
+            except CONNECT_ERRORS as e:
+                self.record_failure(backend)
+                if started or not self.can_retry(tried):
+                    raise
+                self.retries += 1
+                logger.warning(f"Ollama backend {backend.url} unreachable ({e!r}), retrying on another backend")
+            finally:
+                self._release(backend)
+    
+    async def refresh_backend(self, backend: OllamaBackend) -> bool:
+        """Discover installed (/api/tags) and loaded (/api/ps) models on one backend"""
+        client = get_ollama_client()
+        try:
+            tags = await client.get(backend.url + "/api/tags", timeout=ollama_timeout("health"))
+            if tags.status_code != 200:
+                self.record_failure(backend)
+                return False
+            backend.model_details = tags.json().get("models", [])
+            backend.installed_models = {model["name"] for model in backend.model_details}
+            ps = await client.get(backend.url + "/api/ps", timeout=ollama_timeout("health"))
+            if ps.status_code == 200:
+                backend.loaded_models = {model["name"] for model in ps.json().get("models", [])}
+            backend.last_refresh = time.time()
+            self.record_success(backend)
+            return True
+        except Exception as e:
+            logger.warning(f"Ollama backend {backend.url} refresh failed: {e}")
+            self.record_failure(backend)
+            return False
+    
+    async def refresh(self) -> bool:
+        """Refresh every backend; True when at least one answered"""
+        results = await asyncio.gather(*(self.refresh_backend(backend) for backend in self.backends))
+        return any(results)
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "retries": self.retries,
+            "backends": [{
+                "url": backend.url,
+                "circuit": backend.state(),
+                "outstanding": backend.outstanding,
+                "requests": backend.requests,
+                "failures": backend.failures,
+                "consecutive_failures": backend.consecutive_failures,
+                "installed_models": sorted(backend.installed_models),
+                "loaded_models": sorted(backend.loaded_models),
+                "last_refresh": backend.last_refresh
+            } for backend in self.backends]
+        }
+
+ollama_backends = OllamaBackendPool(OLLAMA_BACKEND_URLS)
+
+class ModelCatalog:
+    """Merged /api/tags listing shared by /models, /v1/models and /health
+
+    One background probe refreshes it; readers get the cached copy and, if
+    it is older than the TTL, trigger a single revalidation without waiting
+    for it (stale-while-revalidate). The ETag changes only when the model
+    list does, and Last-Modified is when that happened.
+    """
+    
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.models: List[Dict[str, Any]] = []
+        self.fetched_at: Optional[float] = None
+        self.etag: Optional[str] = None
+        self.last_modified: Optional[float] = None
+        self.healthy = False
+        self.checked_at: Optional[float] = None
+        self.refreshing: Optional[asyncio.Task] = None
+        self.refreshes = 0
+        self.stale_reads = 0
+    
+    async def _refresh(self) -> bool:
+        self.refreshes += 1
+        healthy = await ollama_backends.refresh()
+        self.healthy = healthy
+        self.checked_at = time.time()
+        if not healthy:
+            return False
+        
+        merged: Dict[str, Dict[str, Any]] = {}
+        for backend in ollama_backends.backends:
+            for model in backend.model_details:
+                merged.setdefault(model["name"], model)
+        models = [merged[name] for name in sorted(merged)]
+        etag = hashlib.md5(json.dumps(models, sort_keys=True).encode()).hexdigest()
+        if etag != self.etag:
+            self.etag = etag
+            self.last_modified = time.time()
+        self.models = models
+        self.fetched_at = time.time()
+        return True
+    
+    async def refresh(self) -> bool:
+        """Refresh now, joining a refresh that is already running"""
+        if self.refreshing is None or self.refreshing.done():
+            self.refreshing = asyncio.create_task(self._refresh())
+        return await asyncio.shield(self.refreshing)
+    
+    async def get(self) -> Optional[List[Dict[str, Any]]]:
+        """Cached models; None when Ollama has never answered"""
+        if self.fetched_at is None:
+            await self.refresh()
+            return self.models if self.fetched_at is not None else None
+        if time.time() - self.fetched_at > self.ttl:
+            self.stale_reads += 1
+            if self.refreshing is None or self.refreshing.done():
+                self.refreshing = asyncio.create_task(self._refresh())
+        return self.models
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "models": len(self.models),
+            "ttl_seconds": self.ttl,
+            "age_seconds": round(time.time() - self.fetched_at, 1) if self.fetched_at else None,
+            "etag": self.etag,
+            "healthy": self.healthy,
+            "refreshes": self.refreshes,
+            "stale_reads": self.stale_reads
+        }
+
+model_catalog = ModelCatalog(MODEL_CATALOG_TTL)
+
+async def backend_refresh_loop():
+    """Background probe: re-discover models, refresh the catalog and Ollama health"""
+    while True:
+        await asyncio.sleep(BACKEND_REFRESH_INTERVAL)
+        try:
+            await model_catalog.refresh()
+        except Exception as e:
+            logger.error(f"Ollama backend refresh failed: {e}")
+
+# Model routing
+def installed_models() -> set:
+    """Models installed on any backend, from the periodically refreshed /api/tags listings"""
+    models = set()
+    for backend in ollama_backends.backends:
+        models |= backend.installed_models
+    return models
+
+def _match_installed(name: str, installed: set) -> Optional[str]:
+    if name in installed:
+        return name
+    if ":" not in name and f"{name}:latest" in installed:
+        return f"{name}:latest"
+    return None
+
+def route_by_size(prompt: str) -> str:
+    """Short prompts go to the small model; long prompts and code go to the large one"""
+    if len(prompt) >= SIZE_ROUTING_THRESHOLD_CHARS or "```" in prompt:
+        return SIZE_ROUTING_LARGE_MODEL
+    return SIZE_ROUTING_SMALL_MODEL
+
+def resolve_model(requested: Optional[str], prompt: str = "") -> str:
+    """Map a requested model name or alias to the Ollama model that will serve it
+
+    Aliases win, then installed models (with an implied :latest tag). Names
+    Ollama does not have (e.g. "gpt-4" from an OpenAI client) fall back to
+    size-based routing when enabled, otherwise to the default model.
+    """
+    installed = installed_models()
+    if requested:
+        target = MODEL_ALIASES.get(requested, requested)
+        if not installed:
+            # Catalog not discovered yet: trust aliases and explicit Ollama names
+            if requested in MODEL_ALIASES or target == OLLAMA_MODEL:
+                return target
+        else:
+            matched = _match_installed(target, installed)
+            if matched:
+                return matched
+    if SIZE_ROUTING_ENABLED:
+        return route_by_size(prompt)
+    return OLLAMA_MODEL
+
+def keep_alive_for(model: str) -> Any:
+    return MODEL_KEEP_ALIVE.get(model, OLLAMA_KEEP_ALIVE)
+
+def record_model_latency(model: str, seconds: Optional[float], first_token: Optional[float] = None):
+    """Track per-model generation latency; `seconds` is None for a failed generation"""
+    stats = model_stats.get(model)
+    if stats is None:
+        stats = model_stats[model] = {
+            "requests": 0,
+            "errors": 0,
+            "latencies": deque(maxlen=MODEL_LATENCY_WINDOW),
+            "first_token": deque(maxlen=MODEL_LATENCY_WINDOW)
+        }
+    stats["requests"] += 1
+    if seconds is None:
+        stats["errors"] += 1
+        ollama_errors_total.inc(model=model)
+        return
+    stats["latencies"].append(seconds)
+    ollama_generation_seconds.observe(seconds, model=model)
+    if first_token is not None:
+        stats["first_token"].append(first_token)
+        ollama_first_token_seconds.observe(first_token, model=model)
+
+def _percentile_ms(values: List[float], fraction: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000, 1)
+
+def get_model_stats() -> Dict[str, Any]:
+    """Per-model request counts and latency percentiles over the recent window"""
+    summary = {}
+    for model, stats in model_stats.items():
+        latencies = list(stats["latencies"])
+        first_token = list(stats["first_token"])
+        summary[model] = {
+            "requests": stats["requests"],
+            "errors": stats["errors"],
+            "keep_alive": keep_alive_for(model),
+            "p50_ms": _percentile_ms(latencies, 0.5),
+            "p95_ms": _percentile_ms(latencies, 0.95),
+            "first_token_p50_ms": _percentile_ms(first_token, 0.5)
+        }
+    return summary
 
 # System prompt generation with meta memory
-def generate_system_prompt() -> str:
+def build_system_prompt(zombiecoder_meta: Dict[str, Any]) -> str:
     """Generate optimized system prompt with ZombieCoder meta memory injection"""
     if not zombiecoder_meta:
         return "You are Hello Zombie, a local AI assistant."
@@ -169,215 +1206,2877 @@ Core Rules:
 Skills: {', '.join(zombiecoder_meta.get('core_rules', {}).get('skills', [])[:10])}"""
     return system_prompt.strip()
 
+def compile_system_prompt(meta: Dict[str, Any]) -> tuple:
+    """Build the system prompt once and fingerprint it for cache keys"""
+    prompt = build_system_prompt(meta)
+    return prompt, hashlib.md5(prompt.encode('utf-8')).hexdigest()[:12]
+
+# Compiled (prompt, fingerprint), swapped as one tuple on reload
+compiled_system_prompt = compile_system_prompt(zombiecoder_meta)
+
+def generate_system_prompt() -> str:
+    """Return the system prompt compiled for the current meta memory"""
+    return compiled_system_prompt[0]
+
+def system_prompt_fingerprint() -> str:
+    return compiled_system_prompt[1]
+
+def _read_or_default(reader, path: Path) -> Dict[str, Any]:
+    # A missing file means "no config", as at startup; parse errors propagate
+    if not path.exists():
+        return {}
+    return reader()
+
+def reload_agent_files() -> Optional[bool]:
+    """Re-read the agent section and meta memory and swap them in atomically
+
+    Only the `agent` section of hello_zombie.yaml and the system prompt
+    compiled from zombiecoder_meta.json are replaced; settings under
+    `infrastructure` were turned into module constants at import and keep
+    their startup values, so a change there is reported as needing a
+    restart. Nothing changes unless both files parse. Returns None on
+    failure, otherwise whether the system prompt changed. Runs in a worker
+    thread; reload_agents() drops the state built on the old prompt.
+    """
+    global config, zombiecoder_meta, compiled_system_prompt, agent_version, restart_required
+    try:
+        new_config = _read_or_default(read_agent_config, CONFIG_PATH)
+        new_meta = _read_or_default(read_meta_memory, META_MEMORY_PATH)
+        new_prompt = compile_system_prompt(new_meta)
+    except Exception as e:
+        logger.error(f"Agent reload failed, keeping the current agent and prompt: {e}")
+        return None
+    
+    with agent_reload_lock:
+        prompt_changed = new_prompt[1] != compiled_system_prompt[1]
+        config = {**config, 'agent': new_config.get('agent', {})}
+        zombiecoder_meta = new_meta
+        compiled_system_prompt = new_prompt
+        agent_version += 1
+        restart_required = new_config.get('infrastructure', {}) != config.get('infrastructure', {})
+    
+    logger.info(f"Agent reloaded (version {agent_version}, prompt {'changed' if prompt_changed else 'unchanged'})")
+    if restart_required:
+        logger.warning("Infrastructure settings in hello_zombie.yaml changed; they take effect after a restart")
+    return prompt_changed
+
+async def reload_agents() -> bool:
+    """Reload the agent files off the event loop; True unless they failed to parse
+
+    The caches and sessions built on an old system prompt are cleared back
+    on the loop, which is the only place request handlers change them.
+    """
+    prompt_changed = await asyncio.to_thread(reload_agent_files)
+    if prompt_changed is None:
+        return False
+    if prompt_changed:
+        await invalidate_prompt_dependent_state()
+    return True
+
+def _file_signature(path: Path) -> Optional[tuple]:
+    try:
+        stat = path.stat()
+        return stat.st_mtime_ns, stat.st_size
+    except OSError:
+        return None
+
+async def agent_watch_loop():
+    """Poll hello_zombie.yaml and zombiecoder_meta.json and reload the agent on change"""
+    signatures = (_file_signature(CONFIG_PATH), _file_signature(META_MEMORY_PATH))
+    while True:
+        await asyncio.sleep(HOT_RELOAD_INTERVAL)
+        current = (_file_signature(CONFIG_PATH), _file_signature(META_MEMORY_PATH))
+        if current != signatures:
+            signatures = current
+            logger.info("Agent file change detected, reloading")
+            await reload_agents()
+
 # Caching functions
-def get_cache_key(prompt: str, model: str) -> str:
-    """Generate cache key for prompt and model"""
-    return hashlib.md5(f"{prompt}_{model}".encode()).hexdigest()
-
-def get_cached_response(cache_key: str) -> Optional[Dict]:
-    """Get cached response if available and not expired"""
-    with cache_lock:
-        if cache_key in response_cache:
-            cached_data = response_cache[cache_key]
-            if time.time() - cached_data['timestamp'] < CACHE_TTL:
-                logger.info(f"Cache hit for key: {cache_key[:8]}...")
-                return cached_data['response']
-            else:
-                # Remove expired cache
-                del response_cache[cache_key]
-                logger.info(f"Cache expired for key: {cache_key[:8]}...")
+def normalize_prompt(prompt: str) -> str:
+    """Fold whitespace (and optionally case) so trivially different prompts match"""
+    normalized = " ".join(prompt.split())
+    return normalized.casefold() if CACHE_CASEFOLD else normalized
+
+def get_cache_key(prompt: str, model: str, options: Optional[Dict[str, Any]] = None) -> str:
+    """Generate cache key for the normalized prompt, model, generation options and system prompt version"""
+    key = f"{normalize_prompt(prompt)}_{model}_{system_prompt_fingerprint()}"
+    if options:
+        # Answers differ with temperature or length limits, so they never share an entry
+        key += "_" + json.dumps(options, sort_keys=True)
+    return hashlib.md5(key.encode()).hexdigest()
+
+def normalize_generation_options(options: Dict[str, Any]) -> Dict[str, Any]:
+    """Drop unset Ollama options and give numbers one spelling (0.70 and 0.7 are the same request)"""
+    normalized = {}
+    for name, value in options.items():
+        if value is None:
+            continue
+        if isinstance(value, float):
+            value = round(value, 4)
+            if value.is_integer():
+                value = int(value)
+        normalized[name] = value
+    return normalized
+
+class ResponseCache:
+    """Thread-safe LRU response cache with per-entry TTL and a byte budget
+
+    Entries live in an OrderedDict in recency order, so lookups, inserts
+    and evictions are all O(1).
+    """
+    
+    def __init__(self, max_bytes: int, default_ttl: float, max_entry_bytes: int):
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.max_entry_bytes = max_entry_bytes
+        self.entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
+        self.rejected = 0
+    
+    def _remove(self, key: str) -> Dict[str, Any]:
+        entry = self.entries.pop(key)
+        self.total_bytes -= entry['size']
+        return entry
+    
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry['expires_at'] <= time.time():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            entry['hits'] += 1
+            self.hits += 1
+            return entry['value']
+    
+    def set(self, key: str, value: Dict[str, Any], ttl: Optional[float] = None) -> bool:
+        size = len(key) + len(json.dumps(value, ensure_ascii=False).encode('utf-8'))
+        if size > self.max_entry_bytes:
+            with self.lock:
+                self.rejected += 1
+            return False
+        
+        now = time.time()
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = {
+                'value': value,
+                'size': size,
+                'created_at': now,
+                'expires_at': now + (self.default_ttl if ttl is None else ttl),
+                'hits': 0
+            }
+            self.total_bytes += size
+            
+            # Evict least recently used entries until back under budget
+            while self.total_bytes > self.max_bytes and self.entries:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+        return True
+    
+    def delete(self, key: str) -> bool:
+        with self.lock:
+            if key not in self.entries:
+                return False
+            self._remove(key)
+            return True
+    
+    def clear(self) -> int:
+        with self.lock:
+            count = len(self.entries)
+            self.entries.clear()
+            self.total_bytes = 0
+            return count
+    
+    def purge_expired(self) -> int:
+        now = time.time()
+        with self.lock:
+            expired = [key for key, entry in self.entries.items() if entry['expires_at'] <= now]
+            for key in expired:
+                self._remove(key)
+            self.expirations += len(expired)
+            return len(expired)
+    
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "total_cached_responses": len(self.entries),
+                "total_bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "max_entry_bytes": self.max_entry_bytes,
+                "cache_ttl_seconds": self.default_ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "cache_hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "expirations": self.expirations,
+                "evictions": self.evictions,
+                "rejected": self.rejected
+            }
+    
+    def describe(self, limit: int = 50) -> List[Dict[str, Any]]:
+        """List the most recently used entries without their payloads"""
+        now = time.time()
+        with self.lock:
+            items = list(reversed(self.entries.items()))[:limit]
+            return [{
+                "key": key,
+                "model": entry['value'].get('model'),
+                "size_bytes": entry['size'],
+                "age_seconds": round(now - entry['created_at'], 1),
+                "ttl_remaining_seconds": round(max(0.0, entry['expires_at'] - now), 1),
+                "hits": entry['hits']
+            } for key, entry in items]
+
+class PersistentResponseCache:
+    """SQLite-backed second cache tier that survives restarts
+
+    Lives in its own file beside the memory database. Hit counts and new
+    entries are buffered in memory and written by the conversation writer's
+    thread (see flush), so neither a lookup nor storing an answer costs a
+    request disk I/O; reads check the buffer first. Compaction rewrites the
+    shared file, so with several workers only the leader runs it.
+    """
+    
+    def __init__(self, path: str, default_ttl: float, max_entries: int):
+        self.path = path
+        self.default_ttl = default_ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.conn: Optional[sqlite3.Connection] = None
+        self.pending_hits: Dict[str, int] = {}
+        # key -> (value JSON, created_at, expires_at) not yet written
+        self.pending_writes: "OrderedDict[str, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.compactions = 0
+        self.last_compaction: Optional[str] = None
+    
+    def open(self) -> bool:
+        try:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS response_cache (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    expires_at REAL NOT NULL,
+                    hits INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_response_cache_expires ON response_cache(expires_at)")
+            conn.commit()
+            with self.lock:
+                self.conn = conn
+            logger.info(f"Persistent response cache opened at {self.path}")
+            return True
+        except Exception as e:
+            logger.error(f"Failed to open persistent response cache: {e}")
+            return False
+    
+    def close(self):
+        self.flush()
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+    
+    def get(self, key: str, record: bool = True) -> Optional[tuple]:
+        """Return (value, expires_at) for a live entry; record=False leaves hit counts alone"""
+        with self.lock:
+            if self.conn is None:
+                return None
+            pending = self.pending_writes.get(key)
+            try:
+                if pending is not None:
+                    row = (pending[0], pending[2]) if pending[2] > time.time() else None
+                else:
+                    row = self.conn.execute(
+                        "SELECT value, expires_at FROM response_cache WHERE key = ? AND expires_at > ?",
+                        (key, time.time())
+                    ).fetchone()
+            except Exception as e:
+                logger.error(f"Persistent cache read failed: {e}")
+                return None
+            if row is None:
+                if record:
+                    self.misses += 1
+                return None
+            if record:
+                self.hits += 1
+                self.pending_hits[key] = self.pending_hits.get(key, 0) + 1
+        return json.loads(row[0]), row[1]
+    
+    def set(self, key: str, value: Dict[str, Any], ttl: Optional[float] = None):
+        """Buffer an entry for the next flush"""
+        now = time.time()
+        entry = (json.dumps(value, ensure_ascii=False), now, now + (self.default_ttl if ttl is None else ttl))
+        with self.lock:
+            if self.conn is None:
+                return
+            self.pending_writes[key] = entry
+            self.pending_writes.move_to_end(key)
+            # Losing a cache write is harmless; an unbounded buffer is not
+            while len(self.pending_writes) > self.max_entries:
+                self.pending_writes.popitem(last=False)
+    
+    def flush(self) -> int:
+        """Write buffered entries and hit counts in one transaction; returns how many entries were written"""
+        with self.lock:
+            if self.conn is None or not (self.pending_writes or self.pending_hits):
+                return 0
+            pending, self.pending_writes = self.pending_writes, OrderedDict()
+            hits, self.pending_hits = self.pending_hits, {}
+            try:
+                start_time = time.perf_counter()
+                if pending:
+                    self.conn.executemany('''
+                        INSERT OR REPLACE INTO response_cache (key, value, created_at, expires_at, hits)
+                        VALUES (?, ?, ?, ?, 0)
+                    ''', [(key,) + entry for key, entry in pending.items()])
+                if hits:
+                    self.conn.executemany(
+                        "UPDATE response_cache SET hits = hits + ? WHERE key = ?",
+                        [(count, key) for key, count in hits.items()]
+                    )
+                self.conn.commit()
+                db_write_seconds.observe(time.perf_counter() - start_time, table="response_cache")
+                self.writes += len(pending)
+                return len(pending)
+            except Exception as e:
+                logger.error(f"Persistent cache write failed for {len(pending)} entries: {e}")
+                return 0
+    
+    def delete(self, key: str) -> bool:
+        with self.lock:
+            if self.conn is None:
+                return False
+            buffered = self.pending_writes.pop(key, None) is not None
+            cursor = self.conn.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+            self.conn.commit()
+            self.pending_hits.pop(key, None)
+            return cursor.rowcount > 0 or buffered
+    
+    def clear(self) -> int:
+        with self.lock:
+            if self.conn is None:
+                return 0
+            buffered = len(self.pending_writes)
+            self.pending_writes.clear()
+            cursor = self.conn.execute("DELETE FROM response_cache")
+            self.conn.commit()
+            self.pending_hits.clear()
+            return cursor.rowcount + buffered
+    
+    def hot_entries(self, limit: int) -> List[tuple]:
+        """Most-hit live entries as (key, value, expires_at), for warm-loading"""
+        with self.lock:
+            if self.conn is None:
+                return []
+            rows = self.conn.execute('''
+                SELECT key, value, expires_at FROM response_cache
+                WHERE expires_at > ?
+                ORDER BY hits DESC, created_at DESC
+                LIMIT ?
+            ''', (time.time(), limit)).fetchall()
+        return [(row[0], json.loads(row[1]), row[2]) for row in rows]
+    
+    def compact(self) -> int:
+        """Drop expired and overflow entries and reclaim pages, after writing buffered ones"""
+        self.flush()
+        with self.lock:
+            if self.conn is None:
+                return 0
+            try:
+                removed = self.conn.execute(
+                    "DELETE FROM response_cache WHERE expires_at <= ?", (time.time(),)
+                ).rowcount
+                removed += self.conn.execute('''
+                    DELETE FROM response_cache WHERE key IN (
+                        SELECT key FROM response_cache
+                        ORDER BY hits DESC, created_at DESC
+                        LIMIT -1 OFFSET ?
+                    )
+                ''', (self.max_entries,)).rowcount
+                self.conn.commit()
+                self.conn.executescript("PRAGMA incremental_vacuum;")
+                self.compactions += 1
+                self.last_compaction = datetime.now().isoformat()
+                return removed
+            except Exception as e:
+                logger.error(f"Persistent cache compaction failed: {e}")
+                return 0
+    
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            entries = 0
+            if self.conn is not None:
+                entries = self.conn.execute("SELECT COUNT(*) FROM response_cache").fetchone()[0]
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.conn is not None,
+                "path": self.path,
+                "entries": entries,
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.default_ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "writes": self.writes,
+                "pending_writes": len(self.pending_writes),
+                "compactions": self.compactions,
+                "last_compaction": self.last_compaction,
+                "size_bytes": os.path.getsize(self.path) if os.path.exists(self.path) else 0
+            }
+
+response_cache = ResponseCache(MAX_CACHE_BYTES, CACHE_TTL, MAX_CACHE_ENTRY_BYTES)
+persistent_cache = PersistentResponseCache(
+    PERSISTENT_CACHE_PATH, PERSISTENT_CACHE_TTL, PERSISTENT_CACHE_MAX_ENTRIES) if PERSISTENT_CACHE_ENABLED else None
+
+async def get_cached_response(cache_key: str) -> Optional[Dict]:
+    """Get cached response if available and not expired
+
+    Checks the in-memory tier first, then the persistent tier (off the
+    event loop), promoting persistent hits back into memory.
+    """
+    cached = response_cache.get(cache_key)
+    if cached is not None:
+        cache_logger.info(f"Cache hit for key: {cache_key[:8]}...")
+        return cached
+    
+    if persistent_cache is not None:
+        stored = await asyncio.to_thread(persistent_cache.get, cache_key)
+        if stored is not None:
+            value, expires_at = stored
+            response_cache.set(cache_key, value, min(CACHE_TTL, expires_at - time.time()))
+            cache_logger.info(f"Persistent cache hit for key: {cache_key[:8]}...")
+            return value
     return None
 
-def set_cached_response(cache_key: str, response: Dict):
-    """Cache response with TTL"""
-    with cache_lock:
-        # Clean up old cache if size limit reached
-        if len(response_cache) >= MAX_CACHE_SIZE:
-            # Remove oldest 20% of cache
-            sorted_items = sorted(response_cache.items(), key=lambda x: x[1]['timestamp'])
-            for key, _ in sorted_items[:MAX_CACHE_SIZE // 5]:
-                del response_cache[key]
-        
-        response_cache[cache_key] = {
-            'response': response,
-            'timestamp': time.time()
-        }
-        logger.info(f"Cached response for key: {cache_key[:8]}...")
+def set_cached_response(cache_key: str, response: Dict, ttl: Optional[float] = None):
+    """Cache the served fields of a response with TTL"""
+    # Drop the raw Ollama payload (context token array, timings) before caching
+    value = {field: response[field] for field in CACHED_RESPONSE_FIELDS if field in response}
+    if response_cache.set(cache_key, value, ttl):
+        cache_logger.info(f"Cached response for key: {cache_key[:8]}...")
+    else:
+        logger.warning(f"Response too large to cache for key: {cache_key[:8]}...")
+    if persistent_cache is not None:
+        persistent_cache.set(cache_key, value)
+    if semantic_cache is not None and cache_key in pending_embeddings:
+        model, vector = pending_embeddings.pop(cache_key)
+        semantic_cache.add(cache_key, model, vector)
 
-# Database connection pooling
-def get_db_connection():
-    """Get database connection from pool"""
-    thread_id = threading.get_ident()
-    with db_lock:
-        if thread_id not in db_connections:
-            if len(db_connections) < MAX_DB_CONNECTIONS:
-                conn = sqlite3.connect(MEMORY_PATH, check_same_thread=False)
-                conn.row_factory = sqlite3.Row
-                db_connections[thread_id] = conn
-                logger.info(f"Created new DB connection for thread {thread_id}")
+class SemanticCacheIndex:
+    """In-memory vector index mapping prompt embeddings to response cache keys
+
+    Vectors are stored unit-normalized so cosine similarity is a dot
+    product; with NumPy available the search is a single matrix-vector
+    multiply.
+    """
+    
+    def __init__(self, threshold: float, max_entries: int):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.keys: List[str] = []
+        self.models: List[str] = []
+        self.vectors: List[Any] = []
+        self.matrix = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    @staticmethod
+    def _normalize(vector: List[float]):
+        if np is not None:
+            array = np.asarray(vector, dtype=np.float32)
+            norm = float(np.linalg.norm(array))
+            return array / norm if norm else array
+        norm = sum(x * x for x in vector) ** 0.5
+        return [x / norm for x in vector] if norm else list(vector)
+    
+    def add(self, key: str, model: str, vector: List[float]):
+        with self.lock:
+            if key in self.keys:
+                return
+            if len(self.keys) >= self.max_entries:
+                del self.keys[0], self.models[0], self.vectors[0]
+            self.keys.append(key)
+            self.models.append(model)
+            self.vectors.append(self._normalize(vector))
+            self.matrix = None
+    
+    def remove(self, key: str):
+        with self.lock:
+            if key in self.keys:
+                index = self.keys.index(key)
+                del self.keys[index], self.models[index], self.vectors[index]
+                self.matrix = None
+    
+    def clear(self):
+        with self.lock:
+            self.keys.clear()
+            self.models.clear()
+            self.vectors.clear()
+            self.matrix = None
+    
+    def search(self, model: str, vector: List[float]) -> Optional[tuple]:
+        """Return (cache_key, similarity) of the best match above the threshold"""
+        query = self._normalize(vector)
+        with self.lock:
+            if not self.keys:
+                self.misses += 1
+                return None
+            if np is not None:
+                if self.matrix is None or self.matrix.shape[0] != len(self.vectors):
+                    self.matrix = np.vstack(self.vectors)
+                if self.matrix.shape[1] != query.shape[0]:
+                    self.misses += 1
+                    return None
+                scores = self.matrix @ query
+                scores[np.asarray(self.models) != model] = -1.0
+                best = int(np.argmax(scores))
+                score = float(scores[best])
             else:
-                # Reuse existing connection
-                conn = list(db_connections.values())[0]
-        else:
-            conn = db_connections[thread_id]
-    return conn
+                best, score = -1, -1.0
+                for index, candidate in enumerate(self.vectors):
+                    if self.models[index] != model or len(candidate) != len(query):
+                        continue
+                    similarity = sum(a * b for a, b in zip(candidate, query))
+                    if similarity > score:
+                        best, score = index, similarity
+            
+            if best < 0 or score < self.threshold:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return self.keys[best], score
+    
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": True,
+                "entries": len(self.keys),
+                "max_entries": self.max_entries,
+                "embedding_model": SEMANTIC_EMBEDDING_MODEL,
+                "similarity_threshold": self.threshold,
+                "backend": "numpy" if np is not None else "python",
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+semantic_cache = SemanticCacheIndex(
+    SEMANTIC_SIMILARITY_THRESHOLD, SEMANTIC_CACHE_MAX_ENTRIES) if SEMANTIC_CACHE_ENABLED else None
+# Embeddings computed for cache misses, held until the generation is cached
+pending_embeddings: "OrderedDict[str, tuple]" = OrderedDict()
 
-def cleanup_old_conversations():
-    """Clean up conversations older than 30 days"""
+async def embed_text(text: str, model: str = SEMANTIC_EMBEDDING_MODEL) -> Optional[List[float]]:
+    """Compute a local embedding through Ollama's /api/embeddings"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Delete conversations older than 30 days
-        cutoff_date = (datetime.now() - timedelta(days=30)).isoformat()
-        cursor.execute('''
-            DELETE FROM conversations 
-            WHERE timestamp < ?
-        ''', (cutoff_date,))
-        
-        deleted_count = cursor.rowcount
-        conn.commit()
-        
-        if deleted_count > 0:
-            logger.info(f"Cleaned up {deleted_count} old conversations")
-        
-        return deleted_count
+        response = await ollama_backends.request(
+            "POST",
+            "/api/embeddings",
+            model=model,
+            json={"model": model, "prompt": text},
+            timeout=ollama_timeout("embed")
+        )
+        if response.status_code == 200:
+            return response.json().get("embedding") or None
+        logger.warning(f"Ollama embedding error: {response.status_code}")
     except Exception as e:
-        logger.error(f"Failed to cleanup old conversations: {e}")
+        logger.warning(f"Ollama embedding failed: {e}")
+    return None
+
+async def lookup_cached_response(cache_key: str, prompt: str, model: str,
+                                 options: Optional[Dict[str, Any]] = None) -> Optional[Dict]:
+    """Exact cache lookup followed by the optional similarity tier"""
+    cached = await get_cached_response(cache_key)
+    if cached is not None or semantic_cache is None:
+        return cached
+    if options:
+        # Similar prompts only match answers generated with the same options
+        model = f"{model} {json.dumps(options, sort_keys=True)}"
+    
+    vector = await embed_text(normalize_prompt(prompt))
+    if vector is None:
+        return None
+    
+    match = semantic_cache.search(model, vector)
+    if match is not None:
+        similar_key, score = match
+        cached = await get_cached_response(similar_key)
+        if cached is not None:
+            cache_logger.info(f"Semantic cache hit for key: {cache_key[:8]}... (similarity {score:.3f})")
+            return cached
+        semantic_cache.remove(similar_key)
+    
+    # Remember the embedding so the eventual generation can be indexed for free
+    pending_embeddings[cache_key] = (model, vector)
+    while len(pending_embeddings) > 1000:
+        pending_embeddings.popitem(last=False)
+    return None
+
+async def invalidate_prompt_dependent_state():
+    """Drop cached responses and session contexts generated with an older system prompt"""
+    flushed = response_cache.clear()
+    if semantic_cache is not None:
+        semantic_cache.clear()
+    pending_embeddings.clear()
+    with session_lock:
+        session_contexts.clear()
+    if persistent_cache is not None:
+        flushed += await asyncio.to_thread(persistent_cache.clear)
+    logger.info(f"System prompt changed: invalidated {flushed} cached responses")
+
+def warm_response_cache() -> int:
+    """Load the hottest persistent entries into the in-memory tier"""
+    if persistent_cache is None:
         return 0
+    loaded = 0
+    now = time.time()
+    for key, value, expires_at in persistent_cache.hot_entries(PERSISTENT_CACHE_WARM_ENTRIES):
+        if response_cache.set(key, value, min(CACHE_TTL, expires_at - now)):
+            loaded += 1
+    return loaded
+
+# Multi-worker coordination
+class WorkerCoordinator:
+    """Leases, heartbeats and shared counters for workers in one SQLite file
+
+    A lease belongs to one worker until it expires or its owner stops
+    heartbeating, so a crashed worker's leases are taken over within a few
+    heartbeats. The "leader" lease picks the worker that runs singleton
+    jobs; "gen:<cache key>" leases make identical generations run once
+    across processes and "batch:<id>" leases name the worker running a
+    batch. Rows in `slots` are the scheduler's per-model generation slots,
+    shared by all workers. Each heartbeat also publishes the worker's stats.
+    """
+    
+    def __init__(self, path: str, worker_id: str):
+        self.path = path
+        self.worker_id = worker_id
+        self.lock = threading.Lock()
+        self.conn: Optional[sqlite3.Connection] = None
+        self.is_leader = False
+        self.elections_won = 0
+        self.heartbeats = 0
+    
+    def open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        conn.execute(f"PRAGMA busy_timeout={DB_PRAGMAS['busy_timeout']}")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)")
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS workers (
+                worker_id TEXT PRIMARY KEY,
+                pid INTEGER NOT NULL,
+                started_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                leader INTEGER NOT NULL DEFAULT 0,
+                stats TEXT
+            )
+        ''')
+        conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS slots (
+                model TEXT NOT NULL,
+                slot INTEGER NOT NULL,
+                owner TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                PRIMARY KEY (model, slot)
+            )
+        ''')
+        with self.lock:
+            self.conn = conn
+        # Registered before any lease is taken, or a peer could treat our leases as orphaned
+        self.publish({})
+        logger.info(f"Worker {self.worker_id} joined coordination at {self.path}")
+    
+    def close(self):
+        with self.lock:
+            if self.conn is None:
+                return
+            self.conn.execute("DELETE FROM leases WHERE owner = ?", (self.worker_id,))
+            self.conn.execute("DELETE FROM slots WHERE owner = ?", (self.worker_id,))
+            self.conn.execute("DELETE FROM workers WHERE worker_id = ?", (self.worker_id,))
+            self.conn.close()
+            self.conn = None
+    
+    def try_acquire(self, name: str, ttl: float) -> bool:
+        """Take or renew a lease; True when this worker holds it afterwards"""
+        now = time.time()
+        with self.lock:
+            cursor = self.conn.execute('''
+                INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?)
+                ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+                WHERE leases.owner = excluded.owner OR leases.expires_at < ?
+                   OR leases.owner NOT IN (SELECT worker_id FROM workers WHERE updated_at > ?)
+            ''', (name, self.worker_id, now + ttl, now, now - 3 * WORKER_HEARTBEAT_SECONDS))
+            return cursor.rowcount > 0
+    
+    def release(self, name: str):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, self.worker_id))
+    
+    def acquire_slot(self, model: str, limit: int) -> Optional[int]:
+        """Take a free generation slot for the model; None when all `limit` are held"""
+        now = time.time()
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Slots of crashed workers are free again
+                self.conn.execute(
+                    "DELETE FROM slots WHERE model = ? AND (expires_at < ? OR owner NOT IN "
+                    "(SELECT worker_id FROM workers WHERE updated_at > ?))",
+                    (model, now, now - 3 * WORKER_HEARTBEAT_SECONDS))
+                taken = {row[0] for row in self.conn.execute("SELECT slot FROM slots WHERE model = ?", (model,))}
+                slot = next((index for index in range(limit) if index not in taken), None)
+                if slot is not None:
+                    self.conn.execute("INSERT INTO slots (model, slot, owner, expires_at) VALUES (?, ?, ?, ?)",
+                                      (model, slot, self.worker_id, now + LEADER_LEASE_SECONDS))
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        return slot
+    
+    def release_slot(self, model: str, slot: int):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.execute("DELETE FROM slots WHERE model = ? AND slot = ? AND owner = ?",
+                                  (model, slot, self.worker_id))
+    
+    def elect(self) -> bool:
+        """Acquire or renew leadership; returns whether this worker leads now"""
+        leader = self.try_acquire("leader", LEADER_LEASE_SECONDS)
+        if leader and not self.is_leader:
+            self.elections_won += 1
+        self.is_leader = leader
+        return leader
+    
+    def publish(self, stats: Dict[str, Any]):
+        now = time.time()
+        with self.lock:
+            self.conn.execute('''
+                INSERT INTO workers (worker_id, pid, started_at, updated_at, leader, stats) VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(worker_id) DO UPDATE SET updated_at = excluded.updated_at,
+                    leader = excluded.leader, stats = excluded.stats
+            ''', (self.worker_id, os.getpid(), now, now, int(self.is_leader), json.dumps(stats)))
+            # Held slots live as long as this worker heartbeats
+            self.conn.execute("UPDATE slots SET expires_at = ? WHERE owner = ?",
+                              (now + LEADER_LEASE_SECONDS, self.worker_id))
+            # Forget workers that stopped heartbeating a while ago, and leases nobody holds
+            self.conn.execute("DELETE FROM workers WHERE updated_at < ?", (now - 30 * WORKER_HEARTBEAT_SECONDS,))
+            self.conn.execute("DELETE FROM leases WHERE expires_at < ?", (now,))
+        self.heartbeats += 1
+    
+    def workers(self) -> List[Dict[str, Any]]:
+        alive_after = time.time() - 3 * WORKER_HEARTBEAT_SECONDS
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT worker_id, pid, started_at, updated_at, leader, stats FROM workers "
+                "WHERE updated_at > ? ORDER BY started_at", (alive_after,)
+            ).fetchall()
+        return [{
+            "worker_id": worker_id,
+            "pid": pid,
+            "started_at": datetime.fromtimestamp(started_at).isoformat(),
+            "last_heartbeat": datetime.fromtimestamp(updated_at).isoformat(),
+            "leader": bool(leader),
+            "stats": json.loads(stats) if stats else {}
+        } for worker_id, pid, started_at, updated_at, leader, stats in rows]
+    
+    def counter(self, name: str) -> int:
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM counters WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else 0
+    
+    def bump(self, name: str) -> int:
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO counters (name, value) VALUES (?, 1) ON CONFLICT(name) DO UPDATE SET value = value + 1",
+                (name,))
+            return self.conn.execute("SELECT value FROM counters WHERE name = ?", (name,)).fetchone()[0]
+
+worker_coordinator = WorkerCoordinator(COORDINATION_PATH, WORKER_ID) if MULTI_WORKER else None
+cache_epoch = 0  # last "cache_epoch" counter seen; bumped by cache flushes in any worker
+coordination_stats = {
+    "shared_generation_waits": 0,  # requests that waited for another worker's generation
+    "shared_generation_hits": 0,   # ... and got its result from the shared cache
+    "shared_generation_timeouts": 0  # ... and gave up after SHARED_WAIT_SECONDS
+}
+
+def is_leader() -> bool:
+    """Whether this process runs singleton jobs (always, with a single worker)"""
+    return worker_coordinator is None or worker_coordinator.is_leader
+
+def announce_cache_flush():
+    """Tell other workers to drop their in-memory cache tiers"""
+    global cache_epoch
+    if worker_coordinator is not None:
+        cache_epoch = worker_coordinator.bump("cache_epoch")
+
+async def wait_for_shared_generation(cache_key: str) -> Optional[Dict[str, Any]]:
+    """Cross-process single-flight for a generation
+
+    Returns None once this worker holds the "gen:<key>" lease and should
+    generate; returns the cached result if another worker produced it while
+    we waited. Results travel through the shared persistent cache tier,
+    which is written before the owner releases its lease. Polls back off up
+    to SHARED_POLL_MAX_SECONDS, and after SHARED_WAIT_SECONDS the caller
+    generates locally rather than waiting out a stuck owner's lease.
+    """
+    name = f"gen:{cache_key}"
+    ttl = OLLAMA_TIMEOUTS["generate"] + 30
+    if await asyncio.to_thread(worker_coordinator.try_acquire, name, ttl):
+        return None
+    coordination_stats["shared_generation_waits"] += 1
+    cache_logger.info(f"Waiting for another worker's generation for key: {cache_key[:8]}...")
+    deadline = time.monotonic() + SHARED_WAIT_SECONDS
+    delay = 0.05
+    while True:
+        await asyncio.sleep(min(delay, max(0.0, deadline - time.monotonic())))
+        delay = min(delay * 2, SHARED_POLL_MAX_SECONDS)
+        acquired, stored = await asyncio.to_thread(_poll_shared_generation, name, ttl, cache_key)
+        if stored is not None:
+            coordination_stats["shared_generation_hits"] += 1
+            return stored[0]
+        if acquired:
+            return None
+        if time.monotonic() >= deadline:
+            coordination_stats["shared_generation_timeouts"] += 1
+            cache_logger.warning(f"Gave up waiting for another worker's generation after {SHARED_WAIT_SECONDS}s, "
+                                 f"generating locally for key: {cache_key[:8]}...")
+            return None
+
+def _poll_shared_generation(name: str, ttl: float, cache_key: str) -> tuple:
+    """One wait step, in a worker thread: (holds the lease, stored result or None)"""
+    stored = persistent_cache.get(cache_key, False)
+    if stored is None and worker_coordinator.try_acquire(name, ttl):
+        # The owner may have stored its result and let go since the lookup
+        stored = persistent_cache.get(cache_key, False)
+        if stored is None:
+            return True, None
+        worker_coordinator.release(name)
+    return False, stored
+
+async def persistent_cache_compaction_loop():
+    """Periodically compact the persistent cache off the event loop"""
+    while True:
+        await asyncio.sleep(PERSISTENT_CACHE_COMPACT_INTERVAL)
+        removed = await asyncio.to_thread(persistent_cache.compact)
+        if removed:
+            logger.info(f"Persistent cache compaction removed {removed} entries")
+
+def new_conversation_id(prefix: str, text: str) -> str:
+    """Generate a unique conversation ID
+
+    The random suffix keeps IDs unique when coalesced identical requests
+    arrive within the same second.
+    """
+    return f"{prefix}_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{hash(text) % 10000}_{uuid.uuid4().hex[:6]}"
+
+# Database connection pooling
+class SQLiteConnectionPool:
+    """Bounded SQLite connection pool with checkout/checkin semantics
+
+    Connections are opened lazily up to `size`, configured with the shared
+    pragmas, and handed to one thread at a time. Read-only pools open the
+    database with mode=ro and query_only so they can never take the write
+    lock.
+    """
+    
+    def __init__(self, path: str, size: int, readonly: bool = False, timeout: float = DB_POOL_TIMEOUT):
+        self.path = path
+        self.size = size
+        self.readonly = readonly
+        self.timeout = timeout
+        self.idle: List[sqlite3.Connection] = []
+        self.created = 0
+        self.in_use = 0
+        self.cond = threading.Condition()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+    
+    def _connect(self) -> sqlite3.Connection:
+        if self.readonly:
+            conn = sqlite3.connect(f"{Path(self.path).resolve().as_uri()}?mode=ro", uri=True,
+                                   check_same_thread=False)
+        else:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+        conn.row_factory = sqlite3.Row
+        for name, value in DB_PRAGMAS.items():
+            conn.execute(f"PRAGMA {name}={value}")
+        if self.readonly:
+            conn.execute("PRAGMA query_only=ON")
+        return conn
+    
+    def acquire(self) -> sqlite3.Connection:
+        """Check out a connection, waiting up to `timeout` for one to free up"""
+        start = time.perf_counter()
+        deadline = start + self.timeout
+        conn = None
+        with self.cond:
+            while True:
+                if self.idle:
+                    conn = self.idle.pop()
+                    break
+                if self.created < self.size:
+                    self.created += 1
+                    break
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise TimeoutError(f"Timed out waiting for a database connection ({self.size} in use)")
+                self.cond.wait(remaining)
+            self.in_use += 1
+        
+        if conn is None:
+            try:
+                conn = self._connect()
+            except Exception:
+                with self.cond:
+                    self.created -= 1
+                    self.in_use -= 1
+                    self.cond.notify()
+                raise
+        
+        waited = time.perf_counter() - start
+        with self.cond:
+            self.checkouts += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+        return conn
+    
+    def release(self, conn: sqlite3.Connection):
+        """Check a connection back in, discarding it if it is unusable"""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            conn.close()
+            with self.cond:
+                self.created -= 1
+                self.in_use -= 1
+                self.cond.notify()
+            return
+        with self.cond:
+            self.idle.append(conn)
+            self.in_use -= 1
+            self.cond.notify()
+    
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+    
+    def close(self):
+        with self.cond:
+            for conn in self.idle:
+                conn.close()
+            self.created -= len(self.idle)
+            self.idle.clear()
+    
+    def stats(self) -> Dict[str, Any]:
+        with self.cond:
+            return {
+                "mode": "read" if self.readonly else "write",
+                "size": self.size,
+                "open_connections": self.created,
+                "in_use": self.in_use,
+                "idle": len(self.idle),
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "avg_wait_ms": round(self.total_wait / self.checkouts * 1000, 3) if self.checkouts else 0.0,
+                "max_wait_ms": round(self.max_wait * 1000, 3)
+            }
+
+# SQLite allows a single writer, so writes share one connection while reads fan out
+db_read_pool = SQLiteConnectionPool(MEMORY_PATH, MAX_DB_CONNECTIONS, readonly=True)
+db_write_pool = SQLiteConnectionPool(MEMORY_PATH, 1)
+
+async def run_db(func, *args, **kwargs):
+    """Async facade: run a blocking database function in a worker thread"""
+    return await asyncio.to_thread(func, *args, **kwargs)
+
+class RetentionWorker:
+    """Deletes conversations older than the retention window without long write locks
+
+    Each batch reads the oldest expired rows, optionally appends them to
+    gzip JSONL archives partitioned by UTC day, then deletes them by rowid in
+    one short transaction, so the conversation writer interleaves between
+    batches. Archiving is at-least-once: rows archived just before a crash
+    are archived again by the next pass. Freed pages are returned with
+    incremental_vacuum when the database uses auto_vacuum=INCREMENTAL.
+    """
+    
+    def __init__(self, days: float, batch_size: int, pause: float, archive_path: Optional[str]):
+        self.days = days
+        self.batch_size = batch_size
+        self.pause = pause
+        self.archive_path = archive_path
+        self.lock = asyncio.Lock()
+        self.passes = 0
+        self.deleted_total = 0
+        self.archived_total = 0
+        self.pages_vacuumed = 0
+        self.current: Optional[Dict[str, Any]] = None
+        self.last_pass: Optional[Dict[str, Any]] = None
+        self.last_error: Optional[str] = None
+    
+    def cutoff(self) -> int:
+        return int((datetime.now() - timedelta(days=self.days)).timestamp() * 1000)
+    
+    def count_expired(self, cutoff: int) -> int:
+        with db_read_pool.connection() as conn:
+            return conn.execute("SELECT COUNT(*) FROM conversations WHERE timestamp < ?", (cutoff,)).fetchone()[0]
+    
+    def _archive(self, rows: List[sqlite3.Row]):
+        partitions: Dict[str, List[str]] = {}
+        for row in rows:
+            day = datetime.fromtimestamp(row['timestamp'] / 1000, timezone.utc).strftime("%Y-%m-%d")
+            record = {field: row[field] for field in ('id', 'agent') + CONVERSATION_FIELDS[1:]}
+            record['timestamp_ms'] = row['timestamp']
+            record['timestamp'] = epoch_ms_to_iso(row['timestamp'])
+            record['context'] = json.loads(row['context']) if row['context'] else None
+            partitions.setdefault(day, []).append(json.dumps(record, ensure_ascii=False) + "\n")
+        for day, lines in partitions.items():
+            directory = os.path.join(self.archive_path, day[:4], day[5:7])
+            os.makedirs(directory, exist_ok=True)
+            # Appending adds a gzip member; gzip readers and zcat see one continuous file
+            with gzip.open(os.path.join(directory, f"conversations-{day}.jsonl.gz"), 'at', encoding='utf-8') as f:
+                f.writelines(lines)
+    
+    def delete_batch(self, cutoff: int) -> int:
+        """Archive and delete up to batch_size expired rows; returns how many went"""
+        columns = "rowid, id, agent, " + ", ".join(CONVERSATION_FIELDS[1:])
+        with db_read_pool.connection() as conn:
+            # Oldest first, served by idx_conversations_timestamp
+            rows = conn.execute(
+                f"SELECT {columns} FROM conversations WHERE timestamp < ? ORDER BY timestamp LIMIT ?",
+                (cutoff, self.batch_size)
+            ).fetchall()
+        if not rows:
+            return 0
+        if self.archive_path:
+            self._archive(rows)
+        start_time = time.perf_counter()
+        with db_write_pool.connection() as conn, conn:
+            deleted = conn.execute(
+                f"DELETE FROM conversations WHERE rowid IN ({', '.join('?' for _ in rows)})",
+                [row['rowid'] for row in rows]
+            ).rowcount
+        db_write_seconds.observe(time.perf_counter() - start_time, table="conversations")
+        return deleted
+    
+    def vacuum_step(self) -> int:
+        """Free up to RETENTION_VACUUM_PAGES pages; 0 when nothing is left or auto_vacuum is off"""
+        with db_write_pool.connection() as conn:
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                return 0
+            free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            if not free_pages:
+                return 0
+            # execute() steps the pragma once, freeing a single page; executescript runs it to completion
+            conn.executescript(f"PRAGMA incremental_vacuum({int(RETENTION_VACUUM_PAGES)});")
+            return free_pages - conn.execute("PRAGMA freelist_count").fetchone()[0]
+    
+    async def run_pass(self) -> Dict[str, Any]:
+        """One full pass; concurrent callers wait for the pass already running"""
+        async with self.lock:
+            cutoff = self.cutoff()
+            self.current = {
+                "started_at": datetime.now().isoformat(),
+                "cutoff": epoch_ms_to_iso(cutoff),
+                "expired_at_start": await run_db(self.count_expired, cutoff),
+                "deleted": 0,
+                "archived": 0,
+                "batches": 0,
+                "pages_vacuumed": 0
+            }
+            try:
+                while True:
+                    deleted = await run_db(self.delete_batch, cutoff)
+                    if not deleted:
+                        break
+                    self.current["deleted"] += deleted
+                    self.current["batches"] += 1
+                    self.deleted_total += deleted
+                    if self.archive_path:
+                        self.current["archived"] += deleted
+                        self.archived_total += deleted
+                    await asyncio.sleep(self.pause)
+                while True:
+                    freed = await run_db(self.vacuum_step)
+                    if freed <= 0:
+                        break
+                    self.current["pages_vacuumed"] += freed
+                    self.pages_vacuumed += freed
+                    await asyncio.sleep(self.pause)
+                self.last_error = None
+            except Exception as e:
+                self.last_error = str(e)
+                logger.error(f"Retention pass failed: {e}")
+            finally:
+                self.current["finished_at"] = datetime.now().isoformat()
+                self.last_pass, self.current = self.current, None
+                self.passes += 1
+            if self.last_pass["deleted"]:
+                logger.info(f"Retention removed {self.last_pass['deleted']} conversations older than {self.days} days"
+                            f"{' (archived)' if self.archive_path else ''}")
+            return self.last_pass
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": RETENTION_ENABLED,
+            "days": self.days,
+            "interval_seconds": RETENTION_INTERVAL,
+            "batch_size": self.batch_size,
+            "archive": self.archive_path,
+            "running": self.current is not None,
+            "current_pass": self.current,
+            "last_pass": self.last_pass,
+            "passes": self.passes,
+            "deleted_total": self.deleted_total,
+            "archived_total": self.archived_total,
+            "pages_vacuumed": self.pages_vacuumed,
+            "last_error": self.last_error
+        }
+
+retention_worker = RetentionWorker(RETENTION_DAYS, RETENTION_BATCH_SIZE, RETENTION_PAUSE,
+                                   RETENTION_ARCHIVE_PATH if RETENTION_ARCHIVE_ENABLED else None)
+
+async def retention_loop():
+    """Run a retention pass shortly after startup, then every RETENTION_INTERVAL"""
+    await asyncio.sleep(5)
+    while True:
+        await retention_worker.run_pass()
+        await asyncio.sleep(RETENTION_INTERVAL)
+
+def enable_incremental_vacuum_mode() -> str:
+    """Switch an existing database to auto_vacuum=INCREMENTAL (rewrites the file with VACUUM)"""
+    with db_write_pool.connection() as conn:
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            return "incremental"
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+        return "incremental" if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2 else "none"
+
+# Schema migrations
+def _migration_create_conversations(conn: sqlite3.Connection):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS conversations (
+            id TEXT PRIMARY KEY,
+            agent TEXT NOT NULL,
+            user_input TEXT NOT NULL,
+            ai_response TEXT NOT NULL,
+            timestamp TEXT NOT NULL,
+            model TEXT NOT NULL,
+            context TEXT
+        )
+    ''')
+
+def _migration_epoch_timestamps(conn: sqlite3.Connection):
+    # SQLite cannot change a column type in place, so rebuild the table.
+    # Legacy ISO timestamps were written in local time; the 'utc' modifier converts them.
+    unparseable = conn.execute(
+        "SELECT id, timestamp FROM conversations WHERE julianday(timestamp, 'utc') IS NULL"
+    ).fetchall()
+    if unparseable:
+        examples = ", ".join(f"{row[0]}={row[1]!r}" for row in unparseable[:5])
+        logger.warning(f"{len(unparseable)} conversations have unparseable timestamps and will be "
+                       f"stored as 0 (1970-01-01): {examples}")
+    conn.execute("ALTER TABLE conversations RENAME TO conversations_v1")
+    conn.execute('''
+        CREATE TABLE conversations (
+            id TEXT PRIMARY KEY,
+            agent TEXT NOT NULL,
+            user_input TEXT NOT NULL,
+            ai_response TEXT NOT NULL,
+            timestamp INTEGER NOT NULL,
+            model TEXT NOT NULL,
+            context TEXT,
+            prompt_tokens INTEGER,
+            completion_tokens INTEGER,
+            latency_ms INTEGER
+        )
+    ''')
+    conn.execute('''
+        INSERT INTO conversations (id, agent, user_input, ai_response, timestamp, model, context)
+        SELECT id, agent, user_input, ai_response,
+               COALESCE(CAST(ROUND((julianday(timestamp, 'utc') - 2440587.5) * 86400000) AS INTEGER), 0),
+               model, context
+        FROM conversations_v1
+    ''')
+    conn.execute("DROP TABLE conversations_v1")
+
+def _migration_conversation_indexes(conn: sqlite3.Connection):
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_conversations_agent_timestamp ON conversations(agent, timestamp)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_conversations_timestamp ON conversations(timestamp)")
+
+def _migration_keyset_index(conn: sqlite3.Connection):
+    # Covers the (timestamp, id) keyset used for history pagination
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_conversations_agent_timestamp_id ON conversations(agent, timestamp, id)")
+    conn.execute("DROP INDEX IF EXISTS idx_conversations_agent_timestamp")
+
+def _migration_batches(conn: sqlite3.Connection):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS batches (
+            id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            created_at INTEGER NOT NULL,
+            completed_at INTEGER,
+            total INTEGER NOT NULL,
+            parallelism INTEGER NOT NULL
+        )
+    ''')
+    # seq is the completion order, so result streams can resume after any item
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS batch_items (
+            batch_id TEXT NOT NULL,
+            idx INTEGER NOT NULL,
+            custom_id TEXT NOT NULL,
+            request TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            result TEXT,
+            cached INTEGER NOT NULL DEFAULT 0,
+            seq INTEGER,
+            completed_at INTEGER,
+            PRIMARY KEY (batch_id, idx)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_batch_items_seq ON batch_items(batch_id, seq)")
+
+def _migration_token_usage(conn: sqlite3.Connection):
+    # One row per UTC day, agent and model; the writer adds to it with upserts
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS token_usage (
+            day TEXT NOT NULL,
+            agent TEXT NOT NULL,
+            model TEXT NOT NULL,
+            requests INTEGER NOT NULL DEFAULT 0,
+            cached_requests INTEGER NOT NULL DEFAULT 0,
+            prompt_tokens INTEGER NOT NULL DEFAULT 0,
+            completion_tokens INTEGER NOT NULL DEFAULT 0,
+            cached_tokens INTEGER NOT NULL DEFAULT 0,
+            estimated_requests INTEGER NOT NULL DEFAULT 0,
+            latency_ms INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, agent, model)
+        ) WITHOUT ROWID
+    ''')
+
+def _migration_conversations_fts(conn: sqlite3.Connection):
+    # External-content index: the text lives only in conversations, keyed by its rowid.
+    # Triggers keep it in sync, including deletes from retention cleanup.
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS conversations_fts USING fts5(
+            user_input, ai_response,
+            content='conversations', content_rowid='rowid',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS conversations_fts_insert AFTER INSERT ON conversations BEGIN
+            INSERT INTO conversations_fts(rowid, user_input, ai_response)
+            VALUES (new.rowid, new.user_input, new.ai_response);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS conversations_fts_delete AFTER DELETE ON conversations BEGIN
+            INSERT INTO conversations_fts(conversations_fts, rowid, user_input, ai_response)
+            VALUES ('delete', old.rowid, old.user_input, old.ai_response);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS conversations_fts_update AFTER UPDATE OF user_input, ai_response ON conversations BEGIN
+            INSERT INTO conversations_fts(conversations_fts, rowid, user_input, ai_response)
+            VALUES ('delete', old.rowid, old.user_input, old.ai_response);
+            INSERT INTO conversations_fts(rowid, user_input, ai_response)
+            VALUES (new.rowid, new.user_input, new.ai_response);
+        END
+    ''')
+    conn.execute("INSERT INTO conversations_fts(conversations_fts) VALUES ('rebuild')")
+
+# Ordered schema migrations; PRAGMA user_version records how many have been applied
+MIGRATIONS = [
+    (1, "create conversations table", _migration_create_conversations),
+    (2, "store timestamps as integer epoch milliseconds, add token counts and latency", _migration_epoch_timestamps),
+    (3, "add (agent, timestamp) and timestamp indexes", _migration_conversation_indexes),
+    (4, "extend agent index with id for keyset pagination", _migration_keyset_index),
+    (5, "add batches and batch_items for /v1/batch", _migration_batches),
+    (6, "add token_usage aggregates", _migration_token_usage),
+    (7, "add conversations_fts full-text index and sync triggers", _migration_conversations_fts),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def migrate_memory_db(conn: sqlite3.Connection) -> int:
+    """Apply pending schema migrations, each in its own transaction"""
+    current = conn.execute("PRAGMA user_version").fetchone()[0]
+    for version, description, migration in MIGRATIONS:
+        if version <= current:
+            continue
+        conn.execute("BEGIN IMMEDIATE")
+        # Another worker may have applied it while we waited for the write lock
+        current = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version <= current:
+            conn.execute("COMMIT")
+            continue
+        try:
+            migration(conn)
+            conn.execute(f"PRAGMA user_version = {version}")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        logger.info(f"Applied schema migration {version}: {description}")
+        current = version
+    return current
+
+def epoch_ms() -> int:
+    """Current time as integer epoch milliseconds (the conversations.timestamp format)"""
+    return int(time.time() * 1000)
+
+def epoch_ms_to_iso(value: int) -> str:
+    return datetime.fromtimestamp(value / 1000).isoformat()
 
 # Initialize memory database
 def init_memory_db():
     """Initialize SQLite database for conversation memory"""
     try:
         os.makedirs(os.path.dirname(MEMORY_PATH), exist_ok=True)
-        conn = sqlite3.connect(MEMORY_PATH)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS conversations (
-                id TEXT PRIMARY KEY,
-                agent TEXT NOT NULL,
-                user_input TEXT NOT NULL,
-                ai_response TEXT NOT NULL,
-                timestamp TEXT NOT NULL,
-                model TEXT NOT NULL,
-                context TEXT
-            )
-        ''')
+        conn = sqlite3.connect(MEMORY_PATH, isolation_level=None)
+        
+        # Only takes effect before the first table exists; existing files
+        # are converted on request with POST /cleanup?enable_incremental_vacuum=true
+        if conn.execute("PRAGMA user_version").fetchone()[0] == 0:
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        # WAL lets the background writer commit without blocking readers
+        conn.execute("PRAGMA journal_mode=WAL")
+        version = migrate_memory_db(conn)
         
-        conn.commit()
         conn.close()
-        logger.info(f"Memory database initialized at {MEMORY_PATH}")
+        logger.info(f"Memory database initialized at {MEMORY_PATH} (schema version {version})")
         return True
     except Exception as e:
         logger.error(f"Failed to initialize memory database: {e}")
         return False
 
-# Memory functions
-def save_conversation(conversation_id: str, agent: str, user_input: str, 
-                     ai_response: str, model: str, context: Optional[Dict] = None):
-    """Save conversation to memory database using connection pooling"""
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT INTO conversations (id, agent, user_input, ai_response, timestamp, model, context)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (conversation_id, agent, user_input, ai_response, 
-              datetime.now().isoformat(), model, json.dumps(context) if context else None))
-        
-        conn.commit()
-        logger.info(f"Conversation saved: {conversation_id}")
-        return True
-    except Exception as e:
-        logger.error(f"Failed to save conversation: {e}")
-        return False
+# Memory functions
+class ConversationWriter:
+    """Write-behind pipeline for conversation records
+
+    Request handlers enqueue rows; a dedicated thread drains the queue and
+    inserts up to batch_size rows per transaction, so request latency never
+    includes disk I/O.
+    """
+    
+    _STOP = object()
+    
+    def __init__(self, batch_size: int, flush_interval: float, max_queue: int):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue: "queue.Queue" = queue.Queue(maxsize=max_queue)
+        self.thread: Optional[threading.Thread] = None
+        self.start_lock = threading.Lock()
+        self.written = 0
+        self.batches = 0
+        self.dropped = 0
+        self.failed = 0
+        self.last_batch_ms = 0.0
+        # Token usage summed in memory per (day, agent, model) until the next flush
+        self.usage: Dict[tuple, List[int]] = {}
+        self.usage_lock = threading.Lock()
+        self.usage_flushes = 0
+    
+    def start(self):
+        with self.start_lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name="conversation-writer", daemon=True)
+                self.thread.start()
+    
+    def enqueue(self, record: tuple) -> bool:
+        self.start()
+        try:
+            self.queue.put_nowait(record)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            logger.error("Conversation write queue full, dropping record")
+            return False
+    
+    def flush(self):
+        """Block until every queued record has been committed"""
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.join()
+        self.flush_usage()
+    
+    def add_usage(self, agent: str, model: str, prompt_tokens: int, completion_tokens: int,
+                  latency_ms: int = 0, cached: bool = False, estimated: bool = False):
+        """Count one served request towards the per-day, per-agent, per-model aggregates
+
+        Tokens of cached answers are tracked separately so the generated
+        totals reflect what Ollama actually had to compute.
+        """
+        key = (datetime.now(timezone.utc).strftime("%Y-%m-%d"), agent, model)
+        with self.usage_lock:
+            totals = self.usage.setdefault(key, [0] * 7)
+            totals[0] += 1
+            if cached:
+                totals[1] += 1
+                totals[4] += prompt_tokens + completion_tokens
+            else:
+                totals[2] += prompt_tokens
+                totals[3] += completion_tokens
+                totals[6] += latency_ms or 0
+            totals[5] += int(estimated)
+    
+    def flush_usage(self):
+        """Upsert the pending usage aggregates in one transaction"""
+        with self.usage_lock:
+            pending, self.usage = self.usage, {}
+        if not pending:
+            return
+        start_time = time.perf_counter()
+        try:
+            with db_write_pool.connection() as conn, conn:
+                conn.executemany('''
+                    INSERT INTO token_usage (day, agent, model, requests, cached_requests, prompt_tokens,
+                                             completion_tokens, cached_tokens, estimated_requests, latency_ms)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (day, agent, model) DO UPDATE SET
+                        requests = requests + excluded.requests,
+                        cached_requests = cached_requests + excluded.cached_requests,
+                        prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+                        completion_tokens = completion_tokens + excluded.completion_tokens,
+                        cached_tokens = cached_tokens + excluded.cached_tokens,
+                        estimated_requests = estimated_requests + excluded.estimated_requests,
+                        latency_ms = latency_ms + excluded.latency_ms
+                ''', [key + tuple(totals) for key, totals in pending.items()])
+            db_write_seconds.observe(time.perf_counter() - start_time, table="token_usage")
+            self.usage_flushes += 1
+        except Exception as e:
+            logger.error(f"Failed to write token usage for {len(pending)} aggregates: {e}")
+    
+    def _flush_deferred(self):
+        """Write what request handlers only recorded in memory: usage totals and cache entries"""
+        self.flush_usage()
+        if persistent_cache is not None:
+            persistent_cache.flush()
+    
+    def stop(self, timeout: float = 10.0):
+        """Flush outstanding records and stop the writer thread"""
+        if self.thread is None or not self.thread.is_alive():
+            return
+        self.queue.put(self._STOP)
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            logger.warning(f"Conversation writer did not stop within {timeout}s ({self.queue.qsize()} queued)")
+    
+    def _run(self):
+        stopping = False
+        while not stopping:
+            try:
+                item = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                self._flush_deferred()
+                continue
+            
+            batch, done = [], 1
+            if item is self._STOP:
+                stopping = True
+            else:
+                batch.append(item)
+            
+            # Gather whatever else arrives before the flush deadline
+            deadline = time.monotonic() + self.flush_interval
+            while not stopping and len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                done += 1
+                if item is self._STOP:
+                    stopping = True
+                else:
+                    batch.append(item)
+            
+            if batch:
+                self._write_batch(batch)
+            self._flush_deferred()
+            for _ in range(done):
+                self.queue.task_done()
+        
+        # Drain anything enqueued after the stop request
+        leftover = []
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            self.queue.task_done()
+            if item is not self._STOP:
+                leftover.append(item)
+        if leftover:
+            self._write_batch(leftover)
+        self.flush_usage()
+    
+    def _write_batch(self, batch: List[tuple]):
+        start_time = time.perf_counter()
+        try:
+            # An upsert rather than INSERT OR REPLACE: REPLACE deletes without firing
+            # the delete trigger, which would leave stale rows in conversations_fts
+            with db_write_pool.connection() as conn, conn:
+                conn.executemany('''
+                    INSERT INTO conversations (id, agent, user_input, ai_response, timestamp, model, context,
+                                               prompt_tokens, completion_tokens, latency_ms)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(id) DO UPDATE SET
+                        agent = excluded.agent, user_input = excluded.user_input,
+                        ai_response = excluded.ai_response, timestamp = excluded.timestamp,
+                        model = excluded.model, context = excluded.context,
+                        prompt_tokens = excluded.prompt_tokens, completion_tokens = excluded.completion_tokens,
+                        latency_ms = excluded.latency_ms
+                ''', batch)
+            db_write_seconds.observe(time.perf_counter() - start_time, table="conversations")
+            self.written += len(batch)
+            self.batches += 1
+        except Exception as e:
+            self.failed += len(batch)
+            logger.error(f"Failed to write {len(batch)} conversations: {e}")
+        self.last_batch_ms = (time.perf_counter() - start_time) * 1000
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queued": self.queue.qsize(),
+            "written": self.written,
+            "batches": self.batches,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "last_batch_ms": round(self.last_batch_ms, 2),
+            "usage_flushes": self.usage_flushes,
+            "batch_size": self.batch_size,
+            "flush_interval_seconds": self.flush_interval
+        }
+
+conversation_writer = ConversationWriter(WRITE_BATCH_SIZE, WRITE_FLUSH_INTERVAL, WRITE_QUEUE_SIZE)
+
+def save_conversation(conversation_id: str, agent: str, user_input: str, 
+                     ai_response: str, model: str, context: Optional[Dict] = None,
+                     prompt_tokens: Optional[int] = None, completion_tokens: Optional[int] = None,
+                     latency_ms: Optional[int] = None, cached: bool = False, estimated: bool = False):
+    """Queue a conversation for the background writer and count its token usage"""
+    try:
+        conversation_writer.add_usage(agent, model, prompt_tokens or 0, completion_tokens or 0,
+                                      latency_ms or 0, cached, estimated)
+        queued = conversation_writer.enqueue((
+            conversation_id, agent, user_input, ai_response,
+            epoch_ms(), model, json.dumps(context) if context else None,
+            prompt_tokens, completion_tokens, latency_ms
+        ))
+        if queued:
+            request_logger.info(f"Conversation queued: {conversation_id}")
+            if not cached:
+                queue_memory_indexing(conversation_id, agent, user_input)
+        return queued
+    except Exception as e:
+        logger.error(f"Failed to save conversation: {e}")
+        return False
+
+# Columns clients may request through the `fields` projection
+CONVERSATION_FIELDS = ('id', 'user_input', 'ai_response', 'timestamp', 'model', 'context',
+                       'prompt_tokens', 'completion_tokens', 'latency_ms')
+MAX_HISTORY_PAGE_SIZE = 500
+
+def encode_history_cursor(key: tuple) -> str:
+    """Encode a (timestamp, id) keyset position as an opaque cursor"""
+    timestamp, conversation_id = key
+    return base64.urlsafe_b64encode(f"{timestamp}:{conversation_id}".encode()).decode().rstrip("=")
+
+def decode_history_cursor(cursor: str) -> tuple:
+    """Decode a cursor produced by encode_history_cursor; raises ValueError if malformed"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        timestamp, conversation_id = raw.split(":", 1)
+        return int(timestamp), conversation_id
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+def parse_history_fields(fields: Optional[str]) -> List[str]:
+    """Parse a comma-separated field projection; raises ValueError on unknown fields"""
+    if not fields:
+        return list(CONVERSATION_FIELDS)
+    requested = [field.strip() for field in fields.split(",") if field.strip()]
+    unknown = [field for field in requested if field not in CONVERSATION_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    return requested
+
+def fetch_conversation_page(agent: str, limit: int, before: Optional[tuple] = None,
+                            fields: Optional[List[str]] = None) -> tuple:
+    """Fetch one page of history newest-first using keyset pagination
+
+    Returns (rows, next_key); next_key is the (timestamp, id) to pass as
+    `before` for the following page, or None on the last page. Only the
+    requested columns are read, and context is decoded only when asked for.
+    """
+    fields = fields or list(CONVERSATION_FIELDS)
+    # id and timestamp are always read because they form the keyset
+    columns = ['id', 'timestamp'] + [field for field in fields if field not in ('id', 'timestamp')]
+    query = f"SELECT {', '.join(columns)} FROM conversations WHERE agent = ?"
+    params: List[Any] = [agent]
+    if before is not None:
+        query += " AND (timestamp, id) < (?, ?)"
+        params.extend(before)
+    # Served by idx_conversations_agent_timestamp_id
+    query += " ORDER BY timestamp DESC, id DESC LIMIT ?"
+    params.append(limit)
+    
+    with db_read_pool.connection() as conn:
+        rows = conn.execute(query, params).fetchall()
+    
+    history = []
+    for row in rows:
+        item = {}
+        for field in fields:
+            value = row[field]
+            if field == 'timestamp':
+                value = epoch_ms_to_iso(value)
+            elif field == 'context':
+                value = json.loads(value) if value else None
+            item[field] = value
+        history.append(item)
+    
+    next_key = (rows[-1]['timestamp'], rows[-1]['id']) if len(rows) == limit else None
+    return history, next_key
+
+def get_conversation_history(agent: str, limit: int = 10) -> List[Dict]:
+    """Retrieve conversation history for an agent using connection pooling"""
+    try:
+        history, _ = fetch_conversation_page(agent, limit)
+        return history
+    except Exception as e:
+        logger.error(f"Failed to retrieve conversation history: {e}")
+        return []
+
+# Full-text search over conversations_fts
+MAX_SEARCH_PAGE_SIZE = 100
+SEARCH_SNIPPET_TOKENS = 16
+SEARCH_TERM_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+def build_fts_query(text: str, raw: bool = False) -> str:
+    """Turn free text into an FTS5 query matching every term
+
+    Terms are quoted so punctuation and FTS5 operators in user input cannot
+    produce syntax errors; the last term also matches as a prefix so
+    search-as-you-type works. `raw` passes FTS5 query syntax through.
+    Raises ValueError when nothing searchable remains.
+    """
+    if raw:
+        if not text.strip():
+            raise ValueError("Empty search query")
+        return text
+    terms = SEARCH_TERM_PATTERN.findall(text)
+    if not terms:
+        raise ValueError("Search query has no searchable terms")
+    quoted = [f'"{term}"' for term in terms]
+    quoted[-1] += "*"
+    return " ".join(quoted)
+
+def search_conversations(fts_query: str, agent: Optional[str], limit: int, offset: int,
+                         highlight: tuple = ("<mark>", "</mark>")) -> tuple:
+    """Rank conversations matching an FTS5 query by BM25
+
+    Matches in user_input weigh twice as much as matches in ai_response.
+    Returns (results, next_offset); next_offset is None on the last page.
+    """
+    start, end = highlight
+    query = f'''
+        SELECT c.id, c.agent, c.timestamp, c.model,
+               bm25(conversations_fts, 2.0, 1.0) AS rank,
+               snippet(conversations_fts, 0, ?, ?, '…', {SEARCH_SNIPPET_TOKENS}) AS user_input,
+               snippet(conversations_fts, 1, ?, ?, '…', {SEARCH_SNIPPET_TOKENS}) AS ai_response
+        FROM conversations_fts
+        JOIN conversations c ON c.rowid = conversations_fts.rowid
+        WHERE conversations_fts MATCH ?
+    '''
+    params: List[Any] = [start, end, start, end, fts_query]
+    if agent:
+        query += " AND c.agent = ?"
+        params.append(agent)
+    # One extra row tells us whether another page exists
+    query += " ORDER BY rank, c.timestamp DESC LIMIT ? OFFSET ?"
+    params.extend([limit + 1, offset])
+    
+    with db_read_pool.connection() as conn:
+        rows = conn.execute(query, params).fetchall()
+    
+    results = [{
+        "id": row["id"],
+        "agent": row["agent"],
+        "timestamp": epoch_ms_to_iso(row["timestamp"]),
+        "model": row["model"],
+        "score": round(-row["rank"], 4),
+        "user_input": row["user_input"],
+        "ai_response": row["ai_response"]
+    } for row in rows[:limit]]
+    next_offset = offset + limit if len(rows) > limit else None
+    return results, next_offset
+
+# Memory retrieval: embeddings of past exchanges, searched for each new prompt
+class ConversationVectorIndex:
+    """Append-only embedding index of past user inputs, memory-mapped from disk
+
+    <path>.f32 holds unit-normalized float32 rows, <path>.ids the matching
+    "agent<TAB>conversation id" lines and <path>.json the embedding model
+    and dimension. New rows are appended, never rewritten, and a search is
+    one matrix-vector product over the mapping plus a partial sort. With
+    several workers only the leader appends; the others refresh() to pick
+    up rows appended since they last looked.
+    """
+    
+    def __init__(self, path: str, model: str):
+        self.vectors_path = path + ".f32"
+        self.ids_path = path + ".ids"
+        self.meta_path = path + ".json"
+        self.model = model
+        self.dim: Optional[int] = None
+        self.ids: List[str] = []
+        self.id_set: set = set()
+        self.agent_codes: Dict[str, int] = {}
+        self.agent_rows: List[int] = []
+        self.agent_array = None
+        self.matrix = None
+        self.ids_offset = 0  # bytes of the ids file already loaded
+        self.lock = threading.Lock()
+        self.searches = 0
+        self.search_ms_total = 0.0
+        self.last_search_ms = 0.0
+        self.injections = 0
+        self.embed_failures = 0
+        self.abandoned = 0
+        self.dropped = 0
+    
+    def __len__(self) -> int:
+        return len(self.ids)
+    
+    def _map(self):
+        count = len(self.ids)
+        self.matrix = np.memmap(self.vectors_path, dtype=np.float32, mode='r',
+                                shape=(count, self.dim)) if count else None
+    
+    def _remember(self, conversation_id: str, agent: str):
+        self.ids.append(conversation_id)
+        self.id_set.add(conversation_id)
+        self.agent_rows.append(self.agent_codes.setdefault(agent, len(self.agent_codes)))
+    
+    def _discard_files(self):
+        for path in (self.vectors_path, self.ids_path, self.meta_path):
+            if os.path.exists(path):
+                os.remove(path)
+    
+    def load(self) -> int:
+        """Map the persisted index; returns the number of rows"""
+        with self.lock:
+            if not os.path.exists(self.meta_path):
+                return 0
+            with open(self.meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            if meta.get("model") != self.model:
+                # Vectors from another embedding model are not comparable
+                logger.info(f"Embedding model changed to {self.model}; rebuilding memory index")
+                self._discard_files()
+                return 0
+            self.dim = meta["dim"]
+            lines = []
+            if os.path.exists(self.ids_path):
+                with open(self.ids_path, 'r', encoding='utf-8') as f:
+                    lines = [line.rstrip("\n").split("\t", 1) for line in f if "\t" in line]
+            row_bytes = 4 * self.dim
+            rows = os.path.getsize(self.vectors_path) // row_bytes if os.path.exists(self.vectors_path) else 0
+            count = min(len(lines), rows)
+            if count != len(lines) or count * row_bytes != (os.path.getsize(self.vectors_path) if rows else 0):
+                # A crash between the two appends leaves them out of step; drop the tail
+                with open(self.vectors_path, 'ab') as f:
+                    f.truncate(count * row_bytes)
+                with open(self.ids_path, 'w', encoding='utf-8') as f:
+                    f.writelines(f"{agent}\t{conversation_id}\n" for agent, conversation_id in lines[:count])
+            for agent, conversation_id in lines[:count]:
+                self._remember(conversation_id, agent)
+            self.ids_offset = os.path.getsize(self.ids_path) if os.path.exists(self.ids_path) else 0
+            self._map()
+            return count
+    
+    def refresh(self) -> int:
+        """Pick up rows another process appended; returns how many were added"""
+        with self.lock:
+            if self.dim is None:
+                if not os.path.exists(self.meta_path):
+                    return 0
+                with open(self.meta_path, 'r', encoding='utf-8') as f:
+                    meta = json.load(f)
+                if meta.get("model") != self.model:
+                    return 0
+                self.dim = meta["dim"]
+            if not os.path.exists(self.ids_path) or not os.path.exists(self.vectors_path):
+                return 0
+            with open(self.ids_path, 'rb') as f:
+                f.seek(self.ids_offset)
+                tail = f.read()
+            # Vectors are written before ids, so every complete id line has its row
+            available = os.path.getsize(self.vectors_path) // (4 * self.dim) - len(self.ids)
+            added = 0
+            for line in tail.split(b"\n")[:-1][:max(0, available)]:
+                self.ids_offset += len(line) + 1
+                agent, _, conversation_id = line.decode('utf-8').partition("\t")
+                if conversation_id:
+                    self._remember(conversation_id, agent)
+                    added += 1
+            if added:
+                self.agent_array = None
+                self._map()
+            return added
+    
+    def add_many(self, items: List[tuple]) -> int:
+        """Append (conversation_id, agent, vector) rows; returns how many were new"""
+        with self.lock:
+            rows, entries = [], []
+            for conversation_id, agent, vector in items:
+                if conversation_id in self.id_set:
+                    continue
+                array = np.asarray(vector, dtype=np.float32)
+                if self.dim is None:
+                    self.dim = int(array.shape[0])
+                    os.makedirs(os.path.dirname(self.meta_path) or ".", exist_ok=True)
+                    with open(self.meta_path, 'w', encoding='utf-8') as f:
+                        json.dump({"model": self.model, "dim": self.dim}, f)
+                if array.shape[0] != self.dim:
+                    continue
+                norm = float(np.linalg.norm(array))
+                rows.append(array / norm if norm else array)
+                entries.append((conversation_id, agent))
+            if not rows:
+                return 0
+            with open(self.vectors_path, 'ab') as f:
+                f.write(np.vstack(rows).astype(np.float32).tobytes())
+            with open(self.ids_path, 'a', encoding='utf-8') as f:
+                f.writelines(f"{agent}\t{conversation_id}\n" for conversation_id, agent in entries)
+            self.ids_offset = os.path.getsize(self.ids_path)
+            for conversation_id, agent in entries:
+                self._remember(conversation_id, agent)
+            self.agent_array = None
+            self._map()
+            return len(rows)
+    
+    def search(self, agent: str, vector: List[float], k: int, min_similarity: float) -> List[tuple]:
+        """Best (conversation_id, similarity) matches among the agent's rows"""
+        query = np.asarray(vector, dtype=np.float32)
+        norm = float(np.linalg.norm(query))
+        if norm:
+            query = query / norm
+        with self.lock:
+            code = self.agent_codes.get(agent)
+            if self.matrix is None or code is None or query.shape[0] != self.dim:
+                return []
+            start_time = time.perf_counter()
+            scores = self.matrix @ query
+            if len(self.agent_codes) > 1:
+                if self.agent_array is None:
+                    self.agent_array = np.asarray(self.agent_rows, dtype=np.int32)
+                scores[self.agent_array != code] = -1.0
+            k = min(k, scores.shape[0])
+            top = np.argpartition(scores, -k)[-k:]
+            top = top[np.argsort(scores[top])[::-1]]
+            matches = [(self.ids[i], float(scores[i])) for i in top if scores[i] >= min_similarity]
+            self.last_search_ms = (time.perf_counter() - start_time) * 1000
+            self.search_ms_total += self.last_search_ms
+            self.searches += 1
+            return matches
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": True,
+            "entries": len(self.ids),
+            "dimensions": self.dim,
+            "embedding_model": self.model,
+            "index_bytes": len(self.ids) * 4 * (self.dim or 0),
+            "queued": memory_index_queue.qsize(),
+            "dropped": self.dropped,
+            "embed_failures": self.embed_failures,
+            "retrying": len(memory_index_attempts),
+            "abandoned": self.abandoned,
+            "searches": self.searches,
+            "injections": self.injections,
+            "avg_search_ms": round(self.search_ms_total / self.searches, 3) if self.searches else 0.0,
+            "last_search_ms": round(self.last_search_ms, 3),
+            "top_k": MEMORY_TOP_K,
+            "min_similarity": MEMORY_MIN_SIMILARITY,
+            "token_budget": MEMORY_TOKEN_BUDGET
+        }
+
+memory_index = ConversationVectorIndex(
+    MEMORY_INDEX_PATH, MEMORY_EMBEDDING_MODEL) if MEMORY_RETRIEVAL_ENABLED and np is not None else None
+# Conversations waiting to be embedded: (conversation_id, agent, user_input)
+memory_index_queue: asyncio.Queue = asyncio.Queue(maxsize=MEMORY_INDEX_QUEUE_SIZE)
+# Failed embedding attempts per conversation id, while it waits for a retry
+memory_index_attempts: Dict[str, int] = {}
+
+def queue_memory_indexing(conversation_id: str, agent: str, user_input: str):
+    """Hand a freshly generated exchange to the indexing worker"""
+    # With several workers the leader picks new rows up from the database instead
+    if memory_index is None or MULTI_WORKER:
+        return
+    try:
+        memory_index_queue.put_nowait((conversation_id, agent, user_input))
+    except asyncio.QueueFull:
+        memory_index.dropped += 1
+
+async def memory_index_loop():
+    """Embed queued conversations and append them to the index in small batches"""
+    while True:
+        batch = [await memory_index_queue.get()]
+        while len(batch) < 32 and not memory_index_queue.empty():
+            batch.append(memory_index_queue.get_nowait())
+        items = []
+        for item in batch:
+            conversation_id, agent, text = item
+            vector = await embed_text(text, MEMORY_EMBEDDING_MODEL)
+            if vector is None:
+                memory_index.embed_failures += 1
+                retry_memory_indexing(item)
+                continue
+            memory_index_attempts.pop(conversation_id, None)
+            items.append((conversation_id, agent, vector))
+        if items:
+            try:
+                await asyncio.to_thread(memory_index.add_many, items)
+            except Exception as e:
+                logger.error(f"Failed to append to memory index: {e}")
+
+def retry_memory_indexing(item: tuple):
+    """Queue a conversation whose embedding failed again later, or give up after MEMORY_INDEX_MAX_ATTEMPTS"""
+    conversation_id = item[0]
+    attempts = memory_index_attempts.get(conversation_id, 0) + 1
+    if attempts >= MEMORY_INDEX_MAX_ATTEMPTS:
+        memory_index_attempts.pop(conversation_id, None)
+        memory_index.abandoned += 1
+        logger.warning(f"Not indexing {conversation_id} after {attempts} failed embeddings")
+        return
+    memory_index_attempts[conversation_id] = attempts
+    asyncio.get_running_loop().call_later(10 * attempts, _requeue_memory_indexing, item)
+
+def _requeue_memory_indexing(item: tuple):
+    try:
+        memory_index_queue.put_nowait(item)
+    except asyncio.QueueFull:
+        memory_index_attempts.pop(item[0], None)
+        memory_index.dropped += 1
+
+def max_conversation_rowid() -> int:
+    with db_read_pool.connection() as conn:
+        return conn.execute("SELECT COALESCE(MAX(rowid), 0) FROM conversations").fetchone()[0]
+
+def fetch_unindexed_conversations(limit: int, max_rowid: Optional[int] = None) -> List[tuple]:
+    """Newest conversations (up to max_rowid) missing from the memory index, as (id, agent, user_input)"""
+    where, params = ("WHERE rowid <= ?", [max_rowid]) if max_rowid is not None else ("", [])
+    with db_read_pool.connection() as conn:
+        rows = conn.execute(
+            f"SELECT id, agent, user_input FROM conversations {where} ORDER BY timestamp DESC LIMIT ?",
+            params + [limit]
+        ).fetchall()
+    return [(row['id'], row['agent'], row['user_input']) for row in rows if row['id'] not in memory_index.id_set]
+
+def fetch_conversations_after(rowid: int, limit: int) -> tuple:
+    """Conversations written after `rowid`: (last rowid read, [(id, agent, user_input)])
+
+    Rows get increasing rowids in commit order, unlike timestamps, which the
+    write-behind queue assigns before the row is committed.
+    """
+    with db_read_pool.connection() as conn:
+        rows = conn.execute(
+            "SELECT rowid, id, agent, user_input FROM conversations WHERE rowid > ? ORDER BY rowid LIMIT ?",
+            (rowid, limit)
+        ).fetchall()
+    if not rows:
+        return rowid, []
+    return rows[-1][0], [(row['id'], row['agent'], row['user_input']) for row in rows]
+
+async def backfill_memory_index(max_rowid: Optional[int] = None):
+    """Queue history written before retrieval was enabled (or while it was off)"""
+    pending = await run_db(fetch_unindexed_conversations, MEMORY_BACKFILL_LIMIT, max_rowid)
+    if pending:
+        logger.info(f"Backfilling memory index with {len(pending)} conversations")
+    for item in pending:
+        await memory_index_queue.put(item)
+
+async def memory_index_sync_loop():
+    """Leader-only: queue conversations any worker wrote since the last pass
+
+    Each pass reads only the rows after the last one it saw (by rowid), so
+    conversations whose embedding failed are not read again; they are
+    retried through retry_memory_indexing instead.
+    """
+    high_water = await run_db(max_conversation_rowid)
+    await backfill_memory_index(high_water)
+    while True:
+        await asyncio.sleep(10)
+        if not memory_index_queue.empty():
+            continue  # the last pass is still being embedded
+        try:
+            high_water, pending = await run_db(fetch_conversations_after, high_water, MEMORY_INDEX_QUEUE_SIZE)
+        except Exception as e:
+            logger.warning(f"Memory index sync failed: {e}")
+            continue
+        for item in pending:
+            if item[0] not in memory_index.id_set:
+                await memory_index_queue.put(item)
+
+def fetch_conversation_texts(conversation_ids: List[str]) -> Dict[str, Dict[str, str]]:
+    placeholders = ", ".join("?" for _ in conversation_ids)
+    with db_read_pool.connection() as conn:
+        rows = conn.execute(
+            f"SELECT id, user_input, ai_response FROM conversations WHERE id IN ({placeholders})",
+            conversation_ids
+        ).fetchall()
+    return {row['id']: {"user_input": row['user_input'], "ai_response": row['ai_response']} for row in rows}
+
+async def augment_prompt_with_memories(agent: str, user_input: str, prompt: str) -> tuple:
+    """Prefix the prompt with the agent's most similar past exchanges
+
+    Matches are added best-first while they fit MEMORY_TOKEN_BUDGET.
+    Returns (prompt, ids of the recalled conversations); the prompt comes
+    back unchanged with no ids when retrieval is off, the embedding fails
+    or nothing is similar enough. Rows removed by retention are skipped.
+    """
+    if memory_index is None or not len(memory_index):
+        return prompt, []
+    try:
+        vector = await embed_text(user_input, MEMORY_EMBEDDING_MODEL)
+        if vector is None:
+            memory_index.embed_failures += 1
+            return prompt, []
+        matches = await asyncio.to_thread(memory_index.search, agent, vector, MEMORY_TOP_K, MEMORY_MIN_SIMILARITY)
+        if not matches:
+            return prompt, []
+        texts = await run_db(fetch_conversation_texts, [conversation_id for conversation_id, _ in matches])
+    except Exception as e:
+        logger.warning(f"Memory retrieval failed: {e}")
+        return prompt, []
+    
+    exchanges, recalled, used = [], [], 0
+    for conversation_id, _ in matches:
+        row = texts.get(conversation_id)
+        if row is None:
+            continue
+        exchange = f"User: {row['user_input']}\nAssistant: {row['ai_response']}"
+        tokens = count_tokens(exchange)
+        if used + tokens > MEMORY_TOKEN_BUDGET:
+            continue
+        exchanges.append(exchange)
+        recalled.append(conversation_id)
+        used += tokens
+    if not exchanges:
+        return prompt, []
+    memory_index.injections += 1
+    return "Relevant past conversations (may be outdated):\n\n" + "\n\n".join(exchanges) + f"\n\n{prompt}", recalled
+
+# (cache key, agent) -> key of the last memory-augmented generation for that prompt
+recalled_generation_keys: "OrderedDict[tuple, str]" = OrderedDict()
+
+async def recall_for_generation(cache_key: str, agent: str, user_input: str, prompt: str) -> tuple:
+    """Key and prompt for a generation after a cache miss, with recalled memories when any
+
+    Joining a generation already in flight for the plain prompt skips
+    retrieval. With memories the key also names the agent and the recalled
+    conversations, so one agent's history is never served to another from
+    the cache or a shared generation. The agent's last augmented answer to
+    the same prompt is looked up first, so a repeat that is still cached
+    costs no embedding. Returns (key, prompt, cached response).
+    """
+    if memory_index is None or cache_key in inflight_generations or cache_key in inflight_streams:
+        return cache_key, prompt, None
+    previous_key = recalled_generation_keys.get((cache_key, agent))
+    if previous_key is not None:
+        cached = await get_cached_response(previous_key)
+        if cached is not None:
+            return previous_key, prompt, cached
+    augmented, recalled = await augment_prompt_with_memories(agent, user_input, prompt)
+    if not recalled:
+        return cache_key, prompt, None
+    memory_key = hashlib.md5(f"{cache_key}_{agent}_{','.join(recalled)}".encode()).hexdigest()
+    recalled_generation_keys[(cache_key, agent)] = memory_key
+    recalled_generation_keys.move_to_end((cache_key, agent))
+    while len(recalled_generation_keys) > 1000:
+        recalled_generation_keys.popitem(last=False)
+    return memory_key, augmented, await get_cached_response(memory_key)
+
+# Token usage
+TOKEN_PATTERN = re.compile(r"[A-Za-z]+|\d+|\n+|[ \t\r\f\v]+|[^\x00-\x7F]+|.", re.DOTALL)
+# Digest of a counted text -> its token count; digests keep large prompts from being held in memory
+token_count_cache: "OrderedDict[bytes, int]" = OrderedDict()
+token_count_lock = threading.Lock()
+
+def count_tokens(text: str) -> int:
+    """Approximate a BPE/SentencePiece token count when Ollama did not report one
+
+    Latin words cost about one token per four letters, digits one per three,
+    and non-ASCII runs (Bengali, CJK, emoji) one per four UTF-8 bytes, which
+    tracks subword vocabularies far better than counting words. The last
+    TOKENIZER_CACHE_SIZE results are remembered by digest, since the same
+    system prompt and messages are counted again and again.
+    """
+    digest = hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+    with token_count_lock:
+        tokens = token_count_cache.get(digest)
+        if tokens is not None:
+            token_count_cache.move_to_end(digest)
+            return tokens
+    tokens = _count_tokens(text)
+    with token_count_lock:
+        token_count_cache[digest] = tokens
+        while len(token_count_cache) > TOKENIZER_CACHE_SIZE:
+            token_count_cache.popitem(last=False)
+    return tokens
+
+def _count_tokens(text: str) -> int:
+    tokens = 0
+    for match in TOKEN_PATTERN.finditer(text):
+        piece = match.group()
+        first = piece[0]
+        if first.isascii() and first.isalpha():
+            tokens += (len(piece) + 3) // 4
+        elif first.isdigit() and first.isascii():
+            tokens += (len(piece) + 2) // 3
+        elif first == "\n":
+            tokens += 1
+        elif first in " \t\r\f\v":
+            continue
+        elif not first.isascii():
+            tokens += (len(piece.encode("utf-8")) + 3) // 4
+        else:
+            tokens += 1
+    return tokens
+
+def estimate_prompt_tokens(payload: Dict[str, Any]) -> int:
+    """Fallback token count for everything sent in an Ollama payload"""
+    if "messages" in payload:
+        return sum(count_tokens(message.get("content", "")) for message in payload["messages"])
+    return count_tokens(payload.get("prompt", ""))
+
+def token_counts(payload: Dict[str, Any], completion: str, result: Optional[Dict[str, Any]]) -> tuple:
+    """(prompt_tokens, completion_tokens, estimated) from Ollama's counts, estimating what is missing"""
+    result = result or {}
+    prompt_tokens = result.get("prompt_eval_count")
+    completion_tokens = result.get("eval_count")
+    estimated = prompt_tokens is None or completion_tokens is None
+    if prompt_tokens is None:
+        prompt_tokens = estimate_prompt_tokens(payload)
+    if completion_tokens is None:
+        completion_tokens = count_tokens(completion)
+    return prompt_tokens, completion_tokens, estimated
+
+USAGE_COLUMNS = ("requests", "cached_requests", "prompt_tokens", "completion_tokens", "cached_tokens",
+                 "estimated_requests", "latency_ms")
+
+def fetch_token_usage(days: int, agent: Optional[str] = None, model: Optional[str] = None,
+                      by_day: bool = True) -> List[Dict[str, Any]]:
+    """Usage aggregates for the last `days` UTC days, per day or totalled over the window"""
+    since = (datetime.now(timezone.utc) - timedelta(days=max(days, 1) - 1)).strftime("%Y-%m-%d")
+    group = ["day", "agent", "model"] if by_day else ["agent", "model"]
+    query = (f"SELECT {', '.join(group)}, {', '.join(f'SUM({column}) AS {column}' for column in USAGE_COLUMNS)} "
+             "FROM token_usage WHERE day >= ?")
+    params: List[Any] = [since]
+    if agent:
+        query += " AND agent = ?"
+        params.append(agent)
+    if model:
+        query += " AND model = ?"
+        params.append(model)
+    query += f" GROUP BY {', '.join(group)} ORDER BY {', '.join(group)}"
+    
+    with db_read_pool.connection() as conn:
+        rows = conn.execute(query, params).fetchall()
+    usage = []
+    for row in rows:
+        item = dict(row)
+        generated = item["requests"] - item["cached_requests"]
+        item["total_tokens"] = item["prompt_tokens"] + item["completion_tokens"]
+        item["avg_latency_ms"] = round(item["latency_ms"] / generated, 1) if generated else None
+        item["tokens_per_second"] = (round(item["completion_tokens"] / (item["latency_ms"] / 1000), 2)
+                                     if item["latency_ms"] else None)
+        usage.append(item)
+    return usage
+
+# Batch persistence
+def create_batch(batch_id: str, items: List[tuple], parallelism: int):
+    """Persist a batch and its (custom_id, request_json) items in one transaction"""
+    with db_write_pool.connection() as conn, conn:
+        conn.execute(
+            "INSERT INTO batches (id, status, created_at, total, parallelism) VALUES (?, 'running', ?, ?, ?)",
+            (batch_id, epoch_ms(), len(items), parallelism)
+        )
+        conn.executemany(
+            "INSERT INTO batch_items (batch_id, idx, custom_id, request) VALUES (?, ?, ?, ?)",
+            ((batch_id, idx, custom_id, request) for idx, (custom_id, request) in enumerate(items))
+        )
+
+def fetch_pending_batch_items(batch_id: str) -> List[tuple]:
+    with db_read_pool.connection() as conn:
+        rows = conn.execute(
+            "SELECT idx, custom_id, request FROM batch_items WHERE batch_id = ? AND status = 'pending' ORDER BY idx",
+            (batch_id,)
+        ).fetchall()
+    return [(row['idx'], row['custom_id'], row['request']) for row in rows]
+
+def store_batch_result(batch_id: str, idx: int, status: str, result: Dict[str, Any], cached: bool, seq: int):
+    start_time = time.perf_counter()
+    with db_write_pool.connection() as conn, conn:
+        conn.execute('''
+            UPDATE batch_items SET status = ?, result = ?, cached = ?, seq = ?, completed_at = ?
+            WHERE batch_id = ? AND idx = ?
+        ''', (status, json.dumps(result, ensure_ascii=False), int(cached), seq, epoch_ms(), batch_id, idx))
+    db_write_seconds.observe(time.perf_counter() - start_time, table="batch_items")
+
+def finish_batch(batch_id: str):
+    with db_write_pool.connection() as conn, conn:
+        conn.execute("UPDATE batches SET status = 'completed', completed_at = ? WHERE id = ?", (epoch_ms(), batch_id))
+
+def get_batch(batch_id: str) -> Optional[Dict[str, Any]]:
+    """Batch metadata with per-status item counts"""
+    with db_read_pool.connection() as conn:
+        batch = conn.execute("SELECT * FROM batches WHERE id = ?", (batch_id,)).fetchone()
+        if batch is None:
+            return None
+        counts = dict(conn.execute(
+            "SELECT status, COUNT(*) FROM batch_items WHERE batch_id = ? GROUP BY status", (batch_id,)
+        ).fetchall())
+        cached = conn.execute(
+            "SELECT COUNT(*) FROM batch_items WHERE batch_id = ? AND cached = 1", (batch_id,)
+        ).fetchone()[0]
+    return {
+        "id": batch["id"],
+        "object": "batch",
+        "status": batch["status"],
+        "created_at": epoch_ms_to_iso(batch["created_at"]),
+        "completed_at": epoch_ms_to_iso(batch["completed_at"]) if batch["completed_at"] else None,
+        "parallelism": batch["parallelism"],
+        "request_counts": {
+            "total": batch["total"],
+            "completed": counts.get("completed", 0),
+            "failed": counts.get("failed", 0),
+            "pending": counts.get("pending", 0),
+            "cached": cached
+        }
+    }
+
+def fetch_batch_results(batch_id: str, after_seq: int, limit: int) -> List[Dict[str, Any]]:
+    """Finished items in completion order after `after_seq` (served by idx_batch_items_seq)"""
+    with db_read_pool.connection() as conn:
+        rows = conn.execute('''
+            SELECT idx, custom_id, status, result, cached, seq FROM batch_items
+            WHERE batch_id = ? AND seq > ? ORDER BY seq LIMIT ?
+        ''', (batch_id, after_seq, limit)).fetchall()
+    results = []
+    for row in rows:
+        result = json.loads(row['result'])
+        item = {"seq": row['seq'], "index": row['idx'], "custom_id": row['custom_id'], "status": row['status'],
+                "cached": bool(row['cached'])}
+        item["response" if row['status'] == 'completed' else "error"] = result
+        results.append(item)
+    return results
+
+def unfinished_batches() -> List[tuple]:
+    """(batch_id, parallelism, last_seq) for batches interrupted by a restart"""
+    with db_read_pool.connection() as conn:
+        rows = conn.execute('''
+            SELECT b.id, b.parallelism, COALESCE(MAX(i.seq), 0) AS last_seq
+            FROM batches b LEFT JOIN batch_items i ON i.batch_id = b.id
+            WHERE b.status = 'running' GROUP BY b.id
+        ''').fetchall()
+    return [(row['id'], row['parallelism'], row['last_seq']) for row in rows]
+
+# Ollama admission scheduler
+class SchedulerRejected(Exception):
+    """Raised when a generation cannot be admitted; carries the HTTP status to return"""
+    
+    def __init__(self, status_code: int, detail: str, retry_after: int = 5):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+class OllamaScheduler:
+    """Per-model concurrency limiter with a bounded priority queue
+
+    At most `limit` generations run per model. Extra requests wait in a
+    heap ordered by (priority, arrival); a finished generation hands its
+    slot directly to the best waiter. A full queue is rejected with 429,
+    and a waiter past its priority's deadline with 503, so clients back off
+    instead of all timing out together. With several workers the limit is
+    server-wide: a locally admitted request also takes one of the model's
+    shared slots, polling until another worker frees one.
+    """
+    
+    def __init__(self, default_limit: int, model_limits: Dict[str, int], max_queue: int,
+                 queue_timeouts: Dict[int, float]):
+        self.default_limit = default_limit
+        self.model_limits = model_limits
+        self.max_queue = max_queue
+        self.queue_timeouts = queue_timeouts
+        self.models: Dict[str, Dict[str, Any]] = {}
+        self.sequence = 0
+    
+    def _state(self, model: str) -> Dict[str, Any]:
+        state = self.models.get(model)
+        if state is None:
+            state = self.models[model] = {
+                "limit": self.model_limits.get(model, self.default_limit),
+                "running": 0,
+                "waiters": [],
+                "admitted": 0,
+                "rejected_queue_full": 0,
+                "rejected_deadline": 0,
+                "total_wait": 0.0,
+                "max_wait": 0.0
+            }
+        return state
+    
+    @staticmethod
+    def _queued(state: Dict[str, Any]) -> int:
+        return sum(1 for _, _, future in state["waiters"] if not future.done())
+    
+    def check_admission(self, model: str):
+        """Fail fast with 429 when a new request could not even be queued"""
+        state = self._state(model)
+        if state["running"] >= state["limit"] and self._queued(state) >= self.max_queue:
+            state["rejected_queue_full"] += 1
+            raise SchedulerRejected(429, f"Ollama queue for {model} is full")
+    
+    def _release(self, state: Dict[str, Any]):
+        while state["waiters"]:
+            _, _, future = heapq.heappop(state["waiters"])
+            if not future.done():
+                future.set_result(True)  # Hand the slot over; running count is unchanged
+                return
+        state["running"] -= 1
+    
+    def _admitted(self, state: Dict[str, Any], start: float, model: str, priority: int):
+        waited = time.perf_counter() - start
+        queue_wait_seconds.observe(waited, model=model, priority=PRIORITY_NAMES.get(priority, priority))
+        state["admitted"] += 1
+        state["total_wait"] += waited
+        state["max_wait"] = max(state["max_wait"], waited)
+    
+    @asynccontextmanager
+    async def slot(self, model: str, priority: int = PRIORITY_INTERACTIVE):
+        """Hold one of the model's generation slots for the duration of the block"""
+        state = self._state(model)
+        start = time.perf_counter()
+        
+        if state["running"] < state["limit"] and not self._queued(state):
+            state["running"] += 1
+        else:
+            if self._queued(state) >= self.max_queue:
+                state["rejected_queue_full"] += 1
+                raise SchedulerRejected(429, f"Ollama queue for {model} is full")
+            
+            future = asyncio.get_running_loop().create_future()
+            self.sequence += 1
+            heapq.heappush(state["waiters"], (priority, self.sequence, future))
+            try:
+                await asyncio.wait({future}, timeout=self.queue_timeouts.get(priority, 30.0))
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    self._release(state)
+                else:
+                    future.cancel()
+                raise
+            if not future.done():
+                future.cancel()
+                state["rejected_deadline"] += 1
+                raise SchedulerRejected(503, f"Timed out waiting for an Ollama slot for {model}")
+        
+        shared_slot = None
+        if worker_coordinator is not None:
+            try:
+                shared_slot = await self._shared_slot(model, state, start, priority)
+            except BaseException:
+                self._release(state)
+                raise
+        self._admitted(state, start, model, priority)
+        try:
+            yield
+        finally:
+            self._release(state)
+            if shared_slot is not None:
+                await asyncio.to_thread(worker_coordinator.release_slot, model, shared_slot)
+    
+    async def _shared_slot(self, model: str, state: Dict[str, Any], start: float, priority: int) -> int:
+        """Wait for a server-wide slot, backing off up to SHARED_POLL_MAX_SECONDS between tries"""
+        deadline = start + self.queue_timeouts.get(priority, 30.0)
+        delay = 0.05
+        while True:
+            slot = await asyncio.to_thread(worker_coordinator.acquire_slot, model, state["limit"])
+            if slot is not None:
+                return slot
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                state["rejected_deadline"] += 1
+                raise SchedulerRejected(503, f"Timed out waiting for an Ollama slot for {model}")
+            await asyncio.sleep(min(delay, remaining))
+            delay = min(delay * 2, SHARED_POLL_MAX_SECONDS)
+    
+    def stats(self) -> Dict[str, Any]:
+        models = {}
+        for model, state in self.models.items():
+            models[model] = {
+                "limit": state["limit"],
+                "running": state["running"],
+                "queued": self._queued(state),
+                "admitted": state["admitted"],
+                "rejected_queue_full": state["rejected_queue_full"],
+                "rejected_deadline": state["rejected_deadline"],
+                "avg_wait_ms": round(state["total_wait"] / state["admitted"] * 1000, 2) if state["admitted"] else 0.0,
+                "max_wait_ms": round(state["max_wait"] * 1000, 2)
+            }
+        return {
+            "max_concurrency_per_model": self.default_limit,
+            "max_queue_per_model": self.max_queue,
+            "queue_timeouts_seconds": {"interactive": self.queue_timeouts[PRIORITY_INTERACTIVE],
+                                       "background": self.queue_timeouts[PRIORITY_BACKGROUND],
+                                       "batch": self.queue_timeouts[PRIORITY_BATCH]},
+            "models": models
+        }
+
+ollama_scheduler = OllamaScheduler(MAX_CONCURRENCY_PER_MODEL, MODEL_CONCURRENCY, MAX_QUEUE_PER_MODEL, QUEUE_TIMEOUTS)
+
+def generation_error(result: Dict[str, Any]) -> HTTPException:
+    """Map a failed generation to an HTTPException, keeping scheduler 429/503 statuses"""
+    status_code = result.get("status_code", 500)
+    headers = {"Retry-After": str(result["retry_after"])} if "retry_after" in result else None
+    return HTTPException(status_code=status_code, detail=result["error"], headers=headers)
+
+def admission_error(e: SchedulerRejected) -> Dict[str, Any]:
+    return {"error": e.detail, "status_code": e.status_code, "retry_after": e.retry_after}
+
+# Ollama integration
+def build_generate_payload(prompt: str, model: str = OLLAMA_MODEL,
+                           context: Optional[List[int]] = None) -> Dict[str, Any]:
+    """Build an /api/generate payload with meta memory injection
+
+    With a session `context` (Ollama's evaluated token array from the
+    previous turn) the system prompt is already in the KV state, so only
+    the new turn is sent.
+    """
+    if context:
+        return {"model": model, "prompt": f"User: {prompt}\n\nAssistant:", "context": context,
+                "keep_alive": keep_alive_for(model)}
+    
+    # Generate system prompt with meta memory
+    system_prompt = generate_system_prompt()
+    
+    # Combine system prompt with user prompt
+    full_prompt = f"{system_prompt}\n\nUser: {prompt}\n\nAssistant:"
+    return {"model": model, "prompt": full_prompt, "keep_alive": keep_alive_for(model)}
+
+def build_chat_payload(messages: List[Dict[str, str]], model: str = OLLAMA_MODEL,
+                       options: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Build an /api/chat payload carrying the full conversation
+
+    The system prompt always comes first and client messages are forwarded
+    verbatim, so consecutive turns share a byte-identical prefix and Ollama
+    can reuse the already-evaluated KV cache instead of re-processing it.
+    """
+    payload = {
+        "model": model,
+        "messages": [{"role": "system", "content": generate_system_prompt()}] + messages,
+        "keep_alive": keep_alive_for(model)
+    }
+    if options:
+        payload["options"] = options
+    return payload
 
-def get_conversation_history(agent: str, limit: int = 10) -> List[Dict]:
-    """Retrieve conversation history for an agent using connection pooling"""
+def _normalize_chat_chunk(chunk: Dict[str, Any]) -> Dict[str, Any]:
+    """Reshape an /api/chat response into the /api/generate shape used downstream"""
+    if "message" not in chunk:
+        return chunk
+    normalized = {key: value for key, value in chunk.items() if key != "message"}
+    normalized["response"] = (chunk.get("message") or {}).get("content", "")
+    return normalized
+
+async def ollama_generate(path: str, payload: Dict[str, Any],
+                          priority: int = PRIORITY_INTERACTIVE) -> Dict[str, Any]:
+    """POST a non-streaming generation to Ollama with proper error handling"""
+    model = payload["model"]
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT id, user_input, ai_response, timestamp, model, context
-            FROM conversations 
-            WHERE agent = ? 
-            ORDER BY timestamp DESC 
-            LIMIT ?
-        ''', (agent, limit))
-        
-        rows = cursor.fetchall()
-        
-        history = []
-        for row in rows:
-            history.append({
-                'id': row[0],
-                'user_input': row[1],
-                'ai_response': row[2],
-                'timestamp': row[3],
-                'model': row[4],
-                'context': json.loads(row[5]) if row[5] else None
-            })
+        async with ollama_scheduler.slot(model, priority):
+            start = time.perf_counter()
+            response = await asyncio.wait_for(
+                ollama_backends.request("POST", path, model=model,
+                                        json={**payload, "stream": False}, timeout=ollama_timeout("generate")),
+                timeout=OLLAMA_TIMEOUTS["generate"]
+            )
         
-        return history
+        if response.status_code == 200:
+            record_model_latency(model, time.perf_counter() - start)
+            result = response.json()
+            observe_ollama_timings(model, result)
+            return _normalize_chat_chunk(result)
+        else:
+            record_model_latency(model, None)
+            logger.error(f"Ollama API error: {response.status_code} - {response.text}")
+            return {"error": f"Ollama API error: {response.status_code}"}
+                
+    except SchedulerRejected as e:
+        logger.warning(f"Ollama generation rejected: {e.detail}")
+        return admission_error(e)
+    except (httpx.TimeoutException, asyncio.TimeoutError):
+        record_model_latency(model, None)
+        logger.error("Ollama API timeout")
+        return {"error": "Ollama API timeout"}
     except Exception as e:
-        logger.error(f"Failed to retrieve conversation history: {e}")
-        return []
+        record_model_latency(model, None)
+        logger.error(f"Ollama API exception: {e}")
+        return {"error": str(e)}
 
-# Ollama integration
-async def call_ollama(prompt: str, model: str = OLLAMA_MODEL) -> Dict[str, Any]:
-    """Call Ollama API with proper error handling and meta memory injection"""
+async def ollama_generate_stream(path: str, payload: Dict[str, Any],
+                                 priority: int = PRIORITY_INTERACTIVE) -> AsyncIterator[Dict[str, Any]]:
+    """Stream Ollama NDJSON chunks as they are generated
+
+    Yields each decoded chunk (in /api/generate shape); on failure a single
+    {"error": ...} dict is yielded and the stream ends. The scheduler slot
+    is held until the stream finishes.
+    """
+    model = payload["model"]
     try:
-        # Generate system prompt with meta memory
-        system_prompt = generate_system_prompt()
-        
-        # Combine system prompt with user prompt
-        full_prompt = f"{system_prompt}\n\nUser: {prompt}\n\nAssistant:"
-        
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            payload = {
-                "model": model,
-                "prompt": full_prompt,
-                "stream": False
-            }
-            
-            response = await client.post(
-                f"{OLLAMA_HOST}/api/generate",
-                json=payload,
-                headers={"Content-Type": "application/json"}
-            )
-            
-            if response.status_code == 200:
-                return response.json()
-            else:
-                logger.error(f"Ollama API error: {response.status_code} - {response.text}")
-                return {"error": f"Ollama API error: {response.status_code}"}
+        async with ollama_scheduler.slot(model, priority):
+            start = time.perf_counter()
+            first_token = None
+            # The read timeout applies per chunk, so long generations only fail if Ollama stalls
+            async with ollama_backends.stream(
+                "POST",
+                path,
+                model=model,
+                json={**payload, "stream": True},
+                timeout=ollama_timeout("generate")
+            ) as response:
+                if response.status_code != 200:
+                    record_model_latency(model, None)
+                    body = await response.aread()
+                    logger.error(f"Ollama API error: {response.status_code} - {body.decode(errors='replace')}")
+                    yield {"error": f"Ollama API error: {response.status_code}"}
+                    return
                 
+                async for line in response.aiter_lines():
+                    if not line.strip():
+                        continue
+                    try:
+                        chunk = json.loads(line)
+                    except json.JSONDecodeError:
+                        logger.warning(f"Skipping malformed Ollama stream line: {line[:80]}")
+                        continue
+                    
+                    if "error" in chunk:
+                        record_model_latency(model, None)
+                        logger.error(f"Ollama stream error: {chunk['error']}")
+                        yield {"error": chunk["error"]}
+                        return
+                    
+                    if first_token is None:
+                        first_token = time.perf_counter() - start
+                    if chunk.get("done"):
+                        record_model_latency(model, time.perf_counter() - start, first_token)
+                        observe_ollama_timings(model, chunk)
+                    yield _normalize_chat_chunk(chunk)
+                    if chunk.get("done"):
+                        return
+                    
+    except SchedulerRejected as e:
+        logger.warning(f"Ollama stream rejected: {e.detail}")
+        yield admission_error(e)
     except httpx.TimeoutException:
+        record_model_latency(model, None)
         logger.error("Ollama API timeout")
-        return {"error": "Ollama API timeout"}
+        yield {"error": "Ollama API timeout"}
     except Exception as e:
+        record_model_latency(model, None)
         logger.error(f"Ollama API exception: {e}")
-        return {"error": str(e)}
+        yield {"error": str(e)}
+
+async def call_ollama(prompt: str, model: str = OLLAMA_MODEL, context: Optional[List[int]] = None,
+                      priority: int = PRIORITY_INTERACTIVE) -> Dict[str, Any]:
+    """Call Ollama API with proper error handling and meta memory injection"""
+    return await ollama_generate("/api/generate", build_generate_payload(prompt, model, context), priority)
+
+async def call_ollama_stream(prompt: str, model: str = OLLAMA_MODEL, context: Optional[List[int]] = None,
+                             priority: int = PRIORITY_INTERACTIVE) -> AsyncIterator[Dict[str, Any]]:
+    """Stream an /api/generate completion chunk by chunk"""
+    async for chunk in ollama_generate_stream("/api/generate", build_generate_payload(prompt, model, context), priority):
+        yield chunk
+
+def format_sse(data: Any) -> str:
+    """Format a payload as a Server-Sent Events data frame"""
+    if not isinstance(data, str):
+        data = json.dumps(data, ensure_ascii=False)
+    return f"data: {data}\n\n"
+
+# Request coalescing
+class InflightStream:
+    """Buffered Ollama token stream shared by concurrent identical requests
+
+    A background task drives the generation and appends every chunk to a
+    buffer; each subscriber replays the buffer from the start and then
+    follows new chunks, so late joiners receive the full answer.
+    """
+    
+    def __init__(self, cache_key: str, path: str, payload: Dict[str, Any], priority: int = PRIORITY_INTERACTIVE):
+        self.cache_key = cache_key
+        self.chunks: List[Dict[str, Any]] = []
+        self.done = False
+        self.subscribers = 0
+        self.changed = asyncio.Condition()
+        self.task = asyncio.create_task(self._run(path, payload, priority))
+    
+    async def _run(self, path: str, payload: Dict[str, Any], priority: int):
+        parts = []
+        model_used = payload["model"]
+        final_chunk = {}
+        failed = False
+        try:
+            async for chunk in ollama_generate_stream(path, payload, priority):
+                if "error" in chunk:
+                    failed = True
+                else:
+                    model_used = chunk.get("model", model_used)
+                    parts.append(chunk.get("response", ""))
+                    if chunk.get("done"):
+                        final_chunk = chunk
+                async with self.changed:
+                    self.chunks.append(chunk)
+                    self.changed.notify_all()
+            
+            if not failed:
+                set_cached_response(self.cache_key, {
+                    **final_chunk,
+                    "response": "".join(parts) or "No response generated",
+                    "model": model_used
+                })
+        except asyncio.CancelledError:
+            self.chunks.append({"error": "Generation cancelled"})
+            raise
+        finally:
+            if inflight_streams.get(self.cache_key) is self:
+                del inflight_streams[self.cache_key]
+            async with self.changed:
+                self.done = True
+                self.changed.notify_all()
+    
+    async def subscribe(self) -> AsyncIterator[Dict[str, Any]]:
+        """Yield every chunk of the shared generation, replaying buffered ones first"""
+        self.subscribers += 1
+        index = 0
+        try:
+            while True:
+                async with self.changed:
+                    while index >= len(self.chunks) and not self.done:
+                        await self.changed.wait()
+                    pending = self.chunks[index:]
+                    index = len(self.chunks)
+                    finished = self.done
+                
+                for chunk in pending:
+                    yield chunk
+                if finished:
+                    return
+        finally:
+            self.subscribers -= 1
+            # Stop generating once every client has gone away
+            if self.subscribers == 0 and not self.done:
+                self.task.cancel()
+
+async def _generate_and_cache(cache_key: str, path: str, payload: Dict[str, Any], priority: int) -> Dict[str, Any]:
+    shared = worker_coordinator is not None and persistent_cache is not None
+    if shared:
+        stored = await wait_for_shared_generation(cache_key)
+        if stored is not None:
+            response_cache.set(cache_key, stored)
+            return stored
+    try:
+        result = await ollama_generate(path, payload, priority)
+        if "error" not in result:
+            set_cached_response(cache_key, result)
+        return result
+    finally:
+        if shared:
+            # Waiting workers read the result from the shared tier, so write it before letting go
+            await asyncio.to_thread(persistent_cache.flush)
+            await asyncio.to_thread(worker_coordinator.release, f"gen:{cache_key}")
+
+async def generate_coalesced(cache_key: str, path: str, payload: Dict[str, Any],
+                             priority: int = PRIORITY_INTERACTIVE) -> Dict[str, Any]:
+    """Run an Ollama generation once per cache key, sharing the result with concurrent callers"""
+    stream = inflight_streams.get(cache_key)
+    if stream is not None:
+        coalescing_stats["followers"] += 1
+        parts = []
+        model_used = payload["model"]
+        async for chunk in stream.subscribe():
+            if "error" in chunk:
+                return {"error": chunk["error"]}
+            model_used = chunk.get("model", model_used)
+            parts.append(chunk.get("response", ""))
+        return {"response": "".join(parts), "model": model_used, "done": True}
+    
+    task = inflight_generations.get(cache_key)
+    if task is None:
+        coalescing_stats["leaders"] += 1
+        task = asyncio.create_task(_generate_and_cache(cache_key, path, payload, priority))
+        inflight_generations[cache_key] = task
+        
+        def _forget(finished: asyncio.Task):
+            if inflight_generations.get(cache_key) is finished:
+                del inflight_generations[cache_key]
+        task.add_done_callback(_forget)
+    else:
+        coalescing_stats["followers"] += 1
+        cache_logger.info(f"Joining in-flight generation for key: {cache_key[:8]}...")
+    
+    # Shield so one cancelled client does not abort the generation for the others
+    return await asyncio.shield(task)
+
+async def stream_coalesced(cache_key: str, path: str, payload: Dict[str, Any],
+                           priority: int = PRIORITY_INTERACTIVE) -> AsyncIterator[Dict[str, Any]]:
+    """Stream a generation once per cache key, fanning chunks out to concurrent callers"""
+    task = inflight_generations.get(cache_key)
+    if task is not None:
+        coalescing_stats["followers"] += 1
+        yield await asyncio.shield(task)
+        return
+    
+    stream = inflight_streams.get(cache_key)
+    if stream is None:
+        coalescing_stats["leaders"] += 1
+        stream = InflightStream(cache_key, path, payload, priority)
+        inflight_streams[cache_key] = stream
+    else:
+        coalescing_stats["followers"] += 1
+        cache_logger.info(f"Joining in-flight stream for key: {cache_key[:8]}...")
+    
+    async for chunk in stream.subscribe():
+        yield chunk
+
+# Multi-turn session context
+def get_session_context(session_id: str, model: str) -> Optional[List[int]]:
+    """Return the stored Ollama context for a session if it is fresh and for this model"""
+    with session_lock:
+        session = session_contexts.get(session_id)
+        if session is None:
+            return None
+        if session['model'] != model or time.time() - session['updated_at'] > SESSION_TTL:
+            del session_contexts[session_id]
+            return None
+        session_contexts.move_to_end(session_id)
+        return session['context']
+
+def store_session_context(session_id: str, model: str, context: List[int]):
+    """Remember Ollama's evaluated context so the next turn skips re-processing it"""
+    with session_lock:
+        session_contexts[session_id] = {
+            'model': model,
+            'context': context,
+            'turns': session_contexts.get(session_id, {}).get('turns', 0) + 1,
+            'updated_at': time.time()
+        }
+        session_contexts.move_to_end(session_id)
+        while len(session_contexts) > MAX_SESSIONS:
+            session_contexts.popitem(last=False)
+
+def get_session_stats() -> Dict[str, Any]:
+    with session_lock:
+        return {
+            "active_sessions": len(session_contexts),
+            "max_sessions": MAX_SESSIONS,
+            "ttl_seconds": SESSION_TTL,
+            "context_tokens": sum(len(session['context']) for session in session_contexts.values())
+        }
+
+def get_coalescing_stats() -> Dict[str, Any]:
+    """Report in-flight generations and how many requests were deduplicated"""
+    stats = dict(coalescing_stats)
+    stats["inflight_generations"] = len(inflight_generations)
+    stats["inflight_streams"] = len(inflight_streams)
+    return stats
 
 async def check_ollama_health() -> bool:
-    """Check if Ollama server is healthy"""
+    """Probe every Ollama backend now; True when at least one is healthy"""
     try:
-        async with httpx.AsyncClient(timeout=5.0) as client:
-            response = await client.get(f"{OLLAMA_HOST}/api/tags")
-            return response.status_code == 200
+        return await model_catalog.refresh()
     except Exception as e:
         logger.error(f"Ollama health check failed: {e}")
         return False
 
+def catalog_response(request: Request, body: Dict[str, Any]) -> Response:
+    """Serve a model listing with ETag/Last-Modified, answering 304 when the client is current"""
+    etag = f'"{model_catalog.etag}"'
+    last_modified = formatdate(model_catalog.last_modified, usegmt=True)
+    headers = {
+        "ETag": etag,
+        "Last-Modified": last_modified,
+        "Cache-Control": f"max-age={int(model_catalog.ttl)}"
+    }
+    
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        if etag in [tag.strip() for tag in if_none_match.split(",")] or if_none_match.strip() == "*":
+            return Response(status_code=304, headers=headers)
+    elif request.headers.get("if-modified-since"):
+        try:
+            since = parsedate_to_datetime(request.headers["if-modified-since"]).timestamp()
+            if int(model_catalog.last_modified) <= since:
+                return Response(status_code=304, headers=headers)
+        except (TypeError, ValueError):
+            pass
+    
+    return JSONResponse(body, headers=headers)
+
 # API Endpoints
 @app.get("/health", response_model=HealthResponse)
 async def health_check():
-    """Health check endpoint"""
-    ollama_healthy = await check_ollama_health()
+    """Health check endpoint, answered from the background Ollama probe"""
+    ollama_healthy = model_catalog.healthy
     memory_healthy = os.path.exists(MEMORY_PATH)
     
     return HealthResponse(
@@ -388,70 +4087,106 @@ async def health_check():
     )
 
 @app.get("/models")
-async def get_models():
-    """Get available models from Ollama"""
+async def get_models(request: Request):
+    """Get available models from the cached Ollama catalog"""
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            response = await client.get(f"{OLLAMA_HOST}/api/tags")
-            if response.status_code == 200:
-                data = response.json()
-                models = []
-                for model in data.get('models', []):
-                    models.append(ModelInfo(
-                        name=model['name'],
-                        size=model['size'],
-                        modified_at=model['modified_at']
-                    ))
-                return {"models": models}
-            else:
-                raise HTTPException(status_code=500, detail="Failed to fetch models")
+        catalog = await model_catalog.get()
+        if catalog is None:
+            raise HTTPException(status_code=500, detail="Failed to fetch models")
+        models = []
+        for model in catalog:
+            models.append({
+                "name": model['name'],
+                "size": model['size'],
+                "modified_at": model['modified_at']
+            })
+        return catalog_response(request, {"models": models})
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Failed to get models: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+def build_chat_prompt(request: ChatRequest) -> str:
+    """Combine chat input with optional context into the Ollama prompt"""
+    prompt = request.input
+    if request.context:
+        # sort_keys keeps the prompt (and its cache key) stable however the client orders keys
+        context_str = json.dumps(request.context, indent=2, sort_keys=True)
+        prompt = f"Context: {context_str}\n\nUser Input: {request.input}"
+    return prompt
+
 @app.post("/chat", response_model=ChatResponse)
 async def chat(request: ChatRequest):
     """Main chat endpoint with caching optimization"""
     try:
         # Generate conversation ID
-        conversation_id = f"conv_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{hash(request.input) % 10000}"
+        conversation_id = new_conversation_id("conv", request.input)
         
         # Prepare prompt with context
-        prompt = request.input
-        if request.context:
-            context_str = json.dumps(request.context, indent=2)
-            prompt = f"Context: {context_str}\n\nUser Input: {request.input}"
+        prompt = build_chat_prompt(request)
+        model = resolve_model(request.model, request.input)
+        
+        # Follow-up turns in a session depend on its context, so they bypass the shared cache
+        session_context = get_session_context(request.session_id, model) if request.session_id else None
         
         # Check cache first
-        cache_key = get_cache_key(prompt, OLLAMA_MODEL)
-        cached_response = get_cached_response(cache_key)
+        cache_key = get_cache_key(prompt, model)
+        generation_key, generation_prompt = cache_key, prompt
+        cached_response = None
+        if session_context is None:
+            cached_response = await lookup_cached_response(cache_key, prompt, model)
+            if not cached_response:
+                # Past conversations are only recalled for a generation that has to run
+                generation_key, generation_prompt, cached_response = await recall_for_generation(
+                    cache_key, request.agent, request.input, prompt)
+        
+        payload = build_generate_payload(generation_prompt, model, session_context)
         
         if cached_response:
-            logger.info(f"Returning cached response for: {conversation_id}")
+            cache_logger.info(f"Returning cached response for: {conversation_id}")
+            prompt_tokens, completion_tokens, estimated = token_counts(
+                payload, cached_response.get("response", ""), cached_response)
+            save_conversation(
+                conversation_id=conversation_id,
+                agent=request.agent,
+                user_input=request.input,
+                ai_response=cached_response.get("response", "No response generated"),
+                model=cached_response.get("model", model),
+                context=request.context,
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens,
+                latency_ms=0,
+                cached=True,
+                estimated=estimated
+            )
             return ChatResponse(
                 id=conversation_id,
                 author="Hello Zombie (Cached)",
                 text=cached_response.get("response", "No response generated"),
                 timestamp=datetime.now().isoformat(),
-                model=cached_response.get("model", OLLAMA_MODEL),
+                model=cached_response.get("model", model),
                 success=True
             )
         
         # Call Ollama if not cached
-        logger.info(f"Processing chat request: {conversation_id}")
+        request_logger.info(f"Processing chat request: {conversation_id}")
         start_time = time.time()
-        ollama_response = await call_ollama(prompt, OLLAMA_MODEL)
+        if session_context is None:
+            ollama_response = await generate_coalesced(generation_key, "/api/generate", payload)
+        else:
+            ollama_response = await ollama_generate("/api/generate", payload)
         response_time = time.time() - start_time
         
         if "error" in ollama_response:
-            raise HTTPException(status_code=500, detail=ollama_response["error"])
+            raise generation_error(ollama_response)
         
-        # Extract response
+        # Extract response (cached by the coalescing layer)
         ai_response = ollama_response.get("response", "No response generated")
-        model_used = ollama_response.get("model", OLLAMA_MODEL)
-        
-        # Cache the response
-        set_cached_response(cache_key, ollama_response)
+        model_used = ollama_response.get("model", model)
+        if request.session_id and ollama_response.get("context"):
+            store_session_context(request.session_id, model, ollama_response["context"])
+        prompt_tokens, completion_tokens, estimated = token_counts(payload, ai_response, ollama_response)
         
         # Save to memory
         save_conversation(
@@ -460,10 +4195,14 @@ async def chat(request: ChatRequest):
             user_input=request.input,
             ai_response=ai_response,
             model=model_used,
-            context=request.context
+            context=request.context,
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            latency_ms=int(response_time * 1000),
+            estimated=estimated
         )
         
-        logger.info(f"Response generated in {response_time:.2f}s for: {conversation_id}")
+        request_logger.info(f"Response generated in {response_time:.2f}s for: {conversation_id}")
         
         # Return response
         return ChatResponse(
@@ -481,6 +4220,120 @@ async def chat(request: ChatRequest):
         logger.error(f"Chat endpoint error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/chat/stream")
+async def chat_stream(request: ChatRequest):
+    """Streaming chat endpoint relaying Ollama tokens as Server-Sent Events"""
+    conversation_id = new_conversation_id("conv", request.input)
+    prompt = build_chat_prompt(request)
+    model = resolve_model(request.model, request.input)
+    cache_key = get_cache_key(prompt, model)
+    session_context = get_session_context(request.session_id, model) if request.session_id else None
+    
+    cached_response = None
+    if session_context is None:
+        cached_response = await lookup_cached_response(cache_key, prompt, model)
+    if not cached_response:
+        # Reject before the 200 status line is sent if the queue is already full
+        try:
+            ollama_scheduler.check_admission(model)
+        except SchedulerRejected as e:
+            raise generation_error(admission_error(e))
+    
+    payload = build_generate_payload(prompt, model, session_context)
+    
+    async def event_stream():
+        response = cached_response
+        generation_key, generation_payload = cache_key, payload
+        if not response and session_context is None:
+            # Past conversations are only recalled for a generation that has to run
+            generation_key, generation_prompt, response = await recall_for_generation(
+                cache_key, request.agent, request.input, prompt)
+            generation_payload = build_generate_payload(generation_prompt, model)
+        
+        if response:
+            cache_logger.info(f"Returning cached streamed response for: {conversation_id}")
+            prompt_tokens, completion_tokens, estimated = token_counts(
+                generation_payload, response.get("response", ""), response)
+            save_conversation(
+                conversation_id=conversation_id,
+                agent=request.agent,
+                user_input=request.input,
+                ai_response=response.get("response", "No response generated"),
+                model=response.get("model", model),
+                context=request.context,
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens,
+                latency_ms=0,
+                cached=True,
+                estimated=estimated
+            )
+            yield format_sse({
+                "id": conversation_id,
+                "author": "Hello Zombie (Cached)",
+                "text": response.get("response", "No response generated"),
+                "model": response.get("model", model),
+                "done": False
+            })
+            yield format_sse({"id": conversation_id, "done": True, "success": True})
+            return
+        
+        request_logger.info(f"Processing streaming chat request: {conversation_id}")
+        start_time = time.time()
+        parts = []
+        model_used = model
+        final_chunk = {}
+        
+        if session_context is None:
+            chunks = stream_coalesced(generation_key, "/api/generate", generation_payload)
+        else:
+            chunks = ollama_generate_stream("/api/generate", payload)
+        
+        async for chunk in chunks:
+            if "error" in chunk:
+                yield format_sse({"id": conversation_id, "error": chunk["error"], "done": True, "success": False})
+                return
+            
+            if chunk.get("done"):
+                final_chunk = chunk
+            model_used = chunk.get("model", model_used)
+            text = chunk.get("response", "")
+            if text:
+                parts.append(text)
+                yield format_sse({
+                    "id": conversation_id,
+                    "author": "Hello Zombie",
+                    "text": text,
+                    "model": model_used,
+                    "done": False
+                })
+        
+        ai_response = "".join(parts) or "No response generated"
+        if request.session_id and final_chunk.get("context"):
+            store_session_context(request.session_id, model, final_chunk["context"])
+        prompt_tokens, completion_tokens, estimated = token_counts(generation_payload, ai_response, final_chunk)
+        save_conversation(
+            conversation_id=conversation_id,
+            agent=request.agent,
+            user_input=request.input,
+            ai_response=ai_response,
+            model=model_used,
+            context=request.context,
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            latency_ms=int((time.time() - start_time) * 1000),
+            estimated=estimated
+        )
+        request_logger.info(f"Streamed response generated in {time.time() - start_time:.2f}s for: {conversation_id}")
+        yield format_sse({
+            "id": conversation_id,
+            "timestamp": datetime.now().isoformat(),
+            "model": model_used,
+            "done": True,
+            "success": True
+        })
+    
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
 @app.post("/agents/configure")
 async def configure_agent():
     """Agent configuration endpoint"""
@@ -490,13 +4343,244 @@ async def configure_agent():
         "status": "configured"
     }
 
+@app.post("/agents/reload")
+async def reload_agent():
+    """Reload the agent section and meta memory (system prompt) without restarting"""
+    if not await reload_agents():
+        raise HTTPException(status_code=500, detail="Agent reload failed, previous agent and prompt kept")
+    return {
+        "status": "reloaded",
+        "agent_version": agent_version,
+        "system_prompt_fingerprint": system_prompt_fingerprint(),
+        "restart_required": restart_required,
+        "timestamp": datetime.now().isoformat()
+    }
+
+# Declared before /conversations/{agent_id} so "search" is not taken as an agent id
+@app.get("/conversations/search")
+async def search_conversation_memory(q: str, agent: Optional[str] = None, limit: int = 20,
+                                     offset: int = 0, raw: bool = False):
+    """Full-text search over past conversations, best matches first
+
+    Snippets of user_input and ai_response wrap matched terms in <mark>.
+    Pass the returned next_offset as `offset` for the following page; `raw`
+    accepts FTS5 query syntax (phrases, OR, NEAR, column filters).
+    """
+    limit = max(1, min(limit, MAX_SEARCH_PAGE_SIZE))
+    offset = max(0, offset)
+    try:
+        fts_query = build_fts_query(q, raw)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    await asyncio.to_thread(conversation_writer.flush)
+    start_time = time.perf_counter()
+    try:
+        results, next_offset = await run_db(search_conversations, fts_query, agent, limit, offset)
+    except sqlite3.OperationalError as e:
+        # Malformed raw FTS5 syntax surfaces here
+        if raw:
+            raise HTTPException(status_code=400, detail=f"Invalid search query: {e}")
+        logger.error(f"Conversation search failed: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+    except Exception as e:
+        logger.error(f"Conversation search failed: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+    
+    return {
+        "query": q,
+        "results": results,
+        "next_offset": next_offset,
+        "took_ms": round((time.perf_counter() - start_time) * 1000, 2)
+    }
+
 @app.get("/conversations/{agent_id}")
-async def get_conversations(agent_id: str, limit: int = 10):
-    """Get conversation history for an agent"""
-    history = get_conversation_history(agent_id, limit)
-    return {"conversations": history}
+async def get_conversations(agent_id: str, limit: int = 10, cursor: Optional[str] = None,
+                            fields: Optional[str] = None):
+    """Get conversation history for an agent
+
+    Pages newest-first; pass the returned next_cursor to fetch the following
+    page. `fields` is an optional comma-separated projection.
+    """
+    limit = max(1, min(limit, MAX_HISTORY_PAGE_SIZE))
+    try:
+        before = decode_history_cursor(cursor) if cursor else None
+        columns = parse_history_fields(fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    # Make queued writes visible before reading
+    await asyncio.to_thread(conversation_writer.flush)
+    try:
+        history, next_key = await run_db(fetch_conversation_page, agent_id, limit, before, columns)
+    except Exception as e:
+        logger.error(f"Failed to retrieve conversation history: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+    
+    return {
+        "conversations": history,
+        "next_cursor": encode_history_cursor(next_key) if next_key else None
+    }
+
+@app.get("/conversations/{agent_id}/export")
+async def export_conversations(agent_id: str, fields: Optional[str] = None, batch_size: int = 500):
+    """Stream an agent's full history as NDJSON, newest first"""
+    batch_size = max(1, min(batch_size, MAX_HISTORY_PAGE_SIZE))
+    try:
+        columns = parse_history_fields(fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    await asyncio.to_thread(conversation_writer.flush)
+    
+    async def ndjson_rows():
+        before = None
+        while True:
+            try:
+                page, before = await run_db(fetch_conversation_page, agent_id, batch_size, before, columns)
+            except Exception as e:
+                logger.error(f"Conversation export failed: {e}")
+                yield json.dumps({"error": str(e)}) + "\n"
+                return
+            if page:
+                yield "".join(json.dumps(row, ensure_ascii=False) + "\n" for row in page)
+            if before is None:
+                return
+    
+    return StreamingResponse(ndjson_rows(), media_type="application/x-ndjson")
 
 # OpenAI API compatible endpoints
+def openai_chunk(conversation_id: str, created: int, model: str, delta: Dict[str, Any],
+                 finish_reason: Optional[str] = None) -> Dict[str, Any]:
+    """Build an OpenAI chat.completion.chunk payload"""
+    return {
+        "id": conversation_id,
+        "object": "chat.completion.chunk",
+        "created": created,
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+    }
+
+def openai_cache_prompt(messages: List[OpenAIMessage]) -> str:
+    """Text identifying a conversation for caching: the lone message, or the whole transcript"""
+    if len(messages) == 1:
+        return messages[0].content
+    return "\n".join(f"{message.role}: {message.content}" for message in messages)
+
+def prepare_openai_generation(request: OpenAICompletionRequest) -> tuple:
+    """Resolve the model, cache identity and /api/chat payload for an OpenAI-style request
+
+    Returns (model, cache_prompt, cache_key, payload).
+    """
+    # Serve the requested model (or its alias) rather than always the default one
+    cache_prompt = openai_cache_prompt(request.messages)
+    model = resolve_model(request.model, cache_prompt)
+    
+    # Forward the whole conversation to /api/chat so Ollama keeps multi-turn state
+    options = normalize_generation_options({"temperature": request.temperature, "num_predict": request.max_tokens})
+    payload = build_chat_payload(
+        [{"role": message.role, "content": message.content} for message in request.messages],
+        model,
+        options=options
+    )
+    
+    # Cache (and coalesce) by the model that actually answers and the options it answers with
+    return model, cache_prompt, get_cache_key(cache_prompt, model, options), payload
+
+def build_openai_completion(conversation_id: str, request: OpenAICompletionRequest, ai_response: str,
+                            prompt_tokens: int, completion_tokens: int) -> OpenAICompletionResponse:
+    """Wrap a generated answer as an OpenAI chat.completion"""
+    response_message = OpenAIMessage(role="assistant", content=ai_response)
+    choice = OpenAIChoice(
+        index=0,
+        message=response_message,
+        finish_reason="stop"
+    )
+    
+    # Ollama's prompt_eval_count/eval_count, or the local estimate when it did not report them
+    usage = OpenAIUsage(
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        total_tokens=prompt_tokens + completion_tokens
+    )
+    
+    return OpenAICompletionResponse(
+        id=conversation_id,
+        created=int(datetime.now().timestamp()),
+        model=request.model,
+        choices=[choice],
+        usage=usage
+    )
+
+async def openai_stream_events(request: OpenAICompletionRequest, user_input: str, conversation_id: str,
+                               cache_key: str, payload: Dict[str, Any],
+                               cached_response: Optional[Dict]) -> AsyncIterator[str]:
+    """Relay an Ollama generation (or a cached answer) as OpenAI-style SSE chunks"""
+    created = int(datetime.now().timestamp())
+    yield format_sse(openai_chunk(conversation_id, created, request.model, {"role": "assistant"}))
+    
+    if cached_response:
+        cache_logger.info(f"Returning cached OpenAI stream for: {conversation_id}")
+        prompt_tokens, completion_tokens, estimated = token_counts(
+            payload, cached_response.get("response", ""), cached_response)
+        save_conversation(
+            conversation_id=conversation_id,
+            agent="hello_zombie",
+            user_input=user_input,
+            ai_response=cached_response.get("response", "No response generated"),
+            model=cached_response.get("model", payload["model"]),
+            context={"source": "openai_api", "model_requested": request.model},
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            latency_ms=0,
+            cached=True,
+            estimated=estimated
+        )
+        yield format_sse(openai_chunk(conversation_id, created, request.model,
+                                      {"content": cached_response.get("response", "No response generated")}))
+        yield format_sse(openai_chunk(conversation_id, created, request.model, {}, "stop"))
+        yield format_sse("[DONE]")
+        return
+    
+    request_logger.info(f"Processing OpenAI compatible stream: {conversation_id}")
+    start_time = time.time()
+    parts = []
+    model_used = payload["model"]
+    final_chunk = {}
+    
+    async for chunk in stream_coalesced(cache_key, "/api/chat", payload, PRIORITY_BACKGROUND):
+        if "error" in chunk:
+            yield format_sse({"error": {"message": chunk["error"], "type": "ollama_error"}})
+            yield format_sse("[DONE]")
+            return
+        
+        if chunk.get("done"):
+            final_chunk = chunk
+        model_used = chunk.get("model", model_used)
+        text = chunk.get("response", "")
+        if text:
+            parts.append(text)
+            yield format_sse(openai_chunk(conversation_id, created, request.model, {"content": text}))
+    
+    ai_response = "".join(parts) or "No response generated"
+    prompt_tokens, completion_tokens, estimated = token_counts(payload, ai_response, final_chunk)
+    save_conversation(
+        conversation_id=conversation_id,
+        agent="hello_zombie",
+        user_input=user_input,
+        ai_response=ai_response,
+        model=model_used,
+        context={"source": "openai_api", "model_requested": request.model},
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        latency_ms=int((time.time() - start_time) * 1000),
+        estimated=estimated
+    )
+    request_logger.info(f"OpenAI stream generated in {time.time() - start_time:.2f}s for: {conversation_id}")
+    
+    yield format_sse(openai_chunk(conversation_id, created, request.model, {}, "stop"))
+    yield format_sse("[DONE]")
+
 @app.post("/v1/chat/completions", response_model=OpenAICompletionResponse)
 async def openai_chat_completions(request: OpenAICompletionRequest):
     """OpenAI API compatible chat completions endpoint with caching optimization"""
@@ -509,33 +4593,47 @@ async def openai_chat_completions(request: OpenAICompletionRequest):
         user_input = user_messages[-1].content
         
         # Generate conversation ID
-        conversation_id = f"openai_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{hash(user_input) % 10000}"
+        conversation_id = new_conversation_id("openai", user_input)
+        
+        model, cache_prompt, cache_key, payload = prepare_openai_generation(request)
         
         # Check cache first
-        cache_key = get_cache_key(user_input, request.model)
-        cached_response = get_cached_response(cache_key)
+        cached_response = await lookup_cached_response(cache_key, cache_prompt, model, payload.get("options"))
+        
+        if request.stream:
+            if not cached_response:
+                # Reject before the 200 status line is sent if the queue is already full
+                try:
+                    ollama_scheduler.check_admission(payload["model"])
+                except SchedulerRejected as e:
+                    raise generation_error(admission_error(e))
+            return StreamingResponse(
+                openai_stream_events(request, user_input, conversation_id, cache_key, payload, cached_response),
+                media_type="text/event-stream"
+            )
         
+        ollama_response = {}
+        response_time = 0.0
         if cached_response:
-            logger.info(f"Returning cached OpenAI response for: {conversation_id}")
+            cache_logger.info(f"Returning cached OpenAI response for: {conversation_id}")
             ai_response = cached_response.get("response", "No response generated")
-            model_used = cached_response.get("model", request.model)
+            model_used = cached_response.get("model", model)
         else:
             # Call Ollama if not cached
-            logger.info(f"Processing OpenAI compatible request: {conversation_id}")
+            request_logger.info(f"Processing OpenAI compatible request: {conversation_id}")
             start_time = time.time()
-            ollama_response = await call_ollama(user_input, OLLAMA_MODEL)
+            ollama_response = await generate_coalesced(cache_key, "/api/chat", payload, PRIORITY_BACKGROUND)
             response_time = time.time() - start_time
             
             if "error" in ollama_response:
-                raise HTTPException(status_code=500, detail=ollama_response["error"])
+                raise generation_error(ollama_response)
             
-            # Extract response
+            # Extract response (cached by the coalescing layer)
             ai_response = ollama_response.get("response", "No response generated")
-            model_used = ollama_response.get("model", OLLAMA_MODEL)
-            
-            # Cache the response
-            set_cached_response(cache_key, ollama_response)
-            logger.info(f"OpenAI response generated in {response_time:.2f}s for: {conversation_id}")
+            model_used = ollama_response.get("model", model)
+            request_logger.info(f"OpenAI response generated in {response_time:.2f}s for: {conversation_id}")
+        prompt_tokens, completion_tokens, estimated = token_counts(
+            payload, ai_response, cached_response or ollama_response)
         
         # Save to memory
         save_conversation(
@@ -544,33 +4642,16 @@ async def openai_chat_completions(request: OpenAICompletionRequest):
             user_input=user_input,
             ai_response=ai_response,
             model=model_used,
-            context={"source": "openai_api", "model_requested": request.model}
+            context={"source": "openai_api", "model_requested": request.model},
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            latency_ms=int(response_time * 1000),
+            cached=bool(cached_response),
+            estimated=estimated
         )
         
         # Create OpenAI compatible response
-        response_message = OpenAIMessage(role="assistant", content=ai_response)
-        choice = OpenAIChoice(
-            index=0,
-            message=response_message,
-            finish_reason="stop"
-        )
-        
-        # Estimate token usage (rough approximation)
-        prompt_tokens = len(user_input.split()) * 1.3  # Rough estimation
-        completion_tokens = len(ai_response.split()) * 1.3
-        usage = OpenAIUsage(
-            prompt_tokens=int(prompt_tokens),
-            completion_tokens=int(completion_tokens),
-            total_tokens=int(prompt_tokens + completion_tokens)
-        )
-        
-        return OpenAICompletionResponse(
-            id=conversation_id,
-            created=int(datetime.now().timestamp()),
-            model=request.model,
-            choices=[choice],
-            usage=usage
-        )
+        return build_openai_completion(conversation_id, request, ai_response, prompt_tokens, completion_tokens)
         
     except HTTPException:
         raise
@@ -578,46 +4659,392 @@ async def openai_chat_completions(request: OpenAICompletionRequest):
         logger.error(f"OpenAI compatible endpoint error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+# Batch processing
+class BatchJob:
+    """Runs a batch's pending items through Ollama with bounded parallelism
+
+    Items are answered from the response cache when possible and otherwise
+    generated at batch priority, backing off when the scheduler sheds load.
+    Each result is stored with its completion sequence number before
+    listeners are woken, so a restart resumes with only the pending items
+    and result streams can continue after any sequence number.
+    """
+    
+    def __init__(self, batch_id: str, parallelism: int, last_seq: int = 0):
+        self.batch_id = batch_id
+        self.parallelism = parallelism
+        self.seq = last_seq
+        self.done = False
+        self.completed = 0
+        self.failed = 0
+        self.cached = 0
+        self.changed = asyncio.Condition()
+        self.write_lock = asyncio.Lock()
+        self.task = asyncio.create_task(self._run())
+    
+    async def _run(self):
+        try:
+            items = await run_db(fetch_pending_batch_items, self.batch_id)
+            pending = iter(items)
+            
+            async def worker():
+                for idx, custom_id, request_json in pending:
+                    status, result, cached = await self._process(idx, request_json)
+                    await self._record(idx, status, result, cached)
+            
+            await asyncio.gather(*(worker() for _ in range(max(1, min(self.parallelism, len(items))))))
+            await run_db(finish_batch, self.batch_id)
+            if worker_coordinator is not None:
+                await asyncio.to_thread(worker_coordinator.release, f"batch:{self.batch_id}")
+            logger.info(f"Batch {self.batch_id} finished: {self.completed} completed "
+                        f"({self.cached} from cache), {self.failed} failed")
+        except asyncio.CancelledError:
+            # Left as 'running' with its pending items; resumed on the next startup,
+            # or by the leader once this worker stops renewing its claim
+            raise
+        except Exception as e:
+            logger.error(f"Batch {self.batch_id} stopped: {e}")
+        finally:
+            if batch_jobs.get(self.batch_id) is self:
+                del batch_jobs[self.batch_id]
+            async with self.changed:
+                self.done = True
+                self.changed.notify_all()
+    
+    async def _process(self, idx: int, request_json: str) -> tuple:
+        """Answer one item; returns (status, result, cached)"""
+        try:
+            request = OpenAICompletionRequest(**json.loads(request_json))
+            model, cache_prompt, cache_key, payload = prepare_openai_generation(request)
+            
+            start_time = time.time()
+            cached_response = await lookup_cached_response(cache_key, cache_prompt, model, payload.get("options"))
+            ollama_response = cached_response
+            if cached_response:
+                ai_response = cached_response.get("response", "No response generated")
+            else:
+                for attempt in range(BATCH_MAX_ATTEMPTS):
+                    ollama_response = await generate_coalesced(cache_key, "/api/chat", payload, PRIORITY_BATCH)
+                    if ollama_response.get("status_code") not in (429, 503) or attempt == BATCH_MAX_ATTEMPTS - 1:
+                        break
+                    await asyncio.sleep(ollama_response.get("retry_after", 5))
+                if "error" in ollama_response:
+                    return "failed", {"message": ollama_response["error"],
+                                      "status_code": ollama_response.get("status_code", 500)}, False
+                ai_response = ollama_response.get("response", "No response generated")
+            
+            prompt_tokens, completion_tokens, estimated = token_counts(payload, ai_response, ollama_response)
+            conversation_writer.add_usage("batch", ollama_response.get("model", model), prompt_tokens,
+                                          completion_tokens, int((time.time() - start_time) * 1000),
+                                          bool(cached_response), estimated)
+            completion = build_openai_completion(f"{self.batch_id}_{idx}", request, ai_response,
+                                                 prompt_tokens, completion_tokens)
+            return "completed", completion.model_dump(), bool(cached_response)
+        except Exception as e:
+            logger.error(f"Batch {self.batch_id} item {idx} failed: {e}")
+            return "failed", {"message": str(e), "status_code": 500}, False
+    
+    async def _record(self, idx: int, status: str, result: Dict[str, Any], cached: bool):
+        # Sequence numbers must reach the database in order or result streams could skip one
+        async with self.write_lock:
+            seq = self.seq + 1
+            await run_db(store_batch_result, self.batch_id, idx, status, result, cached, seq)
+            self.seq = seq
+        if status == "completed":
+            self.completed += 1
+            self.cached += int(cached)
+        else:
+            self.failed += 1
+        async with self.changed:
+            self.changed.notify_all()
+    
+    async def wait_past(self, seq: int):
+        """Wait until a result after `seq` is stored or the job ends"""
+        async with self.changed:
+            while self.seq <= seq and not self.done:
+                await self.changed.wait()
+
+batch_jobs: Dict[str, BatchJob] = {}
+
+def start_batch_job(batch_id: str, parallelism: int, last_seq: int = 0) -> BatchJob:
+    job = batch_jobs.get(batch_id)
+    if job is None:
+        job = batch_jobs[batch_id] = BatchJob(batch_id, parallelism, last_seq)
+    return job
+
+async def claim_batch(batch_id: str) -> bool:
+    """Take or renew the lease naming this worker as the batch's runner (always True with one worker)"""
+    if worker_coordinator is None:
+        return True
+    return await asyncio.to_thread(worker_coordinator.try_acquire, f"batch:{batch_id}", LEADER_LEASE_SECONDS)
+
+async def adopt_unfinished_batches():
+    """Resume running batches that no live worker holds"""
+    for batch_id, parallelism, last_seq in await run_db(unfinished_batches):
+        if batch_id not in batch_jobs and await claim_batch(batch_id):
+            start_batch_job(batch_id, parallelism, last_seq)
+            logger.info(f"Resuming batch {batch_id}")
+
+async def renew_batch_claims():
+    for batch_id, job in list(batch_jobs.items()):
+        if not job.done and not await claim_batch(batch_id):
+            logger.warning(f"Batch {batch_id} was taken over by another worker; stopping it here")
+            job.task.cancel()
+
+def get_batch_stats() -> Dict[str, Any]:
+    return {
+        "running": len(batch_jobs),
+        "jobs": {batch_id: {"parallelism": job.parallelism, "finished_items": job.seq,
+                            "completed": job.completed, "cached": job.cached, "failed": job.failed}
+                 for batch_id, job in batch_jobs.items()}
+    }
+
+def parse_batch_lines(body: str) -> List[tuple]:
+    """Validate a JSONL batch into (custom_id, request_json) items
+
+    Lines are either bare chat completion requests or OpenAI batch lines
+    ({"custom_id", "method", "url", "body"}).
+    """
+    items = []
+    for line_number, line in enumerate(body.splitlines(), start=1):
+        if not line.strip():
+            continue
+        try:
+            entry = json.loads(line)
+            if not isinstance(entry, dict):
+                raise ValueError("expected a JSON object")
+            if entry.get("url", "/v1/chat/completions") != "/v1/chat/completions":
+                raise ValueError(f"unsupported url {entry['url']}")
+            request_body = entry.get("body", entry)
+            request = OpenAICompletionRequest(**request_body)
+            if not any(message.role == "user" for message in request.messages):
+                raise ValueError("no user message found")
+        except Exception as e:
+            raise ValueError(f"line {line_number}: {e}")
+        custom_id = str(entry.get("custom_id", len(items)))
+        items.append((custom_id, request.model_dump_json(exclude={"stream"})))
+        if len(items) > BATCH_MAX_ITEMS:
+            raise ValueError(f"batch exceeds {BATCH_MAX_ITEMS} requests")
+    if not items:
+        raise ValueError("batch is empty")
+    return items
+
+async def batch_result_lines(batch_id: str, after_seq: int = 0) -> AsyncIterator[str]:
+    """JSONL of finished items in completion order, following the job until it ends"""
+    while True:
+        job = batch_jobs.get(batch_id)
+        rows = await run_db(fetch_batch_results, batch_id, after_seq, MAX_HISTORY_PAGE_SIZE)
+        if rows:
+            after_seq = rows[-1]["seq"]
+            yield "".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows)
+            continue
+        if job is None or job.done:
+            batch = await run_db(get_batch, batch_id)
+            if job is None and MULTI_WORKER and batch is not None and batch["status"] == "running":
+                # Running in another worker: follow its results through the database
+                await asyncio.sleep(1)
+                continue
+            yield json.dumps(batch) + "\n"
+            return
+        await job.wait_past(after_seq)
+
+@app.post("/v1/batch")
+async def submit_batch(request: Request, parallelism: Optional[int] = None, stream: bool = True):
+    """Run a JSONL file of chat completion requests and stream results back as JSONL"""
+    try:
+        items = parse_batch_lines((await request.body()).decode("utf-8"))
+    except (ValueError, UnicodeDecodeError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid batch: {e}")
+    
+    parallelism = max(1, min(parallelism or BATCH_PARALLELISM, BATCH_MAX_PARALLELISM))
+    batch_id = new_conversation_id("batch", items[0][1])
+    try:
+        # Claimed before the row exists, so the leader never adopts a batch that is just starting
+        await claim_batch(batch_id)
+        await run_db(create_batch, batch_id, items, parallelism)
+    except Exception as e:
+        logger.error(f"Failed to create batch: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+    
+    start_batch_job(batch_id, parallelism)
+    logger.info(f"Batch {batch_id} accepted: {len(items)} requests, parallelism {parallelism}")
+    
+    if stream:
+        return StreamingResponse(batch_result_lines(batch_id), media_type="application/x-ndjson",
+                                 headers={"X-Batch-Id": batch_id})
+    return JSONResponse(await run_db(get_batch, batch_id), status_code=202)
+
+@app.get("/v1/batch/{batch_id}")
+async def get_batch_status(batch_id: str):
+    """Progress and request counts for a batch"""
+    batch = await run_db(get_batch, batch_id)
+    if batch is None:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    return batch
+
+@app.get("/v1/batch/{batch_id}/results")
+async def get_batch_results(batch_id: str, after: int = 0):
+    """Stream a batch's results as JSONL, resuming after sequence number `after`"""
+    if await run_db(get_batch, batch_id) is None:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    return StreamingResponse(batch_result_lines(batch_id, after), media_type="application/x-ndjson",
+                             headers={"X-Batch-Id": batch_id})
+
 @app.get("/v1/models")
-async def openai_models():
+async def openai_models(request: Request):
     """OpenAI API compatible models endpoint"""
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            response = await client.get(f"{OLLAMA_HOST}/api/tags")
-            if response.status_code == 200:
-                data = response.json()
-                models = []
-                for model in data.get('models', []):
-                    models.append({
-                        "id": model['name'],
-                        "object": "model",
-                        "created": int(datetime.now().timestamp()),
-                        "owned_by": "hello-zombie"
-                    })
-                return {"object": "list", "data": models}
-            else:
-                raise HTTPException(status_code=500, detail="Failed to fetch models")
+        catalog = await model_catalog.get()
+        if catalog is None:
+            raise HTTPException(status_code=500, detail="Failed to fetch models")
+        # Stable timestamp so unchanged listings stay byte-identical for their ETag
+        created = int(model_catalog.last_modified)
+        models = []
+        for model in catalog:
+            models.append({
+                "id": model['name'],
+                "object": "model",
+                "created": created,
+                "owned_by": "hello-zombie"
+            })
+        # Advertise configured aliases so OpenAI clients can pick them
+        for alias in MODEL_ALIASES:
+            models.append({
+                "id": alias,
+                "object": "model",
+                "created": created,
+                "owned_by": "hello-zombie"
+            })
+        return catalog_response(request, {"object": "list", "data": models})
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Failed to get OpenAI compatible models: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/usage")
+async def get_token_usage(days: int = 30, agent: Optional[str] = None, model: Optional[str] = None,
+                          group: str = "day"):
+    """Token usage per agent and model over the last `days` UTC days (group=day or total)"""
+    if group not in ("day", "total"):
+        raise HTTPException(status_code=400, detail="group must be 'day' or 'total'")
+    try:
+        await asyncio.to_thread(conversation_writer.flush)
+        usage = await run_db(fetch_token_usage, days, agent, model, group == "day")
+        return {"days": days, "group": group, "usage": usage}
+    except Exception as e:
+        logger.error(f"Failed to read token usage: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+def _cache_lookups() -> Dict[tuple, int]:
+    tiers = {"memory": response_cache, "persistent": persistent_cache, "semantic": semantic_cache}
+    lookups = {}
+    for tier, cache in tiers.items():
+        if cache is not None:
+            lookups[(tier, "hit")] = cache.hits
+            lookups[(tier, "miss")] = cache.misses
+    return lookups
+
+def _cache_hit_ratio() -> Dict[tuple, float]:
+    lookups = _cache_lookups()
+    ratios = {}
+    for (tier, result), count in lookups.items():
+        if result == "hit":
+            total = count + lookups[(tier, "miss")]
+            ratios[(tier,)] = round(count / total, 4) if total else 0.0
+    return ratios
+
+metrics.sample("hello_zombie_cache_lookups_total", "Response cache lookups by tier and result",
+               ("tier", "result"), _cache_lookups, kind="counter")
+metrics.sample("hello_zombie_cache_hit_ratio", "Response cache hit ratio by tier", ("tier",), _cache_hit_ratio)
+metrics.sample("hello_zombie_scheduler_queue_depth", "Requests waiting for an Ollama slot", ("model",),
+               lambda: {(model,): OllamaScheduler._queued(state) for model, state in ollama_scheduler.models.items()})
+metrics.sample("hello_zombie_scheduler_running", "Generations holding an Ollama slot", ("model",),
+               lambda: {(model,): state["running"] for model, state in ollama_scheduler.models.items()})
+metrics.sample("hello_zombie_backend_outstanding", "In-flight requests per Ollama backend", ("backend",),
+               lambda: {(backend.url,): backend.outstanding for backend in ollama_backends.backends})
+metrics.sample("hello_zombie_backend_up", "1 when the backend's circuit is closed", ("backend",),
+               lambda: {(backend.url,): int(backend.opened_at is None) for backend in ollama_backends.backends})
+metrics.sample("hello_zombie_inflight_generations", "Coalesced generations in flight", ("kind",),
+               lambda: {("generate",): len(inflight_generations), ("stream",): len(inflight_streams)})
+metrics.sample("hello_zombie_conversation_write_queue", "Conversations waiting for the background writer", (),
+               lambda: {(): conversation_writer.queue.qsize()})
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Metrics in Prometheus text exposition format"""
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4")  # charset is appended
+
+def get_logging_stats() -> Dict[str, Any]:
+    return {
+        "queued": log_queue.qsize(),
+        "queue_size": LOG_QUEUE_SIZE,
+        "dropped": log_queue_handler.dropped,
+        "suppressed": log_sampler.suppressed_total,
+        "sampling": log_sampler.rules
+    }
+
+def worker_snapshot() -> Dict[str, Any]:
+    """Counters this worker publishes to the others; every leaf can be summed"""
+    tiers = {"memory": response_cache, "persistent": persistent_cache, "semantic": semantic_cache}
+    scheduler = {"running": 0, "queued": 0, "admitted": 0, "rejected": 0}
+    for state in ollama_scheduler.models.values():
+        scheduler["running"] += state["running"]
+        scheduler["queued"] += OllamaScheduler._queued(state)
+        scheduler["admitted"] += state["admitted"]
+        scheduler["rejected"] += state["rejected_queue_full"] + state["rejected_deadline"]
+    return {
+        "cache": {tier: {"hits": cache.hits, "misses": cache.misses}
+                  for tier, cache in tiers.items() if cache is not None},
+        "coalescing": get_coalescing_stats(),
+        "shared_generations": dict(coordination_stats),
+        "writer": {"written": conversation_writer.written, "dropped": conversation_writer.dropped,
+                   "failed": conversation_writer.failed},
+        "scheduler": scheduler
+    }
+
+def sum_worker_stats(snapshots: List[Dict[str, Any]]) -> Dict[str, Any]:
+    totals: Dict[str, Any] = {}
+    for snapshot in snapshots:
+        for name, value in snapshot.items():
+            if isinstance(value, dict):
+                totals[name] = sum_worker_stats([totals.get(name, {}), value])
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                totals[name] = totals.get(name, 0) + value
+    return totals
+
+def get_worker_stats() -> Dict[str, Any]:
+    if worker_coordinator is None:
+        return {"mode": "single", "worker_id": WORKER_ID, "leader": True, "count": 1}
+    workers = worker_coordinator.workers()
+    return {
+        "mode": "multi",
+        "worker_id": WORKER_ID,
+        "leader": worker_coordinator.is_leader,
+        "count": WORKER_COUNT,
+        "live": len(workers),
+        "elections_won": worker_coordinator.elections_won,
+        "cache_epoch": cache_epoch,
+        "workers": workers,
+        "totals": sum_worker_stats([worker["stats"] for worker in workers])
+    }
+
 @app.get("/performance")
 async def get_performance_metrics():
     """Get performance metrics and cache statistics"""
     try:
-        with cache_lock:
-            cache_stats = {
-                "total_cached_responses": len(response_cache),
-                "cache_hit_rate": "N/A",  # Would need to track hits/misses
-                "max_cache_size": MAX_CACHE_SIZE,
-                "cache_ttl_seconds": CACHE_TTL
-            }
+        cache_stats = response_cache.stats()
+        cache_stats["persistent"] = await asyncio.to_thread(persistent_cache.stats) if persistent_cache is not None else {"enabled": False}
+        cache_stats["semantic"] = semantic_cache.stats() if semantic_cache is not None else {"enabled": False}
         
-        with db_lock:
-            db_stats = {
-                "active_connections": len(db_connections),
-                "max_connections": MAX_DB_CONNECTIONS
-            }
+        read_stats = db_read_pool.stats()
+        db_stats = {
+            "active_connections": read_stats["open_connections"] + db_write_pool.stats()["open_connections"],
+            "max_connections": MAX_DB_CONNECTIONS + 1,
+            "read_pool": read_stats,
+            "write_pool": db_write_pool.stats()
+        }
+        db_stats["writer"] = conversation_writer.stats()
         
         # Get database size
         db_size = 0
@@ -627,6 +5054,18 @@ async def get_performance_metrics():
         return {
             "cache": cache_stats,
             "database": db_stats,
+            "ollama_pool": get_ollama_pool_stats(),
+            "ollama_backends": ollama_backends.stats(),
+            "model_catalog": model_catalog.stats(),
+            "models": get_model_stats(),
+            "coalescing": get_coalescing_stats(),
+            "sessions": get_session_stats(),
+            "batches": get_batch_stats(),
+            "scheduler": ollama_scheduler.stats(),
+            "memory_retrieval": memory_index.stats() if memory_index is not None else {"enabled": False},
+            "logging": get_logging_stats(),
+            "retention": retention_worker.stats(),
+            "workers": await asyncio.to_thread(get_worker_stats),
             "database_size_bytes": db_size,
             "timestamp": datetime.now().isoformat()
         }
@@ -634,20 +5073,143 @@ async def get_performance_metrics():
         logger.error(f"Failed to get performance metrics: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/cache")
+async def inspect_cache(limit: int = 50):
+    """Inspect response cache statistics and the most recently used entries"""
+    return {
+        "stats": response_cache.stats(),
+        "persistent": await asyncio.to_thread(persistent_cache.stats) if persistent_cache is not None else {"enabled": False},
+        "semantic": semantic_cache.stats() if semantic_cache is not None else {"enabled": False},
+        "entries": response_cache.describe(limit),
+        "timestamp": datetime.now().isoformat()
+    }
+
+@app.delete("/cache")
+async def flush_cache():
+    """Flush the response cache"""
+    flushed = response_cache.clear()
+    flushed_persistent = await asyncio.to_thread(persistent_cache.clear) if persistent_cache is not None else 0
+    if semantic_cache is not None:
+        semantic_cache.clear()
+    await asyncio.to_thread(announce_cache_flush)
+    logger.info(f"Response cache flushed: {flushed} in memory, {flushed_persistent} persistent")
+    return {
+        "status": "success",
+        "flushed_entries": flushed,
+        "flushed_persistent_entries": flushed_persistent,
+        "timestamp": datetime.now().isoformat()
+    }
+
+@app.delete("/cache/{cache_key}")
+async def delete_cache_entry(cache_key: str):
+    """Remove a single response cache entry"""
+    deleted = response_cache.delete(cache_key)
+    if persistent_cache is not None:
+        deleted = await asyncio.to_thread(persistent_cache.delete, cache_key) or deleted
+    if semantic_cache is not None:
+        semantic_cache.remove(cache_key)
+    await asyncio.to_thread(announce_cache_flush)
+    if not deleted:
+        raise HTTPException(status_code=404, detail="Cache entry not found")
+    return {"status": "success", "key": cache_key}
+
+@app.delete("/sessions/{session_id}")
+async def delete_session(session_id: str):
+    """Forget a multi-turn session's stored context"""
+    with session_lock:
+        removed = session_contexts.pop(session_id, None) is not None
+    if not removed:
+        raise HTTPException(status_code=404, detail="Session not found")
+    return {"status": "success", "session_id": session_id}
+
 @app.post("/cleanup")
-async def cleanup_old_data():
-    """Manually trigger cleanup of old conversations"""
+async def cleanup_old_data(enable_incremental_vacuum: bool = False):
+    """Run a retention pass now (waits for one already in progress)
+
+    enable_incremental_vacuum converts a database created before incremental
+    vacuum was the default; it rewrites the file and blocks writes meanwhile.
+    """
     try:
-        deleted_count = cleanup_old_conversations()
-        return {
+        auto_vacuum = None
+        if enable_incremental_vacuum:
+            await asyncio.to_thread(conversation_writer.flush)
+            auto_vacuum = await run_db(enable_incremental_vacuum_mode)
+        result = await retention_worker.run_pass()
+        response = {
             "status": "success",
-            "deleted_conversations": deleted_count,
+            "deleted_conversations": result["deleted"],
+            "archived_conversations": result["archived"],
+            "pages_vacuumed": result["pages_vacuumed"],
             "timestamp": datetime.now().isoformat()
         }
+        if auto_vacuum is not None:
+            response["auto_vacuum"] = auto_vacuum
+        return response
     except Exception as e:
         logger.error(f"Failed to cleanup old data: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+# Jobs that must run in exactly one worker
+leader_tasks: List[asyncio.Task] = []
+
+async def start_leader_tasks():
+    """Start singleton jobs once this process holds leadership"""
+    if memory_index is not None:
+        if MULTI_WORKER:
+            # Rows the previous leader appended, then every worker's new conversations
+            await asyncio.to_thread(memory_index.refresh)
+            leader_tasks.append(asyncio.create_task(memory_index_sync_loop()))
+        else:
+            leader_tasks.append(asyncio.create_task(backfill_memory_index()))
+        leader_tasks.append(asyncio.create_task(memory_index_loop()))
+    # Expired conversations are removed in the background, never blocking startup
+    if RETENTION_ENABLED:
+        leader_tasks.append(asyncio.create_task(retention_loop()))
+    if persistent_cache is not None:
+        leader_tasks.append(asyncio.create_task(persistent_cache_compaction_loop()))
+    # Resume batches interrupted by the last shutdown
+    await adopt_unfinished_batches()
+
+def stop_leader_tasks():
+    for task in leader_tasks:
+        task.cancel()
+    leader_tasks.clear()
+
+async def coordination_loop():
+    """Heartbeat: renew leadership, publish stats and follow cache flushes"""
+    global cache_epoch
+    while True:
+        await asyncio.sleep(WORKER_HEARTBEAT_SECONDS)
+        try:
+            was_leader = worker_coordinator.is_leader
+            leader = await asyncio.to_thread(worker_coordinator.elect)
+            if leader and not was_leader:
+                logger.info(f"Worker {WORKER_ID} is now the leader")
+                await start_leader_tasks()
+            elif was_leader and not leader:
+                logger.warning(f"Worker {WORKER_ID} lost leadership")
+                stop_leader_tasks()
+            await asyncio.to_thread(worker_coordinator.publish, worker_snapshot())
+            await renew_batch_claims()
+            if leader:
+                # Batches whose worker exited or stopped heartbeating
+                await adopt_unfinished_batches()
+            epoch = await asyncio.to_thread(worker_coordinator.counter, "cache_epoch")
+            if epoch != cache_epoch:
+                # Another worker flushed or deleted entries; the shared tier is already current
+                cache_epoch = epoch
+                flushed = response_cache.clear()
+                if semantic_cache is not None:
+                    semantic_cache.clear()
+                pending_embeddings.clear()
+                cache_logger.info(f"Dropped {flushed} in-memory cache entries after a flush in another worker")
+            if memory_index is not None and not leader:
+                await asyncio.to_thread(memory_index.refresh)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Worker coordination failed: {e}")
+
 # Startup event
 @app.on_event("startup")
 async def startup_event():
@@ -660,22 +5222,101 @@ async def startup_event():
     else:
         logger.error("Failed to initialize memory database")
     
+    # Start the write-behind conversation writer
+    conversation_writer.start()
+    
+    # Open the persistent cache tier and warm the in-memory tier from it
+    if persistent_cache is not None and await asyncio.to_thread(persistent_cache.open):
+        warmed = await asyncio.to_thread(warm_response_cache)
+        logger.info(f"Warm-loaded {warmed} cached responses from disk")
+    
+    # Watch the agent files for hot reload
+    if HOT_RELOAD_ENABLED:
+        background_tasks.append(asyncio.create_task(agent_watch_loop()))
+    
+    # Open the shared Ollama connection pool; the first probe fills the model catalog
+    get_ollama_client()
+    background_tasks.append(asyncio.create_task(backend_refresh_loop()))
+    # Join the other workers and find out whether this one runs the singleton jobs
+    global cache_epoch
+    if worker_coordinator is not None:
+        await asyncio.to_thread(worker_coordinator.open)
+        cache_epoch = await asyncio.to_thread(worker_coordinator.counter, "cache_epoch")
+        leader = await asyncio.to_thread(worker_coordinator.elect)
+        logger.info(f"Worker {WORKER_ID} started as {'leader' if leader else 'follower'} of {WORKER_COUNT}")
+        if persistent_cache is None:
+            # Results travel between workers through the persistent tier only
+            logger.warning("cache.persistent is disabled, so identical generations are only coalesced "
+                           "within each worker; enable it to run them once across all workers")
+        background_tasks.append(asyncio.create_task(coordination_loop()))
+    # Map the memory index; only the leader may repair or append to it
+    if memory_index is not None:
+        if is_leader():
+            indexed = await asyncio.to_thread(memory_index.load)
+        else:
+            indexed = await asyncio.to_thread(memory_index.refresh)
+        logger.info(f"Memory index loaded: {indexed} conversations ({MEMORY_INDEX_PATH})")
+    elif MEMORY_RETRIEVAL_ENABLED:
+        logger.warning("Memory retrieval needs NumPy and is disabled; install it from requirements.txt")
+    if semantic_cache is not None and np is None:
+        logger.warning("Semantic cache is running without NumPy; searches fall back to slower pure Python")
+    if OLLAMA_HTTP2 and not HTTP2_AVAILABLE:
+        logger.warning("ollama.http.http2 is on but the h2 package is missing; using HTTP/1.1 keep-alive "
+                       "(install httpx[http2] from requirements.txt)")
+    
     # Check Ollama connection
     if await check_ollama_health():
         logger.info("Ollama server is healthy")
     else:
         logger.warning("Ollama server is not responding")
     
-    # Cleanup old conversations on startup
-    deleted_count = cleanup_old_conversations()
-    if deleted_count > 0:
-        logger.info(f"Cleaned up {deleted_count} old conversations on startup")
+    # Memory indexing, retention, cache compaction and batch resumption run in the leader only
+    if is_leader():
+        await start_leader_tasks()
     
     # Initialize performance monitoring
     logger.info("Performance optimizations enabled:")
-    logger.info(f"  - Response caching: {MAX_CACHE_SIZE} max entries, {CACHE_TTL}s TTL")
-    logger.info(f"  - Database connection pooling: {MAX_DB_CONNECTIONS} max connections")
-    logger.info(f"  - Automatic cleanup: 30 days retention")
+    logger.info(f"  - Response caching: LRU, {MAX_CACHE_BYTES // (1024 * 1024)} MB budget, {CACHE_TTL}s TTL")
+    logger.info(f"  - Database connection pooling: {MAX_DB_CONNECTIONS} read + 1 write connections (WAL)")
+    logger.info(f"  - Write-behind persistence: batches of {WRITE_BATCH_SIZE}, {WRITE_FLUSH_INTERVAL}s flush interval")
+    logger.info(f"  - Ollama HTTP pool: {OLLAMA_HTTP_CONFIG.get('max_connections', 20)} max connections, keep-alive enabled")
+    logger.info(f"  - Ollama backends: {len(ollama_backends.backends)} ({', '.join(OLLAMA_BACKEND_URLS)}), least-outstanding routing")
+    logger.info(f"  - Model routing: {len(MODEL_ALIASES)} aliases, size routing {'on' if SIZE_ROUTING_ENABLED else 'off'}, keep_alive {OLLAMA_KEEP_ALIVE}")
+    logger.info(f"  - Ollama scheduler: {MAX_CONCURRENCY_PER_MODEL} concurrent generations per model, queue of {MAX_QUEUE_PER_MODEL}")
+    if MULTI_WORKER:
+        logger.info(f"  - Workers: {WORKER_COUNT} processes coordinated through {COORDINATION_PATH}")
+    if memory_index is not None:
+        logger.info(f"  - Memory retrieval: top {MEMORY_TOP_K} past exchanges, {MEMORY_TOKEN_BUDGET} token budget")
+    if RETENTION_ENABLED:
+        logger.info(f"  - Retention: {RETENTION_DAYS} days, batches of {RETENTION_BATCH_SIZE} every {RETENTION_INTERVAL}s"
+                    f"{', archived to ' + RETENTION_ARCHIVE_PATH if RETENTION_ARCHIVE_ENABLED else ''}")
+
+# Shutdown event
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Release shared resources on shutdown"""
+    for task in background_tasks:
+        task.cancel()
+    background_tasks.clear()
+    stop_leader_tasks()
+    # Unfinished batches keep their pending items and resume on the next start
+    batch_tasks = [job.task for job in batch_jobs.values()]
+    for task in batch_tasks:
+        task.cancel()
+    await asyncio.gather(*batch_tasks, return_exceptions=True)
+    
+    if persistent_cache is not None:
+        if is_leader():
+            await asyncio.to_thread(persistent_cache.compact)
+        await asyncio.to_thread(persistent_cache.close)
+    # Hand leadership over right away instead of waiting for the lease to expire
+    if worker_coordinator is not None:
+        await asyncio.to_thread(worker_coordinator.close)
+    await asyncio.to_thread(conversation_writer.stop)
+    db_read_pool.close()
+    db_write_pool.close()
+    await close_ollama_client()
+    logger.info("Hello Zombie Main Server stopped")
 
 if __name__ == "__main__":
     uvicorn.run(
@@ -683,5 +5324,6 @@ if __name__ == "__main__":
         host="0.0.0.0",
         port=12346,
         reload=False,
+        workers=WORKER_COUNT,
         log_level="info"
     )
@@ -0,0 +1,201 @@
+"""
+Schema Migration Test for Hello Zombie Main Server
+Builds a database with the original (pre-migration) schema, migrates it and
+checks rows, timestamps, indexes and the full-text index. No server or
+Ollama needed; everything runs in a temporary directory.
+"""
+
+import importlib.util
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+from datetime import datetime
+from pathlib import Path
+
+REPO_DIR = Path(__file__).resolve().parent
+
+# The schema main_server.py created before versioned migrations existed
+BASELINE_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS conversations (
+        id TEXT PRIMARY KEY,
+        agent TEXT NOT NULL,
+        user_input TEXT NOT NULL,
+        ai_response TEXT NOT NULL,
+        timestamp TEXT NOT NULL,
+        model TEXT NOT NULL,
+        context TEXT
+    )
+'''
+
+# (id, agent, user_input, ai_response, timestamp, model, context); timestamps are
+# local-time ISO strings as the baseline wrote them with datetime.now().isoformat()
+BASELINE_ROWS = [
+    ("conv_1", "hello_zombie", "my secret project codename is bluebird", "Noted!",
+     "2024-03-01T09:15:30.123456", "gemma:2b", None),
+    ("conv_2", "hello_zombie", "what is a zombie", "An undead creature.",
+     "2024-03-02T18:00:00", "gemma:2b", '{"test": true}'),
+    ("conv_3", "coder", "write a haiku about rain", "Soft rain on the roof",
+     "2024-12-31T23:59:59.999000", "deepseek-coder:6.7b", None),
+    ("conv_4", "coder", "broken timestamp row", "still kept",
+     "not a timestamp", "gemma:2b", None),
+]
+
+_server = None
+
+def load_server():
+    """Import main_server once, from a temporary working directory with a minimal config"""
+    global _server
+    if _server is not None:
+        return _server
+    workdir = Path(tempfile.mkdtemp(prefix="hello_zombie_migration_"))
+    config_dir = workdir / "Extension" / "agent_config"
+    config_dir.mkdir(parents=True)
+    (config_dir / "hello_zombie.yaml").write_text(
+        "agent: {name: \"Hello Zombie\"}\n"
+        "infrastructure:\n"
+        "  hot_reload: {enabled: false}\n"
+        "  logging: {console_level: ERROR}\n"
+        "  memory: {location: data/memory/hello_zombie_memory.sqlite}\n",
+        encoding="utf-8"
+    )
+    os.chdir(workdir)
+    spec = importlib.util.spec_from_file_location("main_server", REPO_DIR / "main_server.py")
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["main_server"] = module
+    spec.loader.exec_module(module)
+    _server = module
+    return module
+
+def build_baseline_db(path: Path):
+    conn = sqlite3.connect(path)
+    conn.execute(BASELINE_SCHEMA)
+    conn.executemany("INSERT INTO conversations VALUES (?, ?, ?, ?, ?, ?, ?)", BASELINE_ROWS)
+    conn.commit()
+    conn.close()
+
+class RecordCollector(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record: logging.LogRecord):
+        self.records.append(record)
+
+def migrate_baseline():
+    """Migrate a fresh baseline database; returns (server, connection, warnings logged)"""
+    server = load_server()
+    path = Path(tempfile.mkdtemp(prefix="hello_zombie_baseline_")) / "memory.sqlite"
+    build_baseline_db(path)
+    collector = RecordCollector()
+    server.logger.addHandler(collector)
+    try:
+        conn = sqlite3.connect(path, isolation_level=None)
+        version = server.migrate_memory_db(conn)
+    finally:
+        server.logger.removeHandler(collector)
+    assert version == server.SCHEMA_VERSION
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == server.SCHEMA_VERSION
+    warnings = [record.getMessage() for record in collector.records if record.levelno == logging.WARNING]
+    return server, conn, warnings
+
+def test_rows_preserved():
+    """Every baseline row survives the table rebuild with its text intact"""
+    print("🔍 Testing Migrated Rows...")
+    _, conn, _ = migrate_baseline()
+    rows = conn.execute(
+        "SELECT id, agent, user_input, ai_response, model, context FROM conversations ORDER BY id"
+    ).fetchall()
+    assert rows == [(row[0], row[1], row[2], row[3], row[5], row[6]) for row in BASELINE_ROWS]
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(conversations)")}
+    assert {"prompt_tokens", "completion_tokens", "latency_ms"} <= columns
+    assert conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'conversations_v1'").fetchone()[0] == 0
+    print("✅ Migrated rows: PASS")
+
+def test_timestamps_converted():
+    """Local ISO timestamps become UTC epoch milliseconds; unparseable ones become 0 with a warning"""
+    print("🔍 Testing Timestamp Conversion...")
+    _, conn, warnings = migrate_baseline()
+    stored = dict(conn.execute("SELECT id, timestamp FROM conversations"))
+    for conversation_id, _, _, _, timestamp, _, _ in BASELINE_ROWS[:3]:
+        expected = datetime.fromisoformat(timestamp).timestamp() * 1000
+        assert abs(stored[conversation_id] - expected) <= 1, (conversation_id, stored[conversation_id], expected)
+    assert conn.execute("SELECT typeof(timestamp) FROM conversations WHERE id = 'conv_1'").fetchone()[0] == "integer"
+    assert stored["conv_4"] == 0
+    assert any("unparseable timestamps" in message and "conv_4" in message for message in warnings), warnings
+    print("✅ Timestamp conversion: PASS")
+
+def test_indexes_created():
+    """The history and retention indexes exist and the superseded one is gone"""
+    print("🔍 Testing Indexes...")
+    _, conn, _ = migrate_baseline()
+    indexes = {row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'conversations'")}
+    assert "idx_conversations_timestamp" in indexes
+    assert "idx_conversations_agent_timestamp_id" in indexes
+    assert "idx_conversations_agent_timestamp" not in indexes
+    plan = " ".join(row[3] for row in conn.execute(
+        "EXPLAIN QUERY PLAN SELECT id FROM conversations WHERE agent = ? ORDER BY timestamp DESC, id DESC",
+        ("coder",)))
+    assert "idx_conversations_agent_timestamp_id" in plan, plan
+    print("✅ Indexes: PASS")
+
+def test_fts_index_populated():
+    """Existing rows are searchable, and the triggers follow inserts, updates and deletes"""
+    print("🔍 Testing Full-Text Index...")
+    _, conn, _ = migrate_baseline()
+
+    def search(query: str) -> list:
+        return [row[0] for row in conn.execute(
+            "SELECT c.id FROM conversations_fts f JOIN conversations c ON c.rowid = f.rowid "
+            "WHERE conversations_fts MATCH ? ORDER BY c.id", (query,))]
+
+    assert search("bluebird") == ["conv_1"]
+    assert search("haiku") == ["conv_3"]
+    assert search("undead") == ["conv_2"]
+    conn.execute("INSERT INTO conversations_fts(conversations_fts) VALUES ('integrity-check')")
+
+    conn.execute("INSERT INTO conversations (id, agent, user_input, ai_response, timestamp, model) "
+                 "VALUES ('conv_5', 'coder', 'tell me about kestrels', 'Small falcons.', 0, 'gemma:2b')")
+    assert search("kestrels") == ["conv_5"]
+    conn.execute("UPDATE conversations SET ai_response = 'Tiny raptors.' WHERE id = 'conv_5'")
+    assert search("falcons") == [] and search("raptors") == ["conv_5"]
+    conn.execute("DELETE FROM conversations WHERE id = 'conv_1'")
+    assert search("bluebird") == []
+    conn.execute("INSERT INTO conversations_fts(conversations_fts) VALUES ('integrity-check')")
+    print("✅ Full-text index: PASS")
+
+def test_migration_idempotent():
+    """Running the migrations again on a current database changes nothing"""
+    print("🔍 Testing Repeated Migration...")
+    server, conn, _ = migrate_baseline()
+    before = conn.execute("SELECT id, timestamp FROM conversations ORDER BY id").fetchall()
+    assert server.migrate_memory_db(conn) == server.SCHEMA_VERSION
+    assert conn.execute("SELECT id, timestamp FROM conversations ORDER BY id").fetchall() == before
+    print("✅ Repeated migration: PASS")
+
+def run_migration_tests():
+    """Run all migration tests"""
+    print("🚀 Starting Hello Zombie Migration Tests...")
+    print("=" * 50)
+
+    try:
+        test_rows_preserved()
+        test_timestamps_converted()
+        test_indexes_created()
+        test_fts_index_populated()
+        test_migration_idempotent()
+
+        print("=" * 50)
+        print("🎉 ALL MIGRATION TESTS PASSED!")
+        return True
+
+    except Exception as e:
+        print("=" * 50)
+        print(f"❌ MIGRATION TEST FAILED: {e!r}")
+        return False
+
+if __name__ == "__main__":
+    success = run_migration_tests()
+    exit(0 if success else 1)
@@ -0,0 +1,241 @@
+"""
+Backend Routing Test for Hello Zombie Main Server
+Runs OllamaBackendPool against small local stub servers standing in for
+Ollama instances, plus one address nobody listens on, and checks routing,
+retries and circuit breaking. No Ollama needed.
+"""
+
+import asyncio
+import json
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+
+from migration_test import load_server
+
+class StubOllama:
+    """A tiny HTTP server answering like one Ollama instance"""
+
+    def __init__(self, name: str, status: int = 200, models: tuple = ()):
+        self.name = name
+        self.status = status
+        self.models = list(models)
+        self.requests = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _reply(self, status: int, body: dict):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                if self.path in ("/api/tags", "/api/ps"):
+                    self._reply(200, {"models": [{"name": model} for model in stub.models]})
+                else:
+                    self._reply(404, {"error": "not found"})
+
+            def do_POST(self):
+                stub.requests += 1
+                payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                self._reply(stub.status, {"model": payload.get("model"), "response": stub.name, "done": True})
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def unreachable_url() -> str:
+    """An address with nothing listening, so connecting fails right away"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    return f"http://127.0.0.1:{port}"
+
+def run(scenario):
+    """Run a coroutine on a fresh loop, closing the shared Ollama client it opened"""
+    server = load_server()
+
+    async def wrapper():
+        try:
+            return await scenario
+        finally:
+            await server.close_ollama_client()
+    return asyncio.run(wrapper())
+
+def test_retries_on_another_backend():
+    """Connection failures are retried elsewhere and open the failing backend's circuit"""
+    print("🔍 Testing Retry On Another Backend...")
+    server = load_server()
+    stub = StubOllama("a")
+    try:
+        pool = server.OllamaBackendPool([unreachable_url(), stub.url])
+        dead, alive = pool.backends
+
+        async def scenario():
+            answers = []
+            for _ in range(20):
+                response = await pool.request("POST", "/api/generate", json={"model": "m"})
+                answers.append((response.status_code, response.json()["response"]))
+                if dead.state() == "open":
+                    break
+            async with pool.stream("POST", "/api/generate", json={"model": "m"}) as response:
+                answers.append((response.status_code, json.loads(await response.aread())["response"]))
+            return answers
+
+        answers = run(scenario())
+        assert set(answers) == {(200, "a")}, answers
+        assert dead.failures == server.BACKEND_FAILURE_THRESHOLD
+        assert pool.retries == dead.failures
+        assert dead.state() == "open" and alive.state() == "closed"
+        assert dead.outstanding == 0 and alive.outstanding == 0
+
+        # An open circuit takes no traffic at all
+        async def concurrent():
+            return await asyncio.gather(*(pool.request("POST", "/api/generate", json={"model": "m"})
+                                          for _ in range(5)))
+
+        requests_before = dead.requests
+        assert [response.status_code for response in run(concurrent())] == [200] * 5
+        assert dead.requests == requests_before
+    finally:
+        stub.close()
+    print("✅ Retry on another backend: PASS")
+
+def test_all_backends_down():
+    """With every backend unreachable the connection error reaches the caller"""
+    print("🔍 Testing All Backends Down...")
+    server = load_server()
+    pool = server.OllamaBackendPool([unreachable_url(), unreachable_url()])
+    try:
+        run(pool.request("POST", "/api/generate", json={"model": "m"}))
+        raise AssertionError("request to unreachable backends succeeded")
+    except httpx.ConnectError:
+        pass
+    assert sum(backend.failures for backend in pool.backends) == 2
+    assert pool.retries == 1
+    print("✅ All backends down: PASS")
+
+def test_half_open_trial():
+    """After the cool-down one trial request is let through; success closes the circuit, failure reopens it"""
+    print("🔍 Testing Half-Open Circuit...")
+    server = load_server()
+    stub = StubOllama("a")
+    try:
+        pool = server.OllamaBackendPool([stub.url])
+        backend = pool.backends[0]
+        backend.consecutive_failures = server.BACKEND_FAILURE_THRESHOLD
+        backend.opened_at = time.time()
+        assert backend.state() == "open"
+        try:
+            pool.choose()
+            raise AssertionError("open circuit was chosen")
+        except httpx.ConnectError:
+            pass
+
+        backend.opened_at = time.time() - server.BACKEND_OPEN_SECONDS - 1
+        assert backend.state() == "half_open" and pool.choose() is backend
+        response = run(pool.request("POST", "/api/generate", json={"model": "m"}))
+        assert response.status_code == 200
+        assert backend.state() == "closed" and backend.consecutive_failures == 0
+    finally:
+        stub.close()
+
+    pool = server.OllamaBackendPool([unreachable_url()])
+    backend = pool.backends[0]
+    backend.opened_at = time.time() - server.BACKEND_OPEN_SECONDS - 1
+    try:
+        run(pool.request("POST", "/api/generate", json={"model": "m"}))
+        raise AssertionError("trial request to an unreachable backend succeeded")
+    except httpx.ConnectError:
+        pass
+    assert backend.state() == "open" and not backend.half_open_trial
+    print("✅ Half-open circuit: PASS")
+
+def test_server_errors_open_circuit():
+    """5xx responses are returned to the caller but count against the backend"""
+    print("🔍 Testing Server Errors...")
+    server = load_server()
+    stub = StubOllama("broken", status=500)
+    try:
+        pool = server.OllamaBackendPool([stub.url])
+
+        async def scenario():
+            return [(await pool.request("POST", "/api/generate", json={"model": "m"})).status_code
+                    for _ in range(server.BACKEND_FAILURE_THRESHOLD)]
+
+        assert run(scenario()) == [500] * server.BACKEND_FAILURE_THRESHOLD
+        assert pool.backends[0].state() == "open"
+        assert pool.retries == 0
+    finally:
+        stub.close()
+    print("✅ Server errors: PASS")
+
+def test_model_affinity_and_load():
+    """Backends with the model loaded win, then installed, then the least outstanding requests"""
+    print("🔍 Testing Model Affinity...")
+    server = load_server()
+    stubs = [StubOllama("a", models=("m",)), StubOllama("b", models=("m", "n"))]
+    try:
+        pool = server.OllamaBackendPool([stub.url for stub in stubs])
+        a, b = pool.backends
+        assert run(pool.refresh())
+        assert a.installed_models == {"m"} and b.installed_models == {"m", "n"}
+        assert a.loaded_models == {"m"} and b.loaded_models == {"m", "n"}
+
+        assert {pool.choose("n").url for _ in range(4)} == {b.url}
+        a.loaded_models = set()
+        assert {pool.choose("m").url for _ in range(4)} == {b.url}
+        b.loaded_models = set()
+        chosen = {pool.choose("m").url for _ in range(4)}
+        assert chosen == {a.url, b.url}, chosen  # ties rotate
+
+        a.outstanding = 2
+        assert {pool.choose("m").url for _ in range(4)} == {b.url}
+        a.outstanding = 0
+
+        response = run(pool.request("POST", "/api/generate", model="n", json={"model": "n"}))
+        assert response.json()["response"] == "b"
+        assert stubs[0].requests == 0 and stubs[1].requests == 1
+        assert "n" in b.loaded_models
+    finally:
+        for stub in stubs:
+            stub.close()
+    print("✅ Model affinity: PASS")
+
+def run_routing_tests():
+    """Run all backend routing tests"""
+    print("🚀 Starting Hello Zombie Backend Routing Tests...")
+    print("=" * 50)
+
+    try:
+        test_retries_on_another_backend()
+        test_all_backends_down()
+        test_half_open_trial()
+        test_server_errors_open_circuit()
+        test_model_affinity_and_load()
+
+        print("=" * 50)
+        print("🎉 ALL ROUTING TESTS PASSED!")
+        return True
+
+    except Exception as e:
+        print("=" * 50)
+        print(f"❌ ROUTING TEST FAILED: {e!r}")
+        return False
+
+if __name__ == "__main__":
+    success = run_routing_tests()
+    exit(0 if success else 1)
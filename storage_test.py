@@ -0,0 +1,186 @@
+"""
+Storage Test for Hello Zombie Main Server
+Checks the in-memory response cache, history cursors and keyset pages,
+full-text search and batch resume against a fresh database in a temporary
+directory. No server or Ollama needed.
+"""
+
+import json
+import time
+
+from migration_test import load_server
+
+_database_ready = False
+
+def load_database():
+    """Create the memory database once; returns the server module"""
+    global _database_ready
+    server = load_server()
+    if not _database_ready:
+        assert server.init_memory_db()
+        _database_ready = True
+    return server
+
+def insert_conversations(server, rows: list):
+    """Insert (id, agent, user_input, ai_response, timestamp) rows"""
+    with server.db_write_pool.connection() as conn, conn:
+        conn.executemany(
+            "INSERT INTO conversations (id, agent, user_input, ai_response, timestamp, model) "
+            "VALUES (?, ?, ?, ?, ?, 'gemma:2b')", rows)
+
+def test_response_cache_lru_and_ttl():
+    """The least recently used entry is evicted first, expired entries miss, oversized ones are refused"""
+    print("🔍 Testing Response Cache...")
+    server = load_server()
+    value = {"response": "x" * 100, "model": "m"}
+    entry_size = len("key-a") + len(json.dumps(value).encode("utf-8"))
+    cache = server.ResponseCache(entry_size * 2, 60, entry_size * 2)
+
+    assert cache.set("key-a", value) and cache.set("key-b", value)
+    assert cache.get("key-a") == value  # key-b is now least recently used
+    assert cache.set("key-c", value)
+    assert cache.get("key-b") is None
+    assert cache.get("key-a") == value and cache.get("key-c") == value
+    stats = cache.stats()
+    assert stats["evictions"] == 1 and stats["total_cached_responses"] == 2
+    assert stats["total_bytes"] == entry_size * 2
+
+    assert not cache.set("key-big", {"response": "x" * entry_size * 2})
+    assert cache.stats()["rejected"] == 1
+
+    assert cache.set("key-a", value, ttl=0.05)
+    time.sleep(0.1)
+    assert cache.get("key-a") is None
+    assert cache.stats()["expirations"] == 1
+    assert cache.set("key-d", value, ttl=0.05)
+    time.sleep(0.1)
+    assert cache.purge_expired() == 1
+    assert [entry["key"] for entry in cache.describe()] == ["key-c"]
+    print("✅ Response cache: PASS")
+
+def test_history_cursor():
+    """Cursors round-trip any (timestamp, id) and reject garbage"""
+    print("🔍 Testing History Cursor...")
+    server = load_server()
+    for key in [(1700000000123, "conv_abc"), (0, "id:with:colons"), (42, "ünïcode")]:
+        cursor = server.encode_history_cursor(key)
+        assert "=" not in cursor
+        assert server.decode_history_cursor(cursor) == key
+    for cursor in ["!!!", "bm90LWEtY3Vyc29y", ""]:
+        try:
+            server.decode_history_cursor(cursor)
+            raise AssertionError(f"cursor {cursor!r} was accepted")
+        except ValueError:
+            pass
+    print("✅ History cursor: PASS")
+
+def test_history_pages():
+    """Keyset pages walk the history newest-first without gaps or repeats, even on equal timestamps"""
+    print("🔍 Testing History Pages...")
+    server = load_database()
+    rows = [(f"page_{index}", "pager", f"question {index}", f"answer {index}", 1000 + index // 2)
+            for index in range(7)]
+    insert_conversations(server, rows)
+    expected = [row[0] for row in sorted(rows, key=lambda row: (row[4], row[0]), reverse=True)]
+
+    seen, before = [], None
+    while True:
+        page, next_key = server.fetch_conversation_page("pager", 3, before, ["id", "user_input"])
+        assert all(set(item) == {"id", "user_input"} for item in page)
+        seen.extend(item["id"] for item in page)
+        if next_key is None:
+            break
+        before = server.decode_history_cursor(server.encode_history_cursor(next_key))
+    assert seen == expected, seen
+    try:
+        server.parse_history_fields("id,password")
+        raise AssertionError("unknown field was accepted")
+    except ValueError:
+        pass
+    print("✅ History pages: PASS")
+
+def test_search_conversations():
+    """Search ranks question matches above answer matches, filters by agent and pages"""
+    print("🔍 Testing Conversation Search...")
+    server = load_database()
+    insert_conversations(server, [
+        ("search_1", "hello_zombie", "where do kestrels nest", "On cliffs.", 1),
+        ("search_2", "hello_zombie", "name a small falcon", "The kestrel is one.", 2),
+        ("search_3", "coder", "kestrels in python?", "Not a library.", 3),
+    ])
+
+    assert server.build_fts_query("kestrels, nest!") == '"kestrels" "nest"*'
+    assert server.build_fts_query("kestrel OR falcon", raw=True) == "kestrel OR falcon"
+    for text in ["", "!!! ???"]:
+        try:
+            server.build_fts_query(text)
+            raise AssertionError(f"query {text!r} was accepted")
+        except ValueError:
+            pass
+
+    results, next_offset = server.search_conversations(server.build_fts_query("kestrel"), None, 10, 0)
+    assert {result["id"] for result in results} == {"search_1", "search_2", "search_3"}
+    assert next_offset is None
+    # Question matches outrank answer matches
+    assert results[-1]["id"] == "search_2"
+    assert "<mark>" in results[0]["user_input"]
+
+    results, _ = server.search_conversations(server.build_fts_query("kestrel"), "coder", 10, 0)
+    assert [result["id"] for result in results] == ["search_3"]
+
+    first, next_offset = server.search_conversations(server.build_fts_query("kestrel"), None, 2, 0)
+    rest, last_offset = server.search_conversations(server.build_fts_query("kestrel"), None, 2, next_offset)
+    assert next_offset == 2 and last_offset is None
+    assert len(first) == 2 and len(rest) == 1
+    assert {result["id"] for result in first + rest} == {"search_1", "search_2", "search_3"}
+    print("✅ Conversation search: PASS")
+
+def test_batch_resume():
+    """An interrupted batch resumes with only its pending items and after its last sequence number"""
+    print("🔍 Testing Batch Resume...")
+    server = load_database()
+    items = [(f"item-{index}", json.dumps({"model": "m", "messages": [{"role": "user", "content": str(index)}]}))
+             for index in range(4)]
+    server.create_batch("batch_resume", items, 2)
+    server.store_batch_result("batch_resume", 2, "completed", {"ok": True}, True, 1)
+    server.store_batch_result("batch_resume", 0, "failed", {"message": "boom"}, False, 2)
+
+    assert ("batch_resume", 2, 2) in server.unfinished_batches()
+    assert [idx for idx, _, _ in server.fetch_pending_batch_items("batch_resume")] == [1, 3]
+    results = server.fetch_batch_results("batch_resume", 0, 10)
+    assert [(item["seq"], item["index"], item["status"]) for item in results] == [(1, 2, "completed"), (2, 0, "failed")]
+    assert results[0]["cached"] and results[0]["response"] == {"ok": True}
+    assert results[1]["error"] == {"message": "boom"}
+    assert [item["seq"] for item in server.fetch_batch_results("batch_resume", 1, 10)] == [2]
+
+    batch = server.get_batch("batch_resume")
+    assert batch["request_counts"] == {"total": 4, "completed": 1, "failed": 1, "pending": 2, "cached": 1}
+    server.finish_batch("batch_resume")
+    assert "batch_resume" not in {batch_id for batch_id, _, _ in server.unfinished_batches()}
+    assert server.get_batch("batch_resume")["status"] == "completed"
+    print("✅ Batch resume: PASS")
+
+def run_storage_tests():
+    """Run all storage tests"""
+    print("🚀 Starting Hello Zombie Storage Tests...")
+    print("=" * 50)
+
+    try:
+        test_response_cache_lru_and_ttl()
+        test_history_cursor()
+        test_history_pages()
+        test_search_conversations()
+        test_batch_resume()
+
+        print("=" * 50)
+        print("🎉 ALL STORAGE TESTS PASSED!")
+        return True
+
+    except Exception as e:
+        print("=" * 50)
+        print(f"❌ STORAGE TEST FAILED: {e!r}")
+        return False
+
+if __name__ == "__main__":
+    success = run_storage_tests()
+    exit(0 if success else 1)